@@ -105,6 +105,7 @@ After=network.target
 [Service]
 Type=simple
 ExecStart={python_bin} {script_path}
+ExecReload=/bin/kill -HUP $MAINPID
 Restart=always
 WorkingDirectory={os.path.dirname(script_path)}
 StandardOutput=journal
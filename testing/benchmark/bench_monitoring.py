@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------------
+# Copyright (c) 2025 Lancaster University
+# Written by: Gerard Hand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#---------------------------------------------------------------------------------
+# Measures the cost of talking to the alert manager and the push gateway.
+#
+# For each number of servers the stand-ins of fakemonitor.py are started in a process of their own and an
+# Alerter that pushes its metrics is pointed at them.  Three things are timed:
+#   startup  - reset_alerts() for every server, as ServerList does for servers not in the state file.  The
+#              first call reads all the active alerts from the alert manager.  The others use the copy.
+#   alerts   - A restart alert for every server and then clearing them all, from the first alert being
+#              raised to the last one being on the alert manager.  The time taken to raise them shows how
+#              long the restarts wait.  The number of POST requests shows how well the alerts are batched.
+#   push     - Making the text of the metrics of every server and pushing them to the push gateway (PUT),
+#              and pushing just the heartbeat (POST).  The pushes made by the pusher thread while the alerts
+#              were being sent show how many changes were merged in to one push.
+#
+# Example:
+#   python3 testing/benchmark/bench_monitoring.py --nodes 100,1000,5000 --alerts 20000 --latency 0.005:0.02
+#
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import requests
+from prometheus_client import generate_latest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import xrootdrestart as xr
+import fakessh
+from bench_restarts import percentile
+
+PHASES = ["connect"] + xr.DurationModel.PHASES
+
+
+def start_monitor(args):
+    # Start the stand-ins in a separate process.  Returns the process and the alert manager and push gateway urls.
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakemonitor.py"),
+               "--alerts", str(args.alerts), "--latency", args.latency, "--errors", str(args.errors)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    monitor = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = monitor.stdout.readline().split()
+    if not line or line[0] != "READY":
+        monitor.kill()
+        raise Exception("The alert manager and push gateway stand-ins didn't start")
+    return monitor, f"http://127.0.0.1:{line[1]}", f"http://127.0.0.1:{line[2]}"
+
+
+def stats(url):
+    return requests.get(f"{url}/-/stats", timeout=10).json()
+
+
+def timed(func, count):
+    # Call func count times.  Returns the sorted times and the number of calls that raised an exception.
+    times = []
+    failures = 0
+    for i in range(count):
+        start_time = time.time()
+        try:
+            func()
+        except Exception:
+            failures += 1
+        times.append(time.time() - start_time)
+    return sorted(times), failures
+
+
+def populate(alerter, names):
+    # Give every server the metric series a restart gives it.
+    for name in names:
+        alerter.restart_begin(name)
+        alerter.set_restart_time(name)
+        alerter.xrootdrestart_duration.labels(**alerter.metrics_labels(name)).observe(300)
+        alerter.set_drain_time(name, 240)
+        alerter.set_handshake_time(name, 0.2)
+        alerter.ssh_pool_request(name, "miss")
+        alerter.set_expected_duration(name, 300)
+        alerter.set_node_up(name, True)
+        for phase in PHASES:
+            alerter.set_phase_time(name, phase, "ok", 10)
+            alerter.set_command_time(name, phase, "ok", 1)
+        alerter.restart_end(name)
+    alerter.heartbeat_metric.labels(**alerter.metrics_labels(alerter.hostname)).set(time.time())
+
+
+def run(args, count):
+    monitor, alert_url, pushgw_url = start_monitor(args)
+    try:
+        config = xr.Config(fail_no_key=False)
+        config.alert_url = alert_url
+        config.pushgw_url = pushgw_url
+        config.metrics_method = xr.PUSH
+        config.set_extra_values()
+        xr.alerter = alerter = xr.Alerter(config)
+        names = fakessh.addresses(count)
+        result = {"nodes": count, "seeded_alerts": args.alerts}
+
+        # Startup.
+        start_time = time.time()
+        alerter.reset_alerts(names[0])
+        result["reset_first"] = time.time() - start_time
+        for name in names[1:]:
+            alerter.reset_alerts(name)
+        result["reset_all"] = time.time() - start_time
+
+        # Alerts.
+        alerter.flush(args.timeout)
+        before = stats(alert_url)
+        pushes_before = stats(pushgw_url).get("PUT requests", 0)
+        start_time = time.time()
+        for name in names:
+            alerter.restart_failure(name, f"Unable to restart the services on {name}", "benchmark")
+        result["raise"] = time.time() - start_time
+        for name in names:
+            alerter.clear_restart_alert(name)
+        result["raise_and_clear"] = time.time() - start_time
+        flushed = alerter.events.flush(args.timeout) and alerter.dispatcher.flush(args.timeout)
+        result["alerts_time"] = time.time() - start_time
+        result["alerts_flushed"] = flushed
+        after = stats(alert_url)
+        result["alert_posts"] = after.get("POST requests", 0) - before.get("POST requests", 0)
+        result["alerts_received"] = after.get("alerts received", 0) - before.get("alerts received", 0)
+        result["alerts_per_second"] = 2 * count / result["alerts_time"] if result["alerts_time"] > 0 else 0
+        alerter.pusher.flush(args.timeout)
+        result["pusher_pushes"] = stats(pushgw_url).get("PUT requests", 0) - pushes_before
+
+        # Push.
+        populate(alerter, names)
+        alerter.pusher.flush(args.timeout)
+        text = generate_latest(alerter.registry)
+        result["metrics_bytes"] = len(text)
+        times, failures = timed(lambda: generate_latest(alerter.registry), args.pushes)
+        result["generate"] = {"p50": percentile(times, 0.5), "p99": percentile(times, 0.99)}
+        times, failures = timed(alerter.push_metrics, args.pushes)
+        result["full_push"] = {"p50": percentile(times, 0.5), "p99": percentile(times, 0.99), "failures": failures}
+        times, failures = timed(alerter.push_heartbeat, args.pushes)
+        result["heartbeat_push"] = {"p50": percentile(times, 0.5), "p99": percentile(times, 0.99), "failures": failures}
+        result["injected_errors"] = stats(alert_url).get("injected errors", 0) + stats(pushgw_url).get("injected errors", 0)
+        return result
+    finally:
+        monitor.terminate()
+        monitor.wait()
+
+
+def report(results):
+    print("Startup (reset_alerts for every server)")
+    print(f"{'nodes':>6} {'alerts':>7} {'first ms':>9} {'all ms':>9} {'next us':>11}")
+    for r in results:
+        print(f"{r['nodes']:>6} {r['seeded_alerts']:>7} {r['reset_first'] * 1000:>9.1f} {r['reset_all'] * 1000:>9.1f} "
+              f"{(r['reset_all'] - r['reset_first']) / max(r['nodes'] - 1, 1) * 1e6:>11.1f}")
+    print()
+    print("Alerts (raise and clear a restart alert for every server)")
+    print(f"{'nodes':>6} {'raise ms':>9} {'clear ms':>9} {'total s':>8} {'alerts/s':>9} {'posts':>6} {'received':>8} {'pushes':>6} {'flushed':>7}")
+    for r in results:
+        print(f"{r['nodes']:>6} {r['raise'] * 1000:>9.1f} {(r['raise_and_clear'] - r['raise']) * 1000:>9.1f} "
+              f"{r['alerts_time']:>8.2f} {r['alerts_per_second']:>9.0f} {r['alert_posts']:>6} {r['alerts_received']:>8} "
+              f"{r['pusher_pushes']:>6} {str(r['alerts_flushed']):>7}")
+    print()
+    print("Push (p50/p99 ms)")
+    print(f"{'nodes':>6} {'bytes':>9} {'generate':>15} {'full push':>15} {'heartbeat':>15} {'failed':>6} {'errors':>6}")
+    for r in results:
+        pairs = [f"{r[k]['p50'] * 1000:.1f}/{r[k]['p99'] * 1000:.1f}" for k in ["generate", "full_push", "heartbeat_push"]]
+        failed = r["full_push"]["failures"] + r["heartbeat_push"]["failures"]
+        print(f"{r['nodes']:>6} {r['metrics_bytes']:>9} {pairs[0]:>15} {pairs[1]:>15} {pairs[2]:>15} {failed:>6} {r['injected_errors']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark XRootDRestart's use of the alert manager and push gateway.")
+    parser.add_argument("--nodes", default="100,1000", help="Comma separated list of the numbers of servers to run")
+    parser.add_argument("--alerts", type=int, default=10000, help="Number of active alerts the alert manager starts with")
+    parser.add_argument("--latency", default="0:0", help="Time range of the replies in seconds (MIN:MAX)")
+    parser.add_argument("--errors", type=float, default=0.0, help="Fraction of the requests answered with a 500 error")
+    parser.add_argument("--pushes", type=int, default=10, help="Number of pushes timed")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for the alerts to be sent")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random times, errors and alerts")
+    parser.add_argument("--log", default=None, help="Write the XRootDRestart log to this file")
+    parser.add_argument("--json", default=None, help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    # Nothing is logged unless a log file is given.
+    xr.logger = logging.getLogger("xrootdrestart")
+    if args.log:
+        handler = logging.FileHandler(args.log)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'))
+        xr.logger.addHandler(handler)
+        xr.logger.setLevel(logging.DEBUG)
+    else:
+        xr.logger.addHandler(logging.NullHandler())
+        xr.logger.setLevel(logging.ERROR)
+
+    results = []
+    for count in [int(count) for count in args.nodes.split(",")]:
+        print(f"Alerts and metrics for {count} servers", file=sys.stderr, flush=True)
+        results.append(run(args, count))
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------------
+# Copyright (c) 2025 Lancaster University
+# Written by: Gerard Hand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#---------------------------------------------------------------------------------
+# Measures how XRootDRestart scales with the number of servers.
+#
+# For each number of servers a fleet of fake servers (fakessh.py) is started and the ServerList is driven
+# through one rotation: every server is restarted once, restart_interval seconds apart, by the normal
+# scheduler, engine, ssh pool and restart code.  The fleet runs in a process of its own so the thread
+# count and memory reported are XRootDRestart's alone.
+#
+# Reported for each run:
+#   startup     - Seconds to create the ServerList (reading the state, loading the keys, scheduling).
+#   elapsed     - Seconds from the first restart starting to the last one finishing.
+#   restarts/h  - Restarts finished per hour.  The target is 3600 / interval.
+#   failed      - Restarts that failed.
+#   threads     - Highest number of threads.
+#   rss         - Highest resident memory in MB.
+#   p50/p99 of each phase of the restarts that succeeded.
+#
+# Example:
+#   python3 testing/benchmark/bench_restarts.py --nodes 10,100,1000 --max-concurrent 20 --interval 0.05
+#
+import argparse
+import collections
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import xrootdrestart as xr
+import fakessh
+
+PHASES = ["connect", "cmsd_stop", "cmsd_wait", "xrootd_stop", "xrootd_start", "cmsd_start"]
+SAMPLE_INTERVAL = 0.2
+
+
+def percentile(samples, q):
+    # Nearest rank percentile of a sorted list.
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def rss_mb():
+    # Resident memory of this process in MB.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+class Sampler:
+    # Records the highest thread count and memory use while a run is going.
+
+    def __init__(self):
+        self.threads = 0
+        self.rss = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="bench-sampler", daemon=True)
+        self.thread.start()
+
+
+    def sample(self):
+        self.threads = max(self.threads, threading.active_count() - 1)
+        self.rss = max(self.rss, rss_mb())
+
+
+    def run(self):
+        while self.running:
+            self.sample()
+            time.sleep(SAMPLE_INTERVAL)
+
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sample()
+
+
+def start_fleet(args, count):
+    # Start the fake servers in a separate process.  Returns the process and the port it listens on.
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fakessh.py"),
+               "--nodes", str(count), "--time-scale", str(args.time_scale),
+               "--stop", args.stop, "--start", args.start, "--query", args.query,
+               "--stop-fail", str(args.stop_fail), "--start-fail", str(args.start_fail), "--hang", str(args.hang)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    fleet = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = fleet.stdout.readline().split()
+    if not line or line[0] != "READY":
+        fleet.kill()
+        raise Exception("The fake servers didn't start")
+    return fleet, int(line[1])
+
+
+def make_config(args, count, port, key_file):
+    config = xr.Config(fail_no_key=False)
+    config.servers = fakessh.addresses(count)
+    config.ssh_port = port
+    config.priv_file = key_file
+    config.cmsd_period = count * args.interval
+    config.cmsd_wait = args.cmsd_wait
+    config.service_timeout = args.service_timeout
+    config.min_ok = 0
+    config.max_concurrent = args.max_concurrent
+    config.engine = args.engine
+    config.ssh_workers = args.ssh_workers
+    config.ssh_idle_timeout = args.ssh_idle_timeout
+    config.ssh_pool_size = args.ssh_pool_size
+    config.restart_mode = xr.COMMANDS
+    config.selection = xr.ROUND_ROBIN
+    config.probe_interval = 0
+    config.set_extra_values()
+    return config
+
+
+def rotate(config, server_list):
+    # Restart every server once using the scheduler, the same way main() does.
+    scheduler = server_list.scheduler
+    count = len(server_list)
+    ticks = 0
+
+    def finished():
+        with server_list.lock:
+            return ticks >= count and not server_list.pending and not server_list.in_flight
+
+    if config.engine == xr.ASYNC:
+        engine = xr.AsyncEngine(config, server_list)
+        tick = scheduler.tick
+        time_to_next = scheduler.time_to_next
+
+        def counted_tick():
+            nonlocal ticks
+            tick()
+            ticks += 1
+
+        scheduler.tick = counted_tick
+        scheduler.time_to_next = lambda: time_to_next() if ticks < count else xr.ALIVE_LIMIT
+
+        def stop_when_finished():
+            # Stop the event loop once the last restart has finished.
+            while not finished() or engine.loop is None:
+                time.sleep(0.05)
+            server_list.terminating = True
+            engine.loop.call_soon_threadsafe(engine.wakeup.set)
+
+        threading.Thread(target=stop_when_finished, daemon=True).start()
+        try:
+            engine.run()
+        except xr.Server.TerminateException:
+            pass
+    else:
+        while ticks < count:
+            server_list.alive()
+            wait = scheduler.time_to_next()
+            if wait <= 0:
+                scheduler.tick()
+                ticks += 1
+            else:
+                time.sleep(min(wait, 1))
+        while not finished():
+            time.sleep(0.05)
+        server_list.wait_for_restarts()
+
+
+def run(args, count, key_file):
+    fleet, port = start_fleet(args, count)
+    try:
+        config = make_config(args, count, port, key_file)
+        xr.ssh_pool = xr.SSHPool(config)
+        xr.ssh_pool.start()
+        xr.state_store = xr.StateStore(":memory:")
+
+        # Record the phase times as the restarts report them.
+        samples = collections.defaultdict(list)
+        set_phase_time = xr.Alerter.set_phase_time
+        def record_phase_time(server_name, phase, outcome, seconds):
+            if outcome == "ok":
+                samples[phase].append(seconds)
+            set_phase_time(xr.alerter, server_name, phase, outcome, seconds)
+        xr.alerter.set_phase_time = record_phase_time
+
+        sampler = Sampler()
+        start_time = time.time()
+        xr.server_list = xr.ServerList(config)
+        startup = time.time() - start_time
+
+        start_time = time.time()
+        rotate(config, xr.server_list)
+        elapsed = time.time() - start_time
+        sampler.stop()
+
+        outcomes = collections.Counter(row["outcome"] for row in xr.state_store.db.execute("SELECT outcome FROM history"))
+        result = {
+            "nodes": count,
+            "engine": config.engine,
+            "max_concurrent": config.max_concurrent,
+            "startup": startup,
+            "elapsed": elapsed,
+            "restarts": sum(outcomes.values()),
+            "failed": outcomes[xr.StateStore.FAILURE] + outcomes[xr.StateStore.INTERRUPTED],
+            "restarts_per_hour": sum(outcomes.values()) / elapsed * 3600 if elapsed > 0 else 0,
+            "target_per_hour": 3600 / args.interval,
+            "threads": sampler.threads,
+            "rss_mb": sampler.rss,
+            "phases": {},
+        }
+        for phase in PHASES:
+            times = sorted(samples[phase])
+            if times:
+                result["phases"][phase] = {"count": len(times), "p50": percentile(times, 0.5), "p99": percentile(times, 0.99)}
+        return result
+    finally:
+        xr.ssh_pool.close_all()
+        for server in list(xr.server_list.list if xr.server_list else []):
+            xr.alerter.remove_node(server.name)
+        del xr.alerter.set_phase_time
+        xr.state_store.close()
+        xr.server_list = None
+        fleet.terminate()
+        fleet.wait()
+
+
+def report(results):
+    print(f"{'nodes':>6} {'engine':>6} {'conc':>4} {'startup':>8} {'elapsed':>8} {'restarts':>8} {'failed':>6} "
+          f"{'restarts/h':>10} {'target/h':>9} {'threads':>7} {'rss MB':>7}")
+    for r in results:
+        print(f"{r['nodes']:>6} {r['engine']:>6} {r['max_concurrent']:>4} {r['startup']:>8.2f} {r['elapsed']:>8.2f} "
+              f"{r['restarts']:>8} {r['failed']:>6} {r['restarts_per_hour']:>10.0f} {r['target_per_hour']:>9.0f} "
+              f"{r['threads']:>7} {r['rss_mb']:>7.1f}")
+    print()
+    print(f"{'nodes':>6} {'phase':>12} {'count':>6} {'p50 s':>8} {'p99 s':>8}")
+    for r in results:
+        for phase, stats in r["phases"].items():
+            print(f"{r['nodes']:>6} {phase:>12} {stats['count']:>6} {stats['p50']:>8.3f} {stats['p99']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark XRootDRestart against fleets of fake servers.")
+    parser.add_argument("--nodes", default="10,100,1000", help="Comma separated list of the numbers of servers to run")
+    parser.add_argument("--interval", type=float, default=0.05, help="Seconds between restarts (cmsd_period / number of servers)")
+    parser.add_argument("--max-concurrent", type=int, default=20, help="max_concurrent setting")
+    parser.add_argument("--engine", default=xr.THREAD, type=str.upper, choices=[xr.THREAD, xr.ASYNC], help="engine setting")
+    parser.add_argument("--ssh-workers", type=int, default=xr.SSH_WORKERS, help="ssh_workers setting")
+    parser.add_argument("--ssh-idle-timeout", type=int, default=xr.SSH_IDLE_TIMEOUT, help="ssh_idle_timeout setting")
+    parser.add_argument("--ssh-pool-size", type=int, default=xr.SSH_POOL_SIZE, help="ssh_pool_size setting")
+    parser.add_argument("--cmsd-wait", type=int, default=0, help="cmsd_wait setting")
+    parser.add_argument("--service-timeout", type=int, default=xr.SERVICE_TIMEOUT, help="service_timeout setting")
+    parser.add_argument("--stop", default="10:30", help="Time range of systemctl stop in seconds (MIN:MAX)")
+    parser.add_argument("--start", default="1:5", help="Time range of systemctl start in seconds (MIN:MAX)")
+    parser.add_argument("--query", default="0:0.1", help="Time range of the other commands in seconds (MIN:MAX)")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="All the command times are multiplied by this")
+    parser.add_argument("--stop-fail", type=float, default=0.0, help="Fraction of stops that leave the service running")
+    parser.add_argument("--start-fail", type=float, default=0.0, help="Fraction of starts that fail")
+    parser.add_argument("--hang", type=float, default=0.0, help="Fraction of stops and starts that never reply")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random times and failures")
+    parser.add_argument("--log", default=None, help="Write the XRootDRestart log to this file")
+    parser.add_argument("--json", default=None, help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    # Nothing is logged unless a log file is given.
+    xr.logger = logging.getLogger("xrootdrestart")
+    if args.log:
+        handler = logging.FileHandler(args.log)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'))
+        xr.logger.addHandler(handler)
+        xr.logger.setLevel(logging.DEBUG)
+    else:
+        xr.logger.addHandler(logging.NullHandler())
+        xr.logger.setLevel(logging.ERROR)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    # The alerter registers the metrics so there can only be one.  Alerts are turned off and the metrics
+    # are served on a free port.
+    config = xr.Config(fail_no_key=False)
+    config.alert_url = ""
+    config.metrics_port = 0
+    config.metrics_method = xr.PULL
+    config.set_extra_values()
+    xr.alerter = xr.Alerter(config)
+
+    results = []
+    with tempfile.TemporaryDirectory() as key_dir:
+        key_file = os.path.join(key_dir, "id_ecdsa")
+        paramiko.ECDSAKey.generate().write_private_key_file(key_file)
+        for count in [int(count) for count in args.nodes.split(",")]:
+            print(f"Restarting {count} servers", file=sys.stderr, flush=True)
+            results.append(run(args, count, key_file))
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
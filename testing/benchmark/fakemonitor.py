@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------------
+# Copyright (c) 2025 Lancaster University
+# Written by: Gerard Hand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#---------------------------------------------------------------------------------
+# Stand-ins for the alert manager and the push gateway, for testing and benchmarking XRootDRestart without
+# the containers of the test monitoring stack.
+#
+# Only the parts of the APIs XRootDRestart uses are there:
+#   Alert manager  GET  /api/v2/alerts          - The active alerts.
+#                  POST /api/v2/alerts          - Add or update alerts.  Alerts with an endsAt time that has
+#                                                 passed are removed.
+#   Push gateway   PUT    /metrics/job/...      - Replace the metrics of a group.
+#                  POST   /metrics/job/...      - Replace the metric families that are pushed, keep the others.
+#                  DELETE /metrics/job/...      - Remove a group.
+#                  GET    /metrics              - All the pushed metrics.
+# Both answer GET /-/stats with the number of requests, injected errors, alerts and bytes received.
+#
+# Every request waits a random time in the latency range before it is answered and a fraction of them
+# get a 500 error instead.  The alert manager can be started with a large list of alerts, most of them
+# not from XRootDRestart, like a busy site alert manager.
+#
+# It can be used from python (FakeAlertmanager, FakePushgateway) or run on its own:
+#   python3 fakemonitor.py --alerts 10000 --latency 0.01:0.05 --errors 0.01
+# When it is ready it prints "READY <alert manager port> <push gateway port>".  Set alert_url and
+# pushgw_url to http://127.0.0.1:<port> to point XRootDRestart at them.
+#
+import argparse
+import collections
+import datetime
+import http.server
+import json
+import random
+import signal
+import threading
+import time
+
+from fakessh import addresses, time_range
+
+# Alert names used for the seeded alerts.  Only the first three are XRootDRestart's.
+ALERT_NAMES = ['XROOTDRESTART_RESTART_ERROR', 'XROOTDRESTART_CONNECT_ERROR', 'XROOTDRESTART_INSUFFICIENT_SERVERS',
+               'NodeDown', 'DiskFull', 'HighLoad', 'NetworkErrors', 'CertificateExpiring', 'SwapUsage', 'ClockSkew']
+XROOTDRESTART_SHARE = 0.1
+
+
+def utc_time(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_time(value):
+    try:
+        return datetime.datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+class FakeService:
+    # An http server that adds the latency, errors and request counts.  Subclasses implement handle().
+
+    def __init__(self, latency=(0, 0), errors=0.0, seed=None):
+        self.latency = latency
+        self.errors = errors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+        self.server = None
+
+    def start(self, port=0):
+        # Start serving on 127.0.0.1.  Returns the port.
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_request(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                status, content_type, reply = service.request(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_request
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self.server.server_address[1]
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def request(self, method, path, body):
+        # Returns (status, content type, reply).
+        with self.lock:
+            self.stats[f"{method} requests"] += 1
+            self.stats["bytes received"] += len(body)
+            delay = self.random.uniform(*self.latency)
+            fail = self.random.random() < self.errors
+        if path == "/-/stats":
+            with self.lock:
+                return 200, "application/json", json.dumps(self.stats).encode()
+        time.sleep(delay)
+        if fail:
+            with self.lock:
+                self.stats["injected errors"] += 1
+            return 500, "text/plain", b"injected error\n"
+        with self.lock:
+            return self.handle(method, path, body)
+
+
+class FakeAlertmanager(FakeService):
+    # The alerts are kept by their labels, like the alert manager does.
+
+    def __init__(self, latency=(0, 0), errors=0.0, seed=None, alerts=0):
+        super().__init__(latency, errors, seed)
+        self.alerts = {}
+        self.seed_alerts(alerts)
+
+    @staticmethod
+    def key(alert):
+        return tuple(sorted(alert.get("labels", {}).items()))
+
+    def seed_alerts(self, count):
+        # Add count active alerts.  XROOTDRESTART_SHARE of them are XRootDRestart alerts for the fake servers
+        # of fakessh.py, the rest are for other things.
+        now = time.time()
+        nodes = addresses(count)
+        for i in range(count):
+            if self.random.random() < XROOTDRESTART_SHARE:
+                name = ALERT_NAMES[i % 3]
+                labels = {"alertname": name, "severity": "critical"}
+                if name != 'XROOTDRESTART_INSUFFICIENT_SERVERS':
+                    labels["node"] = nodes[i]
+            else:
+                name = ALERT_NAMES[3 + i % (len(ALERT_NAMES) - 3)]
+                labels = {"alertname": name, "severity": "warning", "instance": f"host{i}.example.org:9100", "job": "node"}
+            alert = {
+                "labels": labels,
+                "annotations": {"summary": f"{name} on alert {i}", "description": f"Seeded alert {i} for load testing"},
+                "startsAt": utc_time(now - self.random.uniform(0, 86400)),
+            }
+            self.alerts[self.key(alert)] = alert
+
+    def handle(self, method, path, body):
+        if path.split("?")[0] != "/api/v2/alerts":
+            return 404, "text/plain", b"not found\n"
+        now = time.time()
+        if method == "GET":
+            alerts = [dict(alert, endsAt=alert.get("endsAt", utc_time(now + 300)), status={"state": "active"})
+                      for alert in self.alerts.values()]
+            return 200, "application/json", json.dumps(alerts).encode()
+        if method == "POST":
+            try:
+                alerts = json.loads(body)
+            except ValueError:
+                return 400, "text/plain", b"bad json\n"
+            self.stats["alerts received"] += len(alerts)
+            for alert in alerts:
+                ends = parse_time(alert.get("endsAt", ""))
+                if ends is not None and ends <= now:
+                    self.stats["alerts ended"] += 1
+                    self.alerts.pop(self.key(alert), None)
+                else:
+                    self.alerts[self.key(alert)] = alert
+            return 200, "application/json", b""
+        return 405, "text/plain", b"method not allowed\n"
+
+
+class FakePushgateway(FakeService):
+    # The pushed metrics are kept per group (the path after /metrics/) and metric family.
+
+    def __init__(self, latency=(0, 0), errors=0.0, seed=None):
+        super().__init__(latency, errors, seed)
+        self.groups = {}
+
+    @staticmethod
+    def families(body):
+        # Split the text exposition format in to metric families.  Each family starts with a # HELP line.
+        families = {}
+        name = None
+        for line in body.decode().splitlines(keepends=True):
+            if line.startswith("# HELP "):
+                name = line.split()[2]
+                families[name] = []
+            if name:
+                families[name].append(line)
+        return {name: "".join(lines) for name, lines in families.items()}
+
+    def handle(self, method, path, body):
+        if method == "GET" and path == "/metrics":
+            reply = "".join(text for families in self.groups.values() for text in families.values())
+            return 200, "text/plain; version=0.0.4", reply.encode()
+        if not path.startswith("/metrics/job/"):
+            return 404, "text/plain", b"not found\n"
+        group = path[len("/metrics/"):]
+        if method == "PUT":
+            self.groups[group] = self.families(body)
+        elif method == "POST":
+            self.groups.setdefault(group, {}).update(self.families(body))
+        elif method == "DELETE":
+            self.groups.pop(group, None)
+        else:
+            return 405, "text/plain", b"method not allowed\n"
+        return 200, "text/plain", b""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run stand-ins for the alert manager and push gateway.")
+    parser.add_argument("--alertmanager-port", type=int, default=0, help="Port of the alert manager.  0 picks a free port")
+    parser.add_argument("--pushgateway-port", type=int, default=0, help="Port of the push gateway.  0 picks a free port")
+    parser.add_argument("--alerts", type=int, default=0, help="Number of active alerts the alert manager starts with")
+    parser.add_argument("--latency", type=time_range, default=(0, 0), help="Time range of the replies in seconds (MIN:MAX)")
+    parser.add_argument("--errors", type=float, default=0.0, help="Fraction of the requests answered with a 500 error")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random times, errors and alerts")
+    args = parser.parse_args()
+
+    alertmanager = FakeAlertmanager(args.latency, args.errors, args.seed, args.alerts)
+    pushgateway = FakePushgateway(args.latency, args.errors, args.seed)
+    print(f"READY {alertmanager.start(args.alertmanager_port)} {pushgateway.start(args.pushgateway_port)}", flush=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda sig, frame: stop.set())
+    stop.wait()
+    alertmanager.stop()
+    pushgateway.stop()
+
+
+if __name__ == "__main__":
+    main()
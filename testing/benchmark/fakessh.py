@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------------
+# Copyright (c) 2025 Lancaster University
+# Written by: Gerard Hand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#---------------------------------------------------------------------------------
+# A fleet of fake XRootD servers for testing and benchmarking XRootDRestart without real hosts.
+#
+# Each fake server is a loopback address (127.1.0.1, 127.1.0.2, ...).  One listening socket on a single
+# port accepts the ssh connections for all of them and the server a connection is for is worked out from
+# the address it was made to.  Any user and public key is accepted.  The commands XRootDRestart runs are
+# emulated:
+#   sudo systemctl stop|start|is-active SERVICE...  - The state of the services is kept for each server.
+#   ss ... | wc -l                                   - There are no xrootd clients.
+#   cat /proc/loadavg                                - A fixed load.
+# Each command answers after a random time taken from the range set for it, like the 10 to 30 second
+# shutdown of the services made by testing/xrootd-services/mk_xroot_services.sh.  Stops and starts
+# can be set to fail (the service stays in the state it was in) or to hang (no reply at all).
+#
+# It can be used from python (FakeFleet) or run on its own:
+#   python3 fakessh.py --nodes 100 --stop 10:30 --time-scale 0.1
+# When it is ready it prints "READY <port> <first server> <last server>".  Set ssh_port to the port and
+# servers to the list of addresses to point XRootDRestart at it.
+#
+import argparse
+import heapq
+import ipaddress
+import itertools
+import logging
+import random
+import signal
+import socket
+import threading
+import time
+
+import paramiko
+
+# Default time ranges of the commands in seconds (min, max).
+STOP_TIME   = (10, 30)
+START_TIME  = (1, 5)
+QUERY_TIME  = (0, 0.1)
+SERVICES    = ['cmsd@cluster', 'xrootd@cluster']
+FIRST_ADDRESS = ipaddress.IPv4Address('127.1.0.1')
+LOADAVG     = "0.50 0.40 0.30 1/200 12345"
+
+
+def addresses(count):
+    # The loopback addresses used for count servers.
+    return [str(FIRST_ADDRESS + i) for i in range(count)]
+
+
+def time_range(value):
+    # Parse MIN:MAX (or a single value) in to a (min, max) tuple.
+    parts = [float(part) for part in value.split(':')]
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2 or parts[0] < 0 or parts[1] < parts[0]:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid time range.  Use MIN:MAX")
+    return tuple(parts)
+
+
+class FakeNode:
+    # The services of one fake server.
+
+    def __init__(self, address, services):
+        self.address = address
+        self.state = {service: "active" for service in services}
+        self.commands = 0
+
+
+class FakeServerInterface(paramiko.ServerInterface):
+    # Accepts any user and key and passes exec requests to the fleet.
+
+    def __init__(self, fleet, node):
+        self.fleet = fleet
+        self.node = node
+
+
+    def get_allowed_auths(self, username):
+        return "publickey,password"
+
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+    def check_channel_exec_request(self, channel, command):
+        self.fleet.run_command(self.node, channel, command.decode())
+        return True
+
+
+class FakeFleet:
+    # The fake servers.  The replies to the commands are sent by one responder thread from a heap of
+    # reply times, so a slow command doesn't need a thread of its own.
+
+    def __init__(self, count, port=0, services=SERVICES, stop_time=STOP_TIME, start_time=START_TIME,
+                 query_time=QUERY_TIME, time_scale=1.0, stop_fail=0.0, start_fail=0.0, hang=0.0, seed=None):
+        self.nodes = {address: FakeNode(address, services) for address in addresses(count)}
+        self.port = port
+        self.times = {"stop": stop_time, "start": start_time, "query": query_time}
+        self.time_scale = time_scale
+        self.stop_fail = stop_fail
+        self.start_fail = start_fail
+        self.hang = hang
+        self.random = random.Random(seed)
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.listener = None
+        self.transports = []
+        self.running = False
+        # (reply time, sequence number, function).  The sequence number keeps replies due at the same time in order.
+        self.replies = []
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.connections = 0
+        self.hung = 0
+
+
+    def start(self):
+        # Start listening.  Returns the port the fleet is listening on.
+        # The listener is bound to all addresses as a socket bound to 127.0.0.1 only accepts connections to
+        # that address.  Connections from anywhere other than the loopback network are closed straight away.
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("0.0.0.0", self.port))
+        self.listener.listen(1024)
+        self.port = self.listener.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self.accept_connections, name="fakessh-accept", daemon=True).start()
+        threading.Thread(target=self.send_replies, name="fakessh-reply", daemon=True).start()
+        return self.port
+
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify()
+        try:
+            self.listener.close()
+        except Exception:
+            pass
+        for transport in self.transports:
+            transport.close()
+
+
+    def accept_connections(self):
+        while self.running:
+            try:
+                sock, peer = self.listener.accept()
+            except OSError:
+                break
+            address = sock.getsockname()[0]
+            node = self.nodes.get(address)
+            if node is None or not ipaddress.IPv4Address(peer[0]).is_loopback:
+                sock.close()
+                continue
+            self.connections += 1
+            transport = paramiko.Transport(sock)
+            transport.name = f"fakessh-{address}"
+            transport.add_server_key(self.host_key)
+            # Passing an event makes start_server() return straight away rather than waiting for the
+            # key exchange, so one slow client doesn't hold up the others.
+            transport.start_server(event=threading.Event(), server=FakeServerInterface(self, node))
+            self.transports.append(transport)
+            if self.connections % 100 == 0:
+                # Forget the connections that have been closed.
+                self.transports = [transport for transport in self.transports if transport.is_active()]
+
+
+    def delay(self, kind):
+        low, high = self.times[kind]
+        return self.random.uniform(low, high) * self.time_scale
+
+
+    def run_command(self, node, channel, command):
+        # Work out the reply to a command and when it is sent.  Called by the transport thread of the connection.
+        node.commands += 1
+        words = command.split()
+        stdout = ""
+        stderr = ""
+        change = None
+        if words[:2] == ["sudo", "systemctl"] and len(words) > 3:
+            action, services = words[2], words[3:]
+            if action == "is-active":
+                delay = self.delay("query")
+                stdout = "\n".join(node.state.get(service, "inactive") for service in services)
+            elif action in ("stop", "start"):
+                delay = self.delay(action)
+                if self.random.random() < self.hang:
+                    # Never reply.  XRootDRestart times the command out.
+                    self.hung += 1
+                    return
+                if self.random.random() < (self.stop_fail if action == "stop" else self.start_fail):
+                    if action == "start":
+                        stderr = f"Job for {services[0]} failed because the control process exited with error code."
+                else:
+                    new_state = "inactive" if action == "stop" else "active"
+                    change = (services, new_state)
+            else:
+                delay = self.delay("query")
+                stderr = f"Unknown command verb {action}."
+        elif words[:1] == ["ss"] and command.endswith("wc -l"):
+            delay = self.delay("query")
+            stdout = "0"
+        elif command == "cat /proc/loadavg":
+            delay = self.delay("query")
+            stdout = LOADAVG
+        else:
+            delay = self.delay("query")
+            stderr = f"fakessh: {words[0] if words else ''}: command not found"
+
+        with self.cond:
+            heapq.heappush(self.replies, (time.time() + delay, next(self.sequence),
+                                          lambda: self.reply(node, channel, stdout, stderr, change)))
+            self.cond.notify()
+
+
+    def reply(self, node, channel, stdout, stderr, change):
+        if change:
+            services, new_state = change
+            for service in services:
+                node.state[service] = new_state
+        try:
+            if stdout:
+                channel.sendall((stdout + "\n").encode())
+            if stderr:
+                channel.sendall_stderr((stderr + "\n").encode())
+            channel.send_exit_status(1 if stderr else 0)
+            channel.close()
+        except Exception:
+            # The client has gone away.
+            pass
+
+
+    def send_replies(self):
+        while self.running:
+            with self.cond:
+                while self.running and (not self.replies or self.replies[0][0] > time.time()):
+                    self.cond.wait(self.replies[0][0] - time.time() if self.replies else None)
+                if not self.running:
+                    break
+                due, sequence, reply = heapq.heappop(self.replies)
+            reply()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fleet of fake XRootD servers reached over ssh.")
+    parser.add_argument("--nodes", type=int, default=10, help="Number of fake servers")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on.  0 picks a free port")
+    parser.add_argument("--stop", type=time_range, default=STOP_TIME, help="Time range of systemctl stop in seconds (MIN:MAX)")
+    parser.add_argument("--start", type=time_range, default=START_TIME, help="Time range of systemctl start in seconds (MIN:MAX)")
+    parser.add_argument("--query", type=time_range, default=QUERY_TIME, help="Time range of the other commands in seconds (MIN:MAX)")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="All the command times are multiplied by this")
+    parser.add_argument("--stop-fail", type=float, default=0.0, help="Fraction of stops that leave the service running")
+    parser.add_argument("--start-fail", type=float, default=0.0, help="Fraction of starts that fail")
+    parser.add_argument("--hang", type=float, default=0.0, help="Fraction of stops and starts that never reply")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random times and failures")
+    args = parser.parse_args()
+
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    fleet = FakeFleet(args.nodes, args.port, stop_time=args.stop, start_time=args.start, query_time=args.query,
+                      time_scale=args.time_scale, stop_fail=args.stop_fail, start_fail=args.start_fail,
+                      hang=args.hang, seed=args.seed)
+    port = fleet.start()
+    names = addresses(args.nodes)
+    print(f"READY {port} {names[0]} {names[-1]}", flush=True)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda sig, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda sig, frame: stop.set())
+    stop.wait()
+    fleet.stop()
+    print(f"{fleet.connections} connections, {sum(node.commands for node in fleet.nodes.values())} commands, {fleet.hung} hung", flush=True)
+
+
+if __name__ == "__main__":
+    main()
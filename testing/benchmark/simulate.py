@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+#---------------------------------------------------------------------------------
+# Copyright (c) 2025 Lancaster University
+# Written by: Gerard Hand
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+#---------------------------------------------------------------------------------
+# Runs XRootDRestart against simulated servers on a virtual clock, so days of restarts take seconds.
+#
+# The scheduler, server list, restart sequence, cmsd_wait loop and learned timeouts are XRootDRestart's own.
+# Its time module is replaced by one that reads and advances a virtual clock, and the ssh pool is replaced
+# by simulated connections to simulated servers.  Each command takes a random time from the range set for
+# its server and connections, stops and starts can be set to fail or (for stops and starts) hang until
+# they time out.
+#
+# The restarts run in threads, but only one of them runs at a time.  A thread runs until it sleeps and then
+# the thread that is due to wake up first is run, with the clock moved on to its wake up time.  The runs
+# are repeatable with --seed.  The load probes of LEAST_LOADED take no virtual time.
+#
+# The settings are taken from --config (a copy of a real config file) or the defaults, with the options
+# below on top.  --nodes-file is a JSON object of server name patterns to settings, applied in order, e.g.
+#   {"xrd1*": {"stop": [60, 600], "stop_fail": 0.05}, "xrd17.example.org": {"connect_fail": 1}}
+# --state starts from a copy of a real state file, so the rotation carries on where the fleet is.
+#
+# The timeline (--timeline) has a line for each restart starting and ending and for min_ok breaches.  The
+# summary shows the most servers down (being restarted or failed) at once, late starts, servers that went
+# longer than cmsd_period without a successful restart and min_ok breaches.
+#
+# Example:
+#   python3 testing/benchmark/simulate.py --nodes 500 --cmsd-period 259200 --cmsd-wait 300 --periods 2 --timeline -
+#
+import argparse
+import collections
+import fnmatch
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import xrootdrestart as xr
+from fakessh import addresses, time_range, LOADAVG
+from bench_restarts import percentile
+
+# Settings of a simulated server.  Times are (min, max) seconds.
+NODE_SETTINGS = ["connect", "stop", "start", "query", "clients", "connect_fail", "stop_fail", "start_fail", "hang"]
+
+
+def duration(seconds):
+    # Format a virtual time offset as +Dd HH:MM:SS.
+    seconds = int(seconds)
+    return f"+{seconds // 86400}d {seconds % 86400 // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+
+
+class VirtualClock:
+    # Virtual time shared by the simulated threads.  A thread takes part once it has called join() or been
+    # started by spawn().  Only one of them runs at a time.  sleep() puts the caller on a heap of wake up times
+    # and runs the first thread on the heap, moving the clock on to its wake up time.  Threads that don't
+    # take part (the load probes) don't use any virtual time.
+
+    def __init__(self, start):
+        self.now = start
+        self.start = start
+        # (wake up time, sequence number, event of the thread).  The sequence number runs threads due at
+        # the same time in the order they went to sleep.
+        self.heap = []
+        self.sequence = itertools.count()
+        self.local = threading.local()
+        # Number of spawned threads that haven't finished.
+        self.threads = 0
+
+    def join(self):
+        self.local.event = threading.Event()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        event = getattr(self.local, "event", None)
+        if event is None:
+            return
+        heapq.heappush(self.heap, (self.now + max(seconds, 0), next(self.sequence), event))
+        self.run_next(event)
+
+    def run_next(self, event=None):
+        # Wake the next thread.  If event is given wait until it is woken.
+        due, sequence, next_event = heapq.heappop(self.heap)
+        self.now = max(self.now, due)
+        if next_event is event:
+            return
+        next_event.set()
+        if event is not None:
+            event.wait()
+            event.clear()
+
+    def spawn(self, func, *args):
+        # Start func in a new thread that runs when the current thread next sleeps.
+        event = threading.Event()
+        self.threads += 1
+
+        def run():
+            event.wait()
+            event.clear()
+            self.local.event = event
+            try:
+                func(*args)
+            finally:
+                self.threads -= 1
+                self.run_next()
+
+        heapq.heappush(self.heap, (self.now, next(self.sequence), event))
+        threading.Thread(target=run, name="simulated", daemon=True).start()
+
+
+class VirtualTime:
+    # Stands in for the time module in xrootdrestart.  time() and sleep() use the virtual clock.
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def time(self):
+        return self.clock.time()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class VirtualTimeFilter(logging.Filter):
+    # Give the log records the virtual time.
+
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def filter(self, record):
+        record.created = self.clock.now
+        record.msecs = (self.clock.now % 1) * 1000
+        return True
+
+
+class SimulatedNode:
+    # The services of a simulated server and how long its commands take.
+
+    def __init__(self, name, settings, seed):
+        self.name = name
+        self.settings = settings
+        self.state = collections.defaultdict(lambda: "active")
+        self.random = random.Random(f"{seed}-{name}")
+
+    def time(self, kind):
+        low, high = self.settings[kind]
+        return self.random.uniform(low, high)
+
+    def fails(self, kind):
+        return self.random.random() < self.settings[kind]
+
+
+class SimulatedOutput:
+    def __init__(self, text):
+        self.text = text
+
+    def read(self):
+        return self.text.encode()
+
+
+class SimulatedConnection:
+    # Stands in for a paramiko.SSHClient connected to a simulated server.
+
+    def __init__(self, node, clock):
+        self.node = node
+        self.clock = clock
+
+    def exec_command(self, command, timeout=None):
+        node = self.node
+        words = command.split()
+        stdout = ""
+        stderr = ""
+        new_state = None
+        if words[:2] == ["sudo", "systemctl"] and words[2:3] in (["stop"], ["start"]):
+            action, services = words[2], words[3:]
+            seconds = node.time(action)
+            if node.fails("hang"):
+                seconds = float("inf")
+            elif node.fails(f"{action}_fail"):
+                if action == "start":
+                    stderr = f"Job for {services[0]} failed because the control process exited with error code."
+            else:
+                new_state = "inactive" if action == "stop" else "active"
+        else:
+            seconds = node.time("query")
+            if words[:2] == ["sudo", "systemctl"] and words[2:3] == ["is-active"]:
+                stdout = "\n".join(node.state[service] for service in words[3:])
+            elif words[:1] == ["ss"]:
+                stdout = str(int(node.time("clients")))
+            elif command == "cat /proc/loadavg":
+                stdout = LOADAVG
+            else:
+                stderr = f"{words[0] if words else ''}: command not found"
+
+        if timeout and seconds > timeout:
+            self.clock.sleep(timeout)
+            raise socket.timeout()
+        self.clock.sleep(seconds)
+        if new_state:
+            for service in words[3:]:
+                node.state[service] = new_state
+        return None, SimulatedOutput(stdout), SimulatedOutput(stderr)
+
+
+class SimulatedPool:
+    # Stands in for the SSHPool.  Connecting takes the server's connect time and can fail.
+
+    def __init__(self, nodes, clock):
+        self.nodes = nodes
+        self.clock = clock
+
+    def acquire(self, server):
+        node = self.nodes[server.name]
+        self.clock.sleep(node.time("connect"))
+        if node.fails("connect_fail"):
+            raise paramiko.ssh_exception.NoValidConnectionsError({(server.name, 22): OSError("Connection refused")})
+        return SimulatedConnection(node, self.clock)
+
+    def release(self, name, ssh_client):
+        pass
+
+    def discard(self, name, ssh_client):
+        pass
+
+    def close_all(self):
+        pass
+
+
+class SimulatedEngine(xr.ThreadEngine):
+    # Runs each restart in a simulated thread.
+
+    def __init__(self, server_list, clock):
+        self.server_list = server_list
+        self.clock = clock
+
+    def launch(self, server):
+        self.clock.spawn(self.run_restart, server)
+
+    def wait(self):
+        while self.clock.threads:
+            self.clock.sleep(1)
+
+
+class Recorder:
+    # Watches the simulation and writes the timeline.
+
+    def __init__(self, clock, server_list, timeline):
+        self.clock = clock
+        self.server_list = server_list
+        self.timeline = timeline
+        self.failed = set(server.name for server in server_list.list if server.status(None) == xr.ERR)
+        self.successes = collections.defaultdict(list)
+        self.restart_times = []
+        self.lateness = []
+        self.max_down = (len(self.failed), clock.now)
+        self.max_in_flight = 0
+        self.breaches = 0
+        self.below_min_ok = server_list.num_ok < server_list.min_ok
+        self.stopped = None
+        self.counts = collections.Counter()
+
+        # Hook in to the scheduler, the restarts and the count of servers that are ok.
+        scheduler = server_list.scheduler
+        restart_selected = scheduler.restart_selected
+        def record_selected(server):
+            self.lateness.append(self.clock.now - scheduler.due_time(server))
+            restart_selected(server)
+        scheduler.restart_selected = record_selected
+
+        ajust_servers_ok = server_list.ajust_servers_ok
+        def record_servers_ok(amount):
+            ajust_servers_ok(amount)
+            below = server_list.num_ok < server_list.min_ok
+            if below and not self.below_min_ok:
+                self.breaches += 1
+                self.event("breach", "", f"{server_list.num_ok} servers ok, min_ok is {server_list.min_ok}")
+            self.below_min_ok = below
+        server_list.ajust_servers_ok = record_servers_ok
+
+        restart = xr.Server.restart
+        recorder = self
+        def record_restart(server):
+            recorder.restart_begin(server)
+            last_success = server.last_success
+            try:
+                restart(server)
+            finally:
+                recorder.restart_end(server, server.last_success != last_success)
+        xr.Server.restart = record_restart
+
+    def down(self):
+        in_flight = set(server.name for server in self.server_list.in_flight)
+        return len(in_flight | self.failed), len(in_flight)
+
+    def event(self, kind, node, detail=""):
+        down, in_flight = self.down()
+        if self.timeline:
+            self.timeline.write(f"{duration(self.clock.now - self.clock.start)}  {kind:<7} {node:<24} down {down:<4} {detail}\n")
+
+    def restart_begin(self, server):
+        server.sim_start = self.clock.now
+        self.counts["started"] += 1
+        down, in_flight = self.down()
+        self.max_in_flight = max(self.max_in_flight, in_flight)
+        if down > self.max_down[0]:
+            self.max_down = (down, self.clock.now)
+        self.event("start", server.name)
+
+    def restart_end(self, server, success):
+        self.restart_times.append(self.clock.now - server.sim_start)
+        if success:
+            self.counts["succeeded"] += 1
+            self.successes[server.name].append(server.sim_start)
+            self.failed.discard(server.name)
+            self.event("ok", server.name, f"took {self.clock.now - server.sim_start:.0f}s")
+        else:
+            self.counts["failed"] += 1
+            self.failed.add(server.name)
+            self.event("failed", server.name, server.last_error or "")
+
+    def overdue(self, end, cmsd_period):
+        # Servers that went longer than cmsd_period between the starts of successful restarts, and how long
+        # over it they went.  A server that was restarted successfully before the simulation started counts
+        # from that restart.
+        overdue = {}
+        for server in self.server_list.list:
+            times = [server.sim_last_success if server.sim_last_success is not None else self.clock.start]
+            times += self.successes[server.name] + [end]
+            gap = max(b - a for a, b in zip(times, times[1:]))
+            if gap > cmsd_period:
+                overdue[server.name] = gap - cmsd_period
+        return overdue
+
+
+def make_config(args, key_file):
+    config = xr.Config(fail_no_key=False)
+    if args.config:
+        config.config_file = args.config
+        config.load_config()
+    if args.nodes is not None:
+        config.servers = addresses(args.nodes)
+        config.groups = {}
+    for option in ["cmsd_period", "cmsd_wait", "max_concurrent", "min_ok", "service_timeout", "selection", "drain_poll", "drain_threshold"]:
+        value = getattr(args, option)
+        if value is not None:
+            setattr(config, option, value)
+    if config.restart_mode != xr.COMMANDS:
+        print("The simulation only runs the restarts with commands.  Using restart_mode COMMANDS", file=sys.stderr)
+        config.restart_mode = xr.COMMANDS
+    if config.engine != xr.THREAD:
+        print("The simulation runs the restarts in threads.  Using engine THREAD", file=sys.stderr)
+        config.engine = xr.THREAD
+    if config.load_probe == xr.PROMETHEUS:
+        print("The simulation can't query prometheus.  Using load_probe CONNECTIONS", file=sys.stderr)
+        config.load_probe = xr.CONNECTIONS
+    config.priv_file = key_file
+    config.probe_interval = 0
+    config.alert_url = ""
+    config.metrics_method = xr.PULL
+    config.metrics_port = 0
+    config.set_extra_values()
+    return config
+
+
+def make_nodes(args, config):
+    # The settings of each simulated server: the defaults from the options with the matching entries of
+    # --nodes-file on top.
+    defaults = {name: getattr(args, name) for name in NODE_SETTINGS}
+    overrides = {}
+    if args.nodes_file:
+        with open(args.nodes_file) as f:
+            overrides = json.load(f)
+    nodes = {}
+    for name in config.servers:
+        settings = dict(defaults)
+        for pattern, values in overrides.items():
+            if fnmatch.fnmatch(name, pattern):
+                for key, value in values.items():
+                    if key not in NODE_SETTINGS:
+                        raise Exception(f"{key} in {args.nodes_file} isn't a server setting.  Use one of {NODE_SETTINGS}")
+                    settings[key] = tuple(value) if isinstance(value, list) else value
+        nodes[name] = SimulatedNode(name, settings, args.seed)
+    return nodes
+
+
+def simulate(args):
+    clock = VirtualClock(time.time())
+    clock.join()
+
+    xr.logger = logging.getLogger("xrootdrestart")
+    if args.log:
+        handler = logging.FileHandler(args.log)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handler.addFilter(VirtualTimeFilter(clock))
+        xr.logger.addHandler(handler)
+        xr.logger.setLevel(logging.DEBUG)
+    else:
+        xr.logger.addHandler(logging.NullHandler())
+        xr.logger.setLevel(logging.ERROR)
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as key_dir:
+        key_file = os.path.join(key_dir, "id_ecdsa")
+        paramiko.ECDSAKey.generate().write_private_key_file(key_file)
+        config = make_config(args, key_file)
+
+        xr.alerter = xr.Alerter(config)
+        xr.state_store = xr.StateStore(":memory:")
+        if args.state:
+            # Work on a copy so the real state file isn't changed.
+            source = sqlite3.connect(args.state)
+            source.backup(xr.state_store.db)
+            source.close()
+        nodes = make_nodes(args, config)
+        xr.ssh_pool = SimulatedPool(nodes, clock)
+        xr.time = VirtualTime(clock)
+        xr.server_list = server_list = xr.ServerList(config)
+
+    if server_list.engine:
+        server_list.engine.executor.shutdown()
+    if config.max_concurrent > 1:
+        server_list.engine = SimulatedEngine(server_list, clock)
+    for server in server_list.list:
+        server.sim_last_success = server.last_success
+
+    timeline = None
+    if args.timeline == "-":
+        timeline = sys.stdout
+    elif args.timeline:
+        timeline = open(args.timeline, "w")
+    recorder = Recorder(clock, server_list, timeline)
+
+    # The main loop of xrootdrestart.
+    wall_start = time.time()
+    end = clock.now + args.periods * config.cmsd_period
+    scheduler = server_list.scheduler
+    try:
+        while clock.now < end:
+            server_list.alive()
+            wait = scheduler.time_to_next()
+            if wait <= 0:
+                scheduler.tick()
+            else:
+                clock.sleep(min(wait, 1, end - clock.now))
+    except Exception as e:
+        recorder.stopped = clock.now
+        recorder.event("stop", "", str(e))
+    server_list.wait_for_restarts()
+    sim_end = clock.now
+    wall_time = time.time() - wall_start
+    if timeline and timeline is not sys.stdout:
+        timeline.close()
+
+    overdue = recorder.overdue(sim_end, config.cmsd_period)
+    restart_times = sorted(recorder.restart_times)
+    interval = server_list.restart_interval()
+    late = [seconds for seconds in recorder.lateness if seconds > interval]
+    summary = {
+        "servers": len(server_list),
+        "cmsd_period": config.cmsd_period,
+        "max_concurrent": config.max_concurrent,
+        "min_ok": config.min_ok,
+        "simulated_seconds": sim_end - clock.start,
+        "wall_seconds": wall_time,
+        "restarts_started": recorder.counts["started"],
+        "restarts_succeeded": recorder.counts["succeeded"],
+        "restarts_failed": recorder.counts["failed"],
+        "restart_p50": percentile(restart_times, 0.5),
+        "restart_p99": percentile(restart_times, 0.99),
+        "max_down": recorder.max_down[0],
+        "max_down_at": recorder.max_down[1] - clock.start,
+        "max_in_flight": recorder.max_in_flight,
+        "late_starts": len(late),
+        "max_late": max(recorder.lateness, default=0),
+        "overdue_servers": len(overdue),
+        "max_overdue": max(overdue.values(), default=0),
+        "min_ok_breaches": recorder.breaches,
+        "stopped_at": recorder.stopped - clock.start if recorder.stopped is not None else None,
+    }
+    return summary
+
+
+def report(summary):
+    print(f"Servers:               {summary['servers']} (cmsd_period {summary['cmsd_period']}s, max_concurrent {summary['max_concurrent']}, min_ok {summary['min_ok']})")
+    print(f"Simulated:             {duration(summary['simulated_seconds'])} in {summary['wall_seconds']:.1f}s")
+    print(f"Restarts:              {summary['restarts_started']} started, {summary['restarts_succeeded']} succeeded, {summary['restarts_failed']} failed")
+    if summary["restart_p50"] is not None:
+        print(f"Restart time:          p50 {summary['restart_p50']:.0f}s, p99 {summary['restart_p99']:.0f}s")
+    print(f"Most servers down:     {summary['max_down']} at {duration(summary['max_down_at'])} ({summary['max_in_flight']} being restarted at once at most)")
+    print(f"Late starts:           {summary['late_starts']} more than restart_interval late, the latest {summary['max_late']:.0f}s late")
+    print(f"Overdue servers:       {summary['overdue_servers']} went longer than cmsd_period without a successful restart, by up to {summary['max_overdue']:.0f}s")
+    print(f"min_ok breaches:       {summary['min_ok_breaches']}")
+    if summary["stopped_at"] is not None:
+        print(f"Stopped restarting at: {duration(summary['stopped_at'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate XRootDRestart restarting a fleet of servers on a virtual clock.")
+    parser.add_argument("--config", default=None, help="Config file to take the settings from.  It isn't changed")
+    parser.add_argument("--state", default=None, help="State file to start from.  A copy is used so it isn't changed")
+    parser.add_argument("--nodes", type=int, default=None, help="Number of servers.  Replaces the servers of --config")
+    parser.add_argument("--cmsd-period", type=int, default=None, help="cmsd_period setting")
+    parser.add_argument("--cmsd-wait", type=int, default=None, help="cmsd_wait setting")
+    parser.add_argument("--max-concurrent", type=int, default=None, help="max_concurrent setting")
+    parser.add_argument("--min-ok", type=int, default=None, help="min_ok setting")
+    parser.add_argument("--service-timeout", type=int, default=None, help="service_timeout setting")
+    parser.add_argument("--selection", type=str.upper, default=None, choices=[xr.ROUND_ROBIN, xr.LEAST_LOADED], help="selection setting")
+    parser.add_argument("--drain-poll", type=int, default=None, help="drain_poll setting")
+    parser.add_argument("--drain-threshold", type=int, default=None, help="drain_threshold setting")
+    parser.add_argument("--periods", type=float, default=1, help="Number of cmsd_periods to simulate")
+    parser.add_argument("--connect", type=time_range, default=(0.1, 0.5), help="Time range of opening a connection in seconds (MIN:MAX)")
+    parser.add_argument("--stop", type=time_range, default=(10, 30), help="Time range of systemctl stop in seconds (MIN:MAX)")
+    parser.add_argument("--start", type=time_range, default=(1, 5), help="Time range of systemctl start in seconds (MIN:MAX)")
+    parser.add_argument("--query", type=time_range, default=(0, 0.1), help="Time range of the other commands in seconds (MIN:MAX)")
+    parser.add_argument("--clients", type=time_range, default=(0, 0), help="Range of the number of xrootd clients (MIN:MAX)")
+    parser.add_argument("--connect-fail", type=float, default=0.0, help="Fraction of connections that fail")
+    parser.add_argument("--stop-fail", type=float, default=0.0, help="Fraction of stops that leave the service running")
+    parser.add_argument("--start-fail", type=float, default=0.0, help="Fraction of starts that fail")
+    parser.add_argument("--hang", type=float, default=0.0, help="Fraction of stops and starts that never finish")
+    parser.add_argument("--nodes-file", default=None, help="JSON file of server name patterns to their own settings")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random times and failures")
+    parser.add_argument("--timeline", default=None, help="Write the timeline to this file.  - writes it to stdout")
+    parser.add_argument("--log", default=None, help="Write the XRootDRestart log, with virtual times, to this file")
+    parser.add_argument("--json", default=None, help="Also write the summary to this file as JSON")
+    args = parser.parse_args()
+    if args.config is None and args.nodes is None:
+        args.nodes = 100
+
+    summary = simulate(args)
+    report(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
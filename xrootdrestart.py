@@ -34,18 +34,33 @@
 #  
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization
+import asyncio
+import atexit
+import collections
+import concurrent.futures
 import configparser
+import contextvars
+import copy
 from datetime import datetime, timedelta
+import functools
+import gzip
+import heapq
 import json
 import logging
+import logging.handlers
+import math
 import os
 import paramiko
 from pathlib import Path
-from prometheus_client import start_http_server, Gauge, Histogram, CollectorRegistry, push_to_gateway
+from prometheus_client import start_http_server, Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, push_to_gateway, pushadd_to_gateway
+from prometheus_client.core import GaugeMetricFamily
+import queue
 import requests
-import schedule
+import shlex
+import shutil
 import signal
 import socket
+import sqlite3
 import subprocess
 import sys
 import time
@@ -57,6 +72,11 @@ import traceback
 logger = None
 alerter = None
 heartbeat = None
+server_list = None
+ssh_pool = None
+state_store = None
+# The server being restarted by the current thread or task.  Added to the log records.
+log_context = contextvars.ContextVar("log_context", default=None)
 
 #-----------------------------------------------------------------------------------------------------
 # Constants
@@ -65,15 +85,135 @@ OK = 'OK'
 ERR = 'ERR'
 PULL = 'PULL'
 PUSH = 'PUSH'
+THREAD = 'THREAD'
+ASYNC = 'ASYNC'
+COMMANDS = 'COMMANDS'
+SCRIPT = 'SCRIPT'
+ROUND_ROBIN = 'ROUND_ROBIN'
+LEAST_LOADED = 'LEAST_LOADED'
+TEXT = 'TEXT'
+JSON = 'JSON'
+CONNECTIONS = 'CONNECTIONS'
+LOADAVG = 'LOADAVG'
+PROMETHEUS = 'PROMETHEUS'
 LOG_FILE = '/var/log/xrootdrestart.log'
 #LOG_FILE = 'xrootdrestart.log'
 HEARTBEAT_INTERVAL = 5
+# The main loop is reported as stuck if it hasn't made progress for ALIVE_LIMIT seconds, or for longer than a
+# restart step it is running should take.
+ALIVE_LIMIT = 30
+# Longest time between checks for ssh connections that have been idle for longer than ssh_idle_timeout.
+SSH_REAP_INTERVAL = 60
+# Seconds a health check waits to connect to each port of a server.  A port that is up answers at once, so
+# this is much shorter than service_timeout.
+HEALTH_CONNECT_TIMEOUT = 5
 
 # Prometheus and Alertmanager
 ALERT_XROOTDRESTART_CONNECT_ERROR = 'XROOTDRESTART_CONNECT_ERROR'
 ALERT_XROOTDRESTART_RESTART_ERROR = 'XROOTDRESTART_RESTART_ERROR'
 ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS = 'XROOTDRESTART_INSUFFICIENT_SERVERS'
 ALERT_TYPE_LIST=[ALERT_XROOTDRESTART_CONNECT_ERROR,ALERT_XROOTDRESTART_RESTART_ERROR,ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS]
+# Seconds before the cached copy of the active alerts is read again from the alert manager.
+ALERT_CACHE_TTL = 300
+# Most alerts sent in one request, the number of times a failed request is tried and the wait before the
+# first retry (doubled for each retry).
+ALERT_BATCH_SIZE = 100
+ALERT_RETRIES = 5
+ALERT_RETRY_WAIT = 1
+# An http endpoint (alert manager, push gateway, prometheus) isn't used for HTTP_OPEN_TIME seconds after
+# HTTP_FAILURES requests to it in a row have failed.
+HTTP_FAILURES = 5
+HTTP_OPEN_TIME = 30
+# In PUSH mode all the metrics are pushed when something changes and at least every FULL_PUSH_INTERVAL
+# seconds.  A failed push is tried again after PUSH_RETRY_WAIT seconds, doubling up to PUSH_MAX_RETRY_WAIT.
+FULL_PUSH_INTERVAL = 60
+PUSH_RETRY_WAIT = 1
+PUSH_MAX_RETRY_WAIT = 60
+
+# Script run on a server when restart_mode is SCRIPT.  It does the whole restart over one ssh channel and
+# writes a progress line for each phase: "XRDR <phase> begin", "XRDR <phase> ok", "XRDR <phase> fail <message>".
+# While waiting after stopping cmsd it also writes "XRDR cmsd_wait clients <n>" each time it counts the
+# xrootd client connections.  The controller closes the script's stdin to ask it to stop.  The script checks for this before each
+# phase and during the cmsd wait, writes "XRDR abort" and exits, leaving the controller to restart any
+# services that are stopped.  Running the script again from any state stops and then starts both services.
+# Arguments: <cmsd service> <xrootd service> <cmsd wait seconds> <drain poll seconds> <drain threshold> <xrootd port>
+RESTART_SCRIPT = r'''
+CMSD="$1"
+XROOTD="$2"
+WAIT="$3"
+POLL="$4"
+THRESHOLD="$5"
+PORT="$6"
+
+report() {
+    echo "XRDR $*"
+}
+
+fail() {
+    report "$1" fail "${@:2}"
+    exit 1
+}
+
+check_abort() {
+    # read -t 0 succeeds if stdin has been closed.
+    if read -t 0; then
+        report abort
+        exit 3
+    fi
+}
+
+stop_service() {
+    check_abort
+    report "$2" begin
+    err=$(sudo systemctl stop "$1" 2>&1 >/dev/null)
+    [ -n "$err" ] && fail "$2" "Error stopping $1: $err"
+    [ "$(sudo systemctl is-active "$1" 2>/dev/null)" = "active" ] && fail "$2" "$1 failed to stop"
+    report "$2" ok
+}
+
+count_clients() {
+    # Number of established connections to the xrootd port.
+    local out
+    out=$(ss -tn state established "( sport = :$PORT )" 2>/dev/null) || return 1
+    echo "$out" | tail -n +2 | wc -l
+}
+
+start_service() {
+    check_abort
+    report "$2" begin
+    [ "$(sudo systemctl is-active "$1" 2>/dev/null)" = "active" ] && fail "$2" "$1 already active before starting."
+    err=$(sudo systemctl start "$1" 2>&1 >/dev/null)
+    [ -n "$err" ] && fail "$2" "Error starting $1: $err"
+    [ "$(sudo systemctl is-active "$1" 2>/dev/null)" = "inactive" ] && fail "$2" "$1 failed to start"
+    report "$2" ok
+}
+
+stop_service "$CMSD" cmsd_stop
+
+check_abort
+report cmsd_wait begin
+END=$((SECONDS + WAIT))
+while [ $SECONDS -lt $END ]; do
+    STEP=$((END - SECONDS))
+    if [ "$POLL" -gt 0 ] && CLIENTS=$(count_clients); then
+        report cmsd_wait clients $CLIENTS
+        [ "$CLIENTS" -le "$THRESHOLD" ] && break
+        [ "$POLL" -lt "$STEP" ] && STEP=$POLL
+    fi
+    # Returns straight away if stdin is closed, otherwise times out after STEP seconds.
+    read -t "$STEP" _
+    if [ $? -le 128 ]; then
+        report abort
+        exit 3
+    fi
+done
+report cmsd_wait ok
+
+stop_service "$XROOTD" xrootd_stop
+start_service "$XROOTD" xrootd_start
+start_service "$CMSD" cmsd_start
+report done
+'''
 
 #-----------------------------------------------------------------------------------------------------
 # Default Config Options Values
@@ -89,7 +229,18 @@ PKEY_NAME        = 'xrootdrestartkey'
 PKEY_PATH        = config_path
 CONFIG_DIR       = config_path
 CONFIG_FILE_NAME = 'xrootdrestart.conf'
+STATE_FILE_NAME  = 'xrootdrestart.db'
 LOG_LEVEL        = 'INFO'
+LOG_FORMAT       = TEXT
+LOG_MAX_BYTES    = 104857600        # 100 MB
+LOG_ROTATE_INTERVAL = 86400         # 1 day
+LOG_BACKUPS      = 7
+# Repeats of a log message in the LOG_DEDUP_WINDOW seconds after it is logged are counted rather than logged.
+# Up to LOG_DEDUP_SIZE recent messages are tracked and the summaries of the repeats are output every
+# LOG_DEDUP_FLUSH seconds.
+LOG_DEDUP_WINDOW = 60
+LOG_DEDUP_SIZE   = 256
+LOG_DEDUP_FLUSH  = 5
 SVR_LIST         = ''
 XROOTD_SVC       = 'xrootd@cluster'
 CMSD_SVC         = 'cmsd@cluster'
@@ -98,7 +249,29 @@ ALERTMANAGER_URL = 'http://localhost:9093'
 METRICS_PORT     = 8000
 PUSHGW_URL       = 'http://localhost:9091'
 SERVICE_TIMEOUT  = 120
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_TIMEOUT     = 10
+TIMEOUT_FACTOR   = 3
 METRICS_METHOD   = PULL
+MAX_CONCURRENT   = 1
+GROUP_MAX_CONCURRENT = 1
+GROUP_MIN_OK     = 0
+ENGINE           = THREAD
+SSH_WORKERS      = 16
+SSH_KEEPALIVE    = 30
+SSH_IDLE_TIMEOUT = 600
+SSH_POOL_SIZE    = 64
+RESTART_MODE     = COMMANDS
+DRAIN_POLL       = 0
+DRAIN_THRESHOLD  = 0
+XROOTD_PORT      = 1094
+CMSD_PORT        = 0
+PROBE_INTERVAL   = 300
+SSH_PORT         = 22
+SELECTION        = ROUND_ROBIN
+SELECTION_WINDOW = 5
+LOAD_PROBE       = CONNECTIONS
+PROM_LOAD_QUERY  = 'node_load1{instance=~"{node}(:[0-9]+)?"}'
 
 #--------------------------------------- Config Class -------------------------------------------------------
 # Holds the current settings used in the program.
@@ -108,21 +281,57 @@ METRICS_METHOD   = PULL
 # alrt_url        - Alert-manager URL + port.
 # cluster_id      - Value to use in the metrics cluster label.
 # cmsd_period     - Time in seconds between restarting the services on a server.
+# cmsd_port       - Port cmsd listens on.  Checked by the health probe.  0 doesn't check it.
 # cmsd_svc        - CMSD service name.
 # cmsd_wait       - Time in seconds to wait after stopping cmsd before stopping xrootd.
+# http_connect_timeout - Seconds to wait to connect to the alert manager, push gateway or prometheus.
+# http_timeout    - Seconds to wait for a reply from the alert manager, push gateway or prometheus.
+# load_probe      - How LEAST_LOADED measures a server's load: CONNECTIONS, LOADAVG, PROMETHEUS.
+# drain_poll      - Seconds between checks of the xrootd client connections during cmsd_wait.  0 always waits cmsd_wait.
+# drain_threshold - cmsd_wait ends early when the number of xrootd client connections drops to this number or below.
+# engine          - How the restarts are run: THREAD, ASYNC.  ASYNC runs the restarts on an asyncio event loop.
+# log_backups     - Number of old log files kept.
+# log_format      - Format of the log file: TEXT, JSON.  JSON writes one JSON object per line with the node, phase
+#                   and restart id of the restart the line is about.
 # log_level       - Logging output level: DEBUG, INFO, WARNING, ERROR, CRITICAL.
+# log_max_bytes   - A new log file is started when the log file reaches this size.  0 turns this off.
+# log_rotate_interval - A new log file is started every this number of seconds.  0 turns this off.
+# max_concurrent  - Maximum number of servers restarted at the same time.  1 restarts the servers one at a time.
 # metrics_port    - Listening port to provide prometheus metrics.
 # metrics_method  - Method of transfering metrics: PUSH, PULL.
 # min_ok          - If the number of servers that are ok drops below this number the program will stop restarting services.
 # pkey_name       - File name of the private key file.  (not including path). Set blank to not use a pkey.
 # pkey_path       - Directory containing pkey_name file.
+# probe_interval  - Seconds between health checks of all the servers.  0 turns the health checks off.
+# prom_load_query - Prometheus query used by the PROMETHEUS load probe.  {node} is replaced by the server name.
 # prom_url        - Prometheus URL + port.
 # pushgw_url      - URL + port of the gateway for pushing prometheus metrics.
+# restart_mode    - How the services are restarted: COMMANDS, SCRIPT.  SCRIPT runs the whole restart with one remote script.
+# selection       - How the next server to restart is picked: ROUND_ROBIN, LEAST_LOADED.
+# selection_window- Number of the most overdue servers LEAST_LOADED chooses between.
 # servers         - A comma separated list of server host names.
-# service_timeout - Seconds to wait for a service to stop or start.
+# service_timeout - Seconds to wait for a service to stop or start.  Used until enough restarts of a server have been
+#                   timed to learn its own timeouts.
+# timeout_factor  - A server's learned timeout for a phase is this times the 95th percentile of its recent times for the
+#                   phase.  0 always uses service_timeout.
+# state_file      - SQLite database holding the state of the servers (restart times, errors and restart history) so it
+#                   survives a program restart.
+# ssh_idle_timeout- Seconds an unused ssh connection is kept open for reuse.  0 closes connections after use.
+# ssh_keepalive   - Seconds between keepalive packets sent on open ssh connections.  0 disables keepalives.
+# ssh_pool_size   - Most unused ssh connections kept open for reuse.  The least recently used are closed first.  0 closes
+#                   connections after use.
+# ssh_port        - Port the ssh connections are made to.  Also checked by the health probe.
 # ssh_user        - User used by the ssh connection.
+# ssh_workers     - Number of threads used for blocking ssh calls by the ASYNC engine and by the health probe.
+# xrootd_port     - Port xrootd listens on for client connections.  Used to count the clients during cmsd_wait.
 # xrootd_svc      - XRootD service name.
 #
+# Servers can also be listed in [group:NAME] sections, one for each failure domain (rack, switch, replica group).
+# Servers in groups are added to the servers list.  Each group section has the options:
+# servers         - A comma separated list of the server host names in the group.
+# max_concurrent  - Maximum number of servers in the group restarted at the same time.
+# min_ok          - Servers in the group aren't restarted if it would leave fewer than this number ok in the group.
+#
 # Options automatically set but not saved to the settings file
 # hostname        - Hostname of the computer running this program.
 #
@@ -142,6 +351,8 @@ class Config:
         self.cmsd_wait = CMSD_WAIT
         # List of servers with xrootd
         self.servers = []
+        # Groups of servers. Group name -> {"servers": [...], "max_concurrent": n, "min_ok": n}
+        self.groups = {}
         # Path to and name of private key for ssh connection
         self.pkey_name = PKEY_NAME
         self.pkey_path = self.config_dir
@@ -149,16 +360,41 @@ class Config:
         # Metrics cluster label value
         self.cluster_id = CLUSTER_ID
         self.ssh_user = SSH_USER
+        self.ssh_port = SSH_PORT
         self.min_ok = MIN_OK
         self.xrootd_svc = XROOTD_SVC
         self.cmsd_svc = CMSD_SVC
         self.log_level = LOG_LEVEL
         self.prom_url = PROMETHEUS_URL
+        self.log_format = LOG_FORMAT
+        self.log_max_bytes = LOG_MAX_BYTES
+        self.log_rotate_interval = LOG_ROTATE_INTERVAL
+        self.log_backups = LOG_BACKUPS
         self.alert_url = ALERTMANAGER_URL
         self.pushgw_url = PUSHGW_URL
         self.metrics_port = METRICS_PORT
         self.metrics_method = METRICS_METHOD
         self.service_timeout = SERVICE_TIMEOUT
+        self.http_connect_timeout = HTTP_CONNECT_TIMEOUT
+        self.http_timeout = HTTP_TIMEOUT
+        self.timeout_factor = TIMEOUT_FACTOR
+        self.max_concurrent = MAX_CONCURRENT
+        self.engine = ENGINE
+        self.ssh_workers = SSH_WORKERS
+        self.ssh_keepalive = SSH_KEEPALIVE
+        self.ssh_idle_timeout = SSH_IDLE_TIMEOUT
+        self.ssh_pool_size = SSH_POOL_SIZE
+        self.restart_mode = RESTART_MODE
+        self.drain_poll = DRAIN_POLL
+        self.drain_threshold = DRAIN_THRESHOLD
+        self.xrootd_port = XROOTD_PORT
+        self.cmsd_port = CMSD_PORT
+        self.probe_interval = PROBE_INTERVAL
+        self.selection = SELECTION
+        self.selection_window = SELECTION_WINDOW
+        self.load_probe = LOAD_PROBE
+        self.prom_load_query = PROM_LOAD_QUERY
+        self.state_file = os.path.join(self.config_dir, STATE_FILE_NAME)
 
 
     def load_config(self):
@@ -181,6 +417,22 @@ class Config:
         self.log_level = general.get('log_level',fallback=LOG_LEVEL)
         if self.log_level not in logging._nameToLevel:
             self.log_level = LOG_LEVEL
+        self.log_format = general.get('log_format',fallback=LOG_FORMAT).upper()
+        if self.log_format not in [TEXT,JSON]:
+            logger.error(f"{self.log_format} is not a valid log format.  Changing to {LOG_FORMAT}")
+            self.log_format = LOG_FORMAT
+        self.log_max_bytes = int(general.get('log_max_bytes',fallback=LOG_MAX_BYTES))
+        if self.log_max_bytes < 0:
+            logger.error(f"{self.log_max_bytes} is not a valid log_max_bytes value.  Changing to {LOG_MAX_BYTES}")
+            self.log_max_bytes = LOG_MAX_BYTES
+        self.log_rotate_interval = int(general.get('log_rotate_interval',fallback=LOG_ROTATE_INTERVAL))
+        if self.log_rotate_interval < 0:
+            logger.error(f"{self.log_rotate_interval} is not a valid log_rotate_interval value.  Changing to {LOG_ROTATE_INTERVAL}")
+            self.log_rotate_interval = LOG_ROTATE_INTERVAL
+        self.log_backups = int(general.get('log_backups',fallback=LOG_BACKUPS))
+        if self.log_backups < 1:
+            logger.error(f"{self.log_backups} is not a valid log_backups value.  Changing to {LOG_BACKUPS}")
+            self.log_backups = LOG_BACKUPS
 
         self.cluster_id = general.get('cluster_id', fallback=CLUSTER_ID)
         self.cmsd_period = int(general.get( 'cmsd_period', fallback=CMSD_PERIOD))
@@ -188,6 +440,10 @@ class Config:
         self.pkey_name = general.get('pkey_name', fallback=PKEY_NAME)
         self.pkey_path = os.path.expanduser(general.get('pkey_path', fallback=PKEY_PATH))
         self.ssh_user = general.get('ssh_user', fallback=SSH_USER)
+        self.ssh_port = int(general.get('ssh_port', fallback=SSH_PORT))
+        if not 0 < self.ssh_port < 65536:
+            logger.error(f"{self.ssh_port} is not a valid ssh_port.  Changing to {SSH_PORT}")
+            self.ssh_port = SSH_PORT
         self.min_ok = int(general.get('min_ok', fallback=MIN_OK))
         self.xrootd_svc = general.get('xrootd_svc', fallback=XROOTD_SVC)
         self.cmsd_svc = general.get('cmsd_svc', fallback=CMSD_SVC)
@@ -199,9 +455,63 @@ class Config:
         self.metrics_port = int(general.get('metrics_port',fallback=METRICS_PORT))
         self.metrics_method = general.get('metrics_method',fallback=METRICS_METHOD).upper()
         self.service_timeout = int(general.get('service_timeout', fallback=SERVICE_TIMEOUT))
+        self.http_connect_timeout = float(general.get('http_connect_timeout', fallback=HTTP_CONNECT_TIMEOUT))
+        self.http_timeout = float(general.get('http_timeout', fallback=HTTP_TIMEOUT))
+        if self.http_connect_timeout <= 0:
+            logger.error(f"{self.http_connect_timeout} is not a valid http_connect_timeout.  Changing to {HTTP_CONNECT_TIMEOUT}")
+            self.http_connect_timeout = HTTP_CONNECT_TIMEOUT
+        if self.http_timeout <= 0:
+            logger.error(f"{self.http_timeout} is not a valid http_timeout.  Changing to {HTTP_TIMEOUT}")
+            self.http_timeout = HTTP_TIMEOUT
+        self.timeout_factor = float(general.get('timeout_factor', fallback=TIMEOUT_FACTOR))
+        if self.timeout_factor < 0:
+            logger.error(f"{self.timeout_factor} is not a valid timeout_factor.  Changing to {TIMEOUT_FACTOR}")
+            self.timeout_factor = TIMEOUT_FACTOR
         if self.metrics_method not in [PUSH,PULL]:
             logger.error(f"{self.metrics_method} is not a valid metrics method.  Changing to PULL")
             self.metrics_method = PULL
+        self.max_concurrent = int(general.get('max_concurrent', fallback=MAX_CONCURRENT))
+        if self.max_concurrent < 1:
+            logger.error(f"{self.max_concurrent} is not a valid max_concurrent value.  Changing to {MAX_CONCURRENT}")
+            self.max_concurrent = MAX_CONCURRENT
+        self.engine = general.get('engine', fallback=ENGINE).upper()
+        if self.engine not in [THREAD,ASYNC]:
+            logger.error(f"{self.engine} is not a valid engine.  Changing to {ENGINE}")
+            self.engine = ENGINE
+        self.ssh_workers = int(general.get('ssh_workers', fallback=SSH_WORKERS))
+        if self.ssh_workers < 1:
+            logger.error(f"{self.ssh_workers} is not a valid ssh_workers value.  Changing to {SSH_WORKERS}")
+            self.ssh_workers = SSH_WORKERS
+        self.ssh_keepalive = int(general.get('ssh_keepalive', fallback=SSH_KEEPALIVE))
+        self.ssh_idle_timeout = int(general.get('ssh_idle_timeout', fallback=SSH_IDLE_TIMEOUT))
+        self.ssh_pool_size = int(general.get('ssh_pool_size', fallback=SSH_POOL_SIZE))
+        if self.ssh_pool_size < 0:
+            logger.error(f"{self.ssh_pool_size} is not a valid ssh_pool_size value.  Changing to {SSH_POOL_SIZE}")
+            self.ssh_pool_size = SSH_POOL_SIZE
+        self.restart_mode = general.get('restart_mode', fallback=RESTART_MODE).upper()
+        if self.restart_mode not in [COMMANDS,SCRIPT]:
+            logger.error(f"{self.restart_mode} is not a valid restart mode.  Changing to {RESTART_MODE}")
+            self.restart_mode = RESTART_MODE
+        self.drain_poll = int(general.get('drain_poll', fallback=DRAIN_POLL))
+        self.drain_threshold = int(general.get('drain_threshold', fallback=DRAIN_THRESHOLD))
+        self.xrootd_port = int(general.get('xrootd_port', fallback=XROOTD_PORT))
+        self.cmsd_port = int(general.get('cmsd_port', fallback=CMSD_PORT))
+        self.probe_interval = int(general.get('probe_interval', fallback=PROBE_INTERVAL))
+        self.selection = general.get('selection', fallback=SELECTION).upper()
+        if self.selection not in [ROUND_ROBIN,LEAST_LOADED]:
+            logger.error(f"{self.selection} is not a valid selection.  Changing to {SELECTION}")
+            self.selection = SELECTION
+        self.selection_window = int(general.get('selection_window', fallback=SELECTION_WINDOW))
+        if self.selection_window < 1:
+            logger.error(f"{self.selection_window} is not a valid selection_window.  Changing to {SELECTION_WINDOW}")
+            self.selection_window = SELECTION_WINDOW
+        self.load_probe = general.get('load_probe', fallback=LOAD_PROBE).upper()
+        if self.load_probe not in [CONNECTIONS,LOADAVG,PROMETHEUS]:
+            logger.error(f"{self.load_probe} is not a valid load_probe.  Changing to {LOAD_PROBE}")
+            self.load_probe = LOAD_PROBE
+        self.prom_load_query = general.get('prom_load_query', raw=True, fallback=PROM_LOAD_QUERY)
+        self.state_file = os.path.expanduser(general.get('state_file', fallback=os.path.join(self.config_dir, STATE_FILE_NAME)))
+        self.load_groups()
 
         # Set object fields that aren't read from the config file.
         self.set_extra_values()
@@ -214,6 +524,34 @@ class Config:
                 sys.exit(1)
 
 
+    def load_groups(self):
+        # Read the [group:NAME] sections.  A server can only be in one group.  Servers in groups that aren't
+        # in the servers list are added to it.
+        self.groups = {}
+        grouped = {}
+        for section in self.parser.sections():
+            if not section.startswith('group:'):
+                continue
+            name = section[len('group:'):].strip()
+            group = self.parser[section]
+            servers_str = group.get('servers', fallback='')
+            servers = []
+            for server in [server.strip() for server in servers_str.split(',') if server.strip()]:
+                if server in grouped:
+                    logger.error(f"{server} is in groups {grouped[server]} and {name}.  Leaving it in {grouped[server]}")
+                    continue
+                grouped[server] = name
+                servers.append(server)
+                if server not in self.servers:
+                    self.servers.append(server)
+            max_concurrent = int(group.get('max_concurrent', fallback=GROUP_MAX_CONCURRENT))
+            if max_concurrent < 1:
+                logger.error(f"{max_concurrent} is not a valid max_concurrent for group {name}.  Changing to {GROUP_MAX_CONCURRENT}")
+                max_concurrent = GROUP_MAX_CONCURRENT
+            min_ok = int(group.get('min_ok', fallback=GROUP_MIN_OK))
+            self.groups[name] = {'servers': servers, 'max_concurrent': max_concurrent, 'min_ok': min_ok}
+
+
     def set_extra_values(self):
         self.hostname = socket.gethostname()
 
@@ -225,18 +563,49 @@ class Config:
             'cmsd_period': self.cmsd_period,
             'cmsd_wait': self.cmsd_wait,
             'service_timeout': self.service_timeout,
+            'http_connect_timeout': self.http_connect_timeout,
+            'http_timeout': self.http_timeout,
+            'timeout_factor': self.timeout_factor,
             'pkey_name': self.pkey_name,
             'pkey_path': self.pkey_path,
             'servers': ','.join(self.servers),
             'ssh_user': self.ssh_user,
+            'ssh_port': self.ssh_port,
             'min_ok': self.min_ok,
             'log_level': self.log_level,
+            'log_format': self.log_format,
+            'log_max_bytes': self.log_max_bytes,
+            'log_rotate_interval': self.log_rotate_interval,
+            'log_backups': self.log_backups,
             'prom_url': self.prom_url,
             'alert_url': self.alert_url,
             'pushgw_url': self.pushgw_url,
             'metrics_port': self.metrics_port,
-            'metrics_method': self.metrics_method
+            'metrics_method': self.metrics_method,
+            'max_concurrent': self.max_concurrent,
+            'engine': self.engine,
+            'ssh_workers': self.ssh_workers,
+            'ssh_keepalive': self.ssh_keepalive,
+            'ssh_idle_timeout': self.ssh_idle_timeout,
+            'ssh_pool_size': self.ssh_pool_size,
+            'restart_mode': self.restart_mode,
+            'drain_poll': self.drain_poll,
+            'drain_threshold': self.drain_threshold,
+            'xrootd_port': self.xrootd_port,
+            'cmsd_port': self.cmsd_port,
+            'probe_interval': self.probe_interval,
+            'selection': self.selection,
+            'selection_window': self.selection_window,
+            'load_probe': self.load_probe,
+            'prom_load_query': self.prom_load_query,
+            'state_file': self.state_file
         }
+        for name, group in self.groups.items():
+            self.parser[f'group:{name}'] = {
+                'servers': ','.join(group['servers']),
+                'max_concurrent': group['max_concurrent'],
+                'min_ok': group['min_ok']
+            }
         with open(self.config_file, 'w') as configfile:
             self.parser.write(configfile)
 
@@ -246,17 +615,44 @@ class Config:
         logger.info(f"cmsd_period: {self.cmsd_period}")
         logger.info(f"cmsd_wait: {self.cmsd_wait}")
         logger.info(f"service_timeout: {self.service_timeout}")
+        logger.info(f"http_connect_timeout: {self.http_connect_timeout}")
+        logger.info(f"http_timeout: {self.http_timeout}")
+        logger.info(f"timeout_factor: {self.timeout_factor}")
         logger.info(f"pkey_name: {self.pkey_name}")
         logger.info(f"pkey_path: {self.pkey_path}")
         logger.info(f"servers: {self.servers}")
         logger.info(f"ssh_user: {self.ssh_user}")
+        logger.info(f"ssh_port: {self.ssh_port}")
         logger.info(f"min_ok: {self.min_ok}")
         logger.info(f"log_level: {self.log_level}")
+        logger.info(f"log_format: {self.log_format}")
+        logger.info(f"log_max_bytes: {self.log_max_bytes}")
+        logger.info(f"log_rotate_interval: {self.log_rotate_interval}")
+        logger.info(f"log_backups: {self.log_backups}")
         logger.info(f"prom_url: {self.prom_url}")
         logger.info(f"alert_url: {self.alert_url}")
         logger.info(f"pushgw_url: {self.pushgw_url}")
         logger.info(f"metrics_port: {self.metrics_port}")
         logger.info(f"metrics_method: {self.metrics_method}")
+        logger.info(f"max_concurrent: {self.max_concurrent}")
+        logger.info(f"engine: {self.engine}")
+        logger.info(f"ssh_workers: {self.ssh_workers}")
+        logger.info(f"ssh_keepalive: {self.ssh_keepalive}")
+        logger.info(f"ssh_idle_timeout: {self.ssh_idle_timeout}")
+        logger.info(f"ssh_pool_size: {self.ssh_pool_size}")
+        logger.info(f"restart_mode: {self.restart_mode}")
+        logger.info(f"drain_poll: {self.drain_poll}")
+        logger.info(f"drain_threshold: {self.drain_threshold}")
+        logger.info(f"xrootd_port: {self.xrootd_port}")
+        logger.info(f"cmsd_port: {self.cmsd_port}")
+        logger.info(f"probe_interval: {self.probe_interval}")
+        logger.info(f"selection: {self.selection}")
+        logger.info(f"selection_window: {self.selection_window}")
+        logger.info(f"load_probe: {self.load_probe}")
+        logger.info(f"prom_load_query: {self.prom_load_query}")
+        logger.info(f"state_file: {self.state_file}")
+        for name, group in self.groups.items():
+            logger.info(f"group {name}: servers={group['servers']} max_concurrent={group['max_concurrent']} min_ok={group['min_ok']}")
 
 
     def create_keys(self):
@@ -292,6 +688,12 @@ class Server:
 
     CONNECT_ERR = 1
     RESTART_ERR = 2
+    HEALTH_ERR = 3
+
+    # Flags to keep track of what has been stopped incase of SIGINT/SIGTERM
+    CONNECTED = 1
+    CMSDSTOPPED = 2
+    XROOTDSTOPPED = 3
 
     received_signal = 0
     _status = OK
@@ -303,6 +705,14 @@ class Server:
     class RestartException(Exception):
         pass
 
+    class TimeoutException(RestartException):
+        pass
+
+    class Pause:
+        # A step in the restart sequence that waits for a number of seconds.
+        def __init__(self, seconds):
+            self.seconds = seconds
+
 
     def __init__(self, server_name, config, parent):
         # The parent tracks the number of servers that are ok.  When the status of this server
@@ -312,26 +722,51 @@ class Server:
         # Host name of the server. Used to connect using ssh.
         self.name = server_name
 
-        # The ssh user that will be used to restart the services.
-        self.ssh_user = config.ssh_user
+        self.configure(config)
 
-        # The names of the CMSD AND XROOTD services to be restarted
-        self.cmsd_svc = config.cmsd_svc
-        self.xrootd_svc = config.xrootd_svc
+        # Settings from a reloaded config.  They are used from the start of the next restart.
+        self.new_config = None
 
-        # How long to wait between stopping CMSD and stopping XROOTD
-        self.cmsd_wait = config.cmsd_wait
+        self.status(OK)
 
-        # How long to wait for a service to start/stop
-        self.service_timeout = config.service_timeout
+        # When the last restart of the server started.  Until the server has been restarted this is
+        # the time the program started.
+        self.last_restart = time.time()
 
-        self.status(OK)
+        # When the last successful restart of the server finished.  None if it isn't known.
+        self.last_success = None
+
+        # When the server was added to the list.  The time since the last success is counted from here until
+        # the server has been restarted successfully.
+        self.added_time = time.time()
+
+        # The phase of the restart in progress.
+        self.phase = None
+
+        # Identifies the restart in progress in the log.  The server name and the time it started.
+        self.restart_id = None
 
         # Assume the server is in error at the start.
         # If it isn't it won't matter.  If it is it will clear any alerts
-        # the server is working.
+        # the server is working.  load_state() replaces this with the saved errors.
         self.err_list = [self.CONNECT_ERR,self.RESTART_ERR]
 
+        # The error from the last failed restart.  Saved in the restart history.
+        self.last_error = None
+
+        # The ServerGroup the server is in.  None if it isn't in a group.
+        self.group = None
+
+        # Set when the server is removed from the config.
+        self.retired = False
+
+        # True if the last restart failed.  A server that passes a health check stays in error until it has
+        # been restarted successfully.
+        self.restart_failed = False
+
+        # How long each phase of a restart takes on this server.  load_state() adds the saved times.
+        self.durations = DurationModel()
+
         # Private key to use with the ssh connection
         self.pkey_file = config.priv_file
         self.private_key = paramiko.ECDSAKey.from_private_key_file(self.pkey_file)
@@ -341,12 +776,52 @@ class Server:
         return self.name
 
 
+    def configure(self, config):
+        # Take the settings used to restart the server from config.
+
+        # The ssh user and port that will be used to restart the services.
+        self.ssh_user = config.ssh_user
+        self.ssh_port = config.ssh_port
+
+        # The names of the CMSD AND XROOTD services to be restarted
+        self.cmsd_svc = config.cmsd_svc
+        self.xrootd_svc = config.xrootd_svc
+
+        # How long to wait between stopping CMSD and stopping XROOTD
+        self.cmsd_wait = config.cmsd_wait
+
+        # How long to wait for a service to start/stop.  Once the server has been timed the timeouts are
+        # timeout_factor times its own times.
+        self.service_timeout = config.service_timeout
+        self.timeout_factor = config.timeout_factor
+
+        # Restart using individual commands or a single remote script.
+        self.restart_mode = config.restart_mode
+
+        # How often to count the xrootd clients while waiting for them to leave after stopping cmsd.
+        self.drain_poll = config.drain_poll
+        self.drain_threshold = config.drain_threshold
+        self.xrootd_port = config.xrootd_port
+        self.cmsd_port = config.cmsd_port
+
+
+    def use_new_config(self):
+        # Switch to the settings from a reloaded config before starting a restart.
+        if self.new_config:
+            logger.debug(f"Using the reloaded config for {self.name}")
+            self.configure(self.new_config)
+            self.new_config = None
+
+
     def status(self,status):
         if status:
-            # If the status has changed, update the parent server list.
+            # If the status has changed, update the parent server list.  A retired server was taken
+            # off num_ok when it was removed from the config, so its status no longer counts.
             if status != self._status:
                 logger.debug(f"Settings status for {self.name} to {status}")
                 self._status = status
+                if self.retired:
+                    return
                 if status == OK:
                     self.parent.ajust_servers_ok( 1 )
                 else:
@@ -355,6 +830,63 @@ class Server:
             return self._status
 
 
+    def load_state(self, saved):
+        # Restore the status and errors saved by the last run of the program and set the alert metrics to match.
+        self.err_list = [int(err) for err in saved["errors"].split(",") if err]
+        if saved["status"]:
+            self.status(saved["status"])
+        self.last_success = saved["last_success"]
+        self.restart_failed = saved["status"] == ERR and (self.CONNECT_ERR in self.err_list or self.RESTART_ERR in self.err_list)
+        alerter.set_alert_states(self.name, self.CONNECT_ERR in self.err_list, self.RESTART_ERR in self.err_list)
+        self.durations = DurationModel(state_store.load_durations(self.name))
+        if self.durations.samples:
+            alerter.set_expected_duration(self.name, self.expected_duration())
+        if saved["phase"] != StateStore.IDLE:
+            logger.warning(f"The last restart of {self.name} was interrupted during {saved['phase']}. Please verify the state of {self.name} is ok")
+
+
+    def set_phase(self, phase):
+        # Record the step of the restart that is starting.  If the program dies part way through a restart
+        # the next run can see which server was left part restarted.
+        logger.debug(f"{self.name} phase: {phase}")
+        self.phase = phase
+        state_store.set_phase(self.name, phase)
+
+
+    def step_limit(self):
+        # Longest a step of the restart should take.  Starting a service runs three commands, each with the
+        # timeout of the phase.  The restart script reports its progress so isn't limited here.
+        if self.restart_mode == SCRIPT:
+            return ALIVE_LIMIT
+        if self.phase in DurationModel.PHASES:
+            return 3 * self.phase_timeout(self.phase) + ALIVE_LIMIT
+        return self.service_timeout + ALIVE_LIMIT
+
+
+    def phase_timeout(self, phase):
+        # Seconds to allow for a phase of the restart on this server.
+        return self.durations.timeout(phase, self.service_timeout, self.timeout_factor)
+
+
+    def expected_duration(self):
+        # Expected time for a whole restart of the server, from the average times of its phases.
+        expected = 0
+        for phase in DurationModel.PHASES:
+            mean = self.durations.expected(phase)
+            if mean is None:
+                mean = self.cmsd_wait if phase == "cmsd_wait" else 0
+            expected += mean
+        return expected
+
+
+    def record_duration(self, phase, seconds, timed_out=False):
+        # Add the time a phase took, or the timeout if it timed out, to the model of the server and save it.
+        self.durations.add(phase, seconds, timed_out)
+        logger.debug(f"{phase} on {self.name} took {seconds}s.  Timeout for the next one {self.phase_timeout(phase)}s")
+        state_store.save_durations(self.name, phase, self.durations.samples[phase])
+        alerter.set_expected_duration(self.name, self.expected_duration())
+
+
     def set_error(self,err_type):
         # Add err_type to the list of current errors.  
         # Make sure there is only one entry in the list.
@@ -376,42 +908,57 @@ class Server:
 
 
     def restart(self):
+        context = self.begin_log_context()
         try:
             # Restart the cmsd service, wait for cmsd_wait seconds and then restart xrootd service.
             logger.info(f"Restarting {self.name}")
             
             # Make sure the flag to say a shutdown signal has been seen is cleared.
             self.received_signal = 0
+            self.use_new_config()
 
             # Reassign the signal handlers to stop the restarting being interupted
             # and left in a odd state.
-            
+            # Signal handlers can only be changed in the main thread.  When the restart is run
+            # by a worker thread the server list passes the signal on by calling signal_handler().
+            in_main_thread = threading.current_thread() is threading.main_thread()
+
             # Save original signal handlers so they can be restored at the end.
-            logger.debug("Reassigning signal handler for restart()")
-            original_sigint_handler = signal.getsignal(signal.SIGINT)
-            original_sigterm_handler = signal.getsignal(signal.SIGTERM)
+            if in_main_thread:
+                logger.debug("Reassigning signal handler for restart()")
+                original_sigint_handler = signal.getsignal(signal.SIGINT)
+                original_sigterm_handler = signal.getsignal(signal.SIGTERM)
 
             try:
                 # Set custom handlers to capture signals and set received_signal.
-                signal.signal(signal.SIGINT, self.signal_handler)
-                signal.signal(signal.SIGTERM, self.signal_handler)
+                if in_main_thread:
+                    signal.signal(signal.SIGINT, self.signal_handler)
+                    signal.signal(signal.SIGTERM, self.signal_handler)
 
                 # Set the metric for restarting
+                self.last_restart = time.time()
+                self.last_error = None
+                outcome = StateStore.INTERRUPTED
                 alerter.restart_begin(self.name)
             
                 alerter.set_restart_time(self.name)
                 
                 # Do the restart and record the histogram metrics.
-                with alerter.xrootdrestart_duration.labels(node=self.name).time():
+                with alerter.xrootdrestart_duration.labels(**alerter.metrics_labels(self.name)).time():
                     self.do_restart()
+                outcome = StateStore.SUCCESS if self._status == OK else StateStore.FAILURE
 
             finally:
                 alerter.restart_end(self.name)
+                state_store.restart_end(self.name, self._status, self.err_list, self.last_restart, outcome, self.last_error)
+                if outcome == StateStore.SUCCESS:
+                    self.last_success = time.time()
 
                 # Restore original signal handlers
-                logger.debug("Restoring the original signal handlers")
-                signal.signal(signal.SIGINT, original_sigint_handler)
-                signal.signal(signal.SIGTERM, original_sigterm_handler)
+                if in_main_thread:
+                    logger.debug("Restoring the original signal handlers")
+                    signal.signal(signal.SIGINT, original_sigint_handler)
+                    signal.signal(signal.SIGTERM, original_sigterm_handler)
                 
         except self.TerminateException as e:
             raise
@@ -419,62 +966,294 @@ class Server:
         except Exception as e:
             logger.error(f"Exception restarting {self.name}: {str(e)}")
 
+        finally:
+            log_context.reset(context)
+
+
+    def begin_log_context(self):
+        # Mark the log records of the current thread (or task) as being about this restart.
+        self.phase = None
+        self.restart_id = f"{self.name}-{int(time.time())}"
+        return log_context.set(self)
+
+
+    async def restart_async(self, executor):
+        # The same as restart() but run as a coroutine by the AsyncEngine.  The engine handles the signals
+        # and passes them on by calling signal_handler().
+        context = self.begin_log_context()
+        try:
+            logger.info(f"Restarting {self.name}")
+            self.received_signal = 0
+            self.use_new_config()
+
+            try:
+                self.last_restart = time.time()
+                self.last_error = None
+                outcome = StateStore.INTERRUPTED
+                alerter.restart_begin(self.name)
+                alerter.set_restart_time(self.name)
+
+                with alerter.xrootdrestart_duration.labels(**alerter.metrics_labels(self.name)).time():
+                    await self.do_restart_async(executor)
+                outcome = StateStore.SUCCESS if self._status == OK else StateStore.FAILURE
+
+            finally:
+                alerter.restart_end(self.name)
+                state_store.restart_end(self.name, self._status, self.err_list, self.last_restart, outcome, self.last_error)
+                if outcome == StateStore.SUCCESS:
+                    self.last_success = time.time()
+
+        except self.TerminateException as e:
+            raise
+
+        except Exception as e:
+            logger.error(f"Exception restarting {self.name}: {str(e)}")
+
+        finally:
+            log_context.reset(context)
+
 
     def do_restart(self):
-        # Flags to keep track of what has been stopped incase of SIGINT/SIGTERM
-        CONNECTED = 1
-        CMSDSTOPPED = 2
-        XROOTDSTOPPED = 3
+        # Run the restart sequence in the current thread.
+        sequence = self.restart_sequence()
+        step = self.next_step(sequence)
+        while step is not None:
+            result = None
+            error = None
+            try:
+                if isinstance(step, Server.Pause):
+                    self.pause(step.seconds)
+                else:
+                    server_list.alive(self.step_limit())
+                    result = step()
+            except Exception as e:
+                error = e
+            step = self.next_step(sequence, result, error)
+
+
+    async def do_restart_async(self, executor):
+        # Run the restart sequence on the event loop.  The blocking steps are run by executor so the
+        # event loop is never blocked by the ssh connection.
+        loop = asyncio.get_running_loop()
+        sequence = self.restart_sequence()
+        step = self.next_step(sequence)
+        while step is not None:
+            result = None
+            error = None
+            try:
+                if isinstance(step, Server.Pause):
+                    await self.pause_async(step.seconds)
+                else:
+                    # The step is run in a copy of the task's context so its log records are marked too.
+                    result = await loop.run_in_executor(executor, contextvars.copy_context().run, step)
+            except Exception as e:
+                error = e
+            step = self.next_step(sequence, result, error)
+
+
+    def next_step(self, sequence, result=None, error=None):
+        # Pass the result of the last step, or the exception it raised, back to the restart sequence and
+        # return the next step.  Returns None when the sequence has finished.
+        try:
+            if error is not None:
+                return sequence.throw(error)
+            return sequence.send(result)
+        except StopIteration:
+            return None
+
+
+    def pause(self, seconds):
+        i = seconds
+        while i>0:
+            server_list.alive()
+            time.sleep(1)
+            i -= 1
+            # Check for program termination and terminate the wait if it is set.  
+            # The stop_service() and start_service()functions check for the recieved signal 
+            # being set and raise an exception. It isn't the most efficent method but it 
+            # makes the code easier to read. The extra overhead isn't that big. 
+            if self.received_signal != 0:
+                logger.debug("CMSD_WAIT terminated because a signal has been set.")
+                break
+
+
+    async def pause_async(self, seconds):
+        # The same as pause() but it gives up the event loop while waiting.
+        i = seconds
+        while i>0:
+            await asyncio.sleep(1)
+            i -= 1
+            if self.received_signal != 0:
+                logger.debug("CMSD_WAIT terminated because a signal has been set.")
+                break
+
+
+    def drain_sequence(self, ssh_client):
+        # Wait for up to cmsd_wait seconds after stopping cmsd.  If drain_poll is set the number of xrootd
+        # client connections is checked every drain_poll seconds and the wait ends as soon as it drops to
+        # drain_threshold or below.
+        start_time = time.time()
+        if self.drain_poll <= 0:
+            logger.info(f"Pausing for {self.cmsd_wait} seconds before stopping xrootd")
+            yield Server.Pause(self.cmsd_wait)
+        else:
+            logger.info(f"Waiting up to {self.cmsd_wait} seconds for the clients to leave {self.name}")
+            poll = True
+            while self.received_signal == 0:
+                remaining = self.cmsd_wait - (time.time() - start_time)
+                if remaining <= 0:
+                    break
+                if poll:
+                    try:
+                        clients = yield functools.partial(self.count_clients, ssh_client, "cmsd_wait")
+                        logger.debug(f"{clients} xrootd clients connected to {self.name}")
+                        if clients <= self.drain_threshold:
+                            logger.info(f"{clients} xrootd clients connected to {self.name}. Ending the wait")
+                            break
+                    except Exception as e:
+                        # Can't count the clients so fall back to waiting for the rest of cmsd_wait.
+                        logger.warning(f"Unable to count the xrootd clients on {self.name}: {str(e)}")
+                        poll = False
+                        continue
+                    yield Server.Pause(min(self.drain_poll, math.ceil(remaining)))
+                else:
+                    yield Server.Pause(math.ceil(remaining))
+        alerter.set_drain_time(self.name, time.time() - start_time)
+        alerter.set_phase_time(self.name, "cmsd_wait", "ok", time.time() - start_time)
+        self.record_duration("cmsd_wait", time.time() - start_time)
+
+
+    def probe_load(self, load_probe):
+        # Measure the load on the server over ssh: the number of xrootd clients or the 1 minute load average.
+        ssh_client = self.connect()
+        try:
+            if load_probe == CONNECTIONS:
+                load = self.count_clients(ssh_client)
+            else:
+                stdout, stderr = self.execute_command(ssh_client, "cat /proc/loadavg", phase="load")
+                load = float(stdout.split()[0])
+        except Exception:
+            self.close_connection(ssh_client, False)
+            raise
+        self.close_connection(ssh_client)
+        return load
+
+
+    def health_check(self):
+        # Check the server is up: sshd, xrootd and cmsd accept tcp connections and both services are active.
+        # Returns None if the server is ok or a description of the problem.
+        ports = [self.ssh_port, self.xrootd_port] + ([self.cmsd_port] if self.cmsd_port else [])
+        for port in ports:
+            try:
+                socket.create_connection((self.name, port), timeout=HEALTH_CONNECT_TIMEOUT).close()
+            except Exception as e:
+                return f"port {port} not reachable: {str(e)}"
+
+        ssh_client = self.connect()
+        try:
+            # One command checks both services.  is-active prints one state per service.
+            stdout, stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {self.cmsd_svc} {self.xrootd_svc}", phase="health")
+        except Exception as e:
+            self.close_connection(ssh_client, False)
+            return str(e)
+        self.close_connection(ssh_client)
+        states = stdout.split()
+        for service, state in zip([self.cmsd_svc, self.xrootd_svc], states + [""] * 2):
+            if state != "active":
+                return f"{service} is {state or 'unknown'}"
+        return None
+
+
+    def set_health(self, problem):
+        # Update the status of the server from the result of a health check.  A server that fails the check
+        # counts as not ok until it passes again.  Errors from restarts are only cleared by a restart.
+        alerter.set_node_up(self.name, problem is None)
+        if problem:
+            if self.HEALTH_ERR not in self.err_list:
+                logger.warning(f"Health check of {self.name} failed: {problem}")
+            self.set_error(self.HEALTH_ERR)
+            self.status(ERR)
+        elif self.HEALTH_ERR in self.err_list:
+            logger.info(f"Health check of {self.name} passed")
+            self.clear_error(self.HEALTH_ERR)
+            if not self.restart_failed:
+                self.status(OK)
+
+
+    def count_clients(self, ssh_client, phase="load"):
+        # Return the number of established connections to the xrootd port on the server.
+        stdout, stderr = self.execute_command(ssh_client, f"ss -tn state established '( sport = :{self.xrootd_port} )' | tail -n +2 | wc -l", phase=phase)
+        return int(stdout)
+
+
+    def restart_sequence(self):
+        # Generator that steps through restarting the services on the server.  Anything that blocks on the
+        # network is yielded as a function to call and waits are yielded as a Pause.  This lets do_restart()
+        # and do_restart_async() run the same sequence.  The result of a step (or the exception it raised)
+        # is sent back in to the generator.
+
+        CONNECTED = self.CONNECTED
+        CMSDSTOPPED = self.CMSDSTOPPED
+        XROOTDSTOPPED = self.XROOTDSTOPPED
         state = []
 
         # Open an ssh connection to the server
+        # The phases are saved to the state file as the restart goes along.  The writes are small local
+        # transactions so they are done inline rather than yielded.  The alerts are only queued on the
+        # alerter's event bus so they are called inline too.
+        connect_start = time.time()
         try:
-            ssh_client = self.connect()
+            self.set_phase("connect")
+            ssh_client = yield self.connect
+            alerter.set_phase_time(self.name, "connect", "ok", time.time() - connect_start)
             state.append(CONNECTED)
             # If the server previoiusly had a connect error, clear the alert.
             if self.CONNECT_ERR in self.err_list:
                 alerter.clear_connect_alert(self.name)
                 self.clear_error(self.CONNECT_ERR)
         except Exception as e:
+            alerter.set_phase_time(self.name, "connect", "error", time.time() - connect_start)
             logger.error( f"Error connecting to {self.name}" )
             logger.error( f"ERROR:{str(e)}" )
+            self.last_error = str(e)
+            self.restart_failed = True
             self.set_error(self.CONNECT_ERR)
             self.status(ERR)
             alerter.cant_connect(self.name, f"XRootDRestart is unable to connect to {self.name}",str(e))
         else:
             try:
-                # If the program is interupted at any point received_signal will be non-zero.
-                # stop_service() and start_service() will raise a self.TerminateException if a non-zero value is set.
-                self.stop_service(ssh_client, self.cmsd_svc)
-                state.append(CMSDSTOPPED)
-
-                logger.info(f"Pausing for {self.cmsd_wait} seconds before stopping xrootd")
-                i = self.cmsd_wait
-                while i>0:
-                    time.sleep(1)
-                    i -= 1
-                    # Check for program termination and terminate the wait if it is set.  
-                    # The stop_service() and start_service()functions check for the recieved signal 
-                    # being set and raise an exception. It isn't the most efficent method but it 
-                    # makes the code easier to read. The extra overhead isn't that big. 
-                    if self.received_signal != 0:
-                        logger.debug("CMSD_WAIT terminated because a signal has been set.")
-                        break
-
-                # Methods will raise a TerminateException exception if received_signal set.
-                self.stop_service(ssh_client, self.xrootd_svc)
-                state.append(XROOTDSTOPPED)
-
-                self.start_service(ssh_client, self.xrootd_svc)
-                state.remove(XROOTDSTOPPED)
-
-                self.start_service(ssh_client, self.cmsd_svc)
-                state.remove(CMSDSTOPPED)
-
-                self.close_connection(ssh_client)
+                if self.restart_mode == SCRIPT:
+                    # The whole restart is done by one remote script.  script_sequence() updates
+                    # state from the script's progress lines.
+                    yield from self.script_sequence(ssh_client, state)
+                else:
+                    # If the program is interupted at any point received_signal will be non-zero.
+                    # stop_service() and start_service() will raise a self.TerminateException if a non-zero value is set.
+                    self.set_phase("cmsd_stop")
+                    yield functools.partial(self.stop_service, ssh_client, self.cmsd_svc)
+                    state.append(CMSDSTOPPED)
+
+                    self.set_phase("cmsd_wait")
+                    yield from self.drain_sequence(ssh_client)
+
+                    # Methods will raise a TerminateException exception if received_signal set.
+                    self.set_phase("xrootd_stop")
+                    yield functools.partial(self.stop_service, ssh_client, self.xrootd_svc)
+                    state.append(XROOTDSTOPPED)
+
+                    self.set_phase("xrootd_start")
+                    yield functools.partial(self.start_service, ssh_client, self.xrootd_svc)
+                    state.remove(XROOTDSTOPPED)
+
+                    self.set_phase("cmsd_start")
+                    yield functools.partial(self.start_service, ssh_client, self.cmsd_svc)
+                    state.remove(CMSDSTOPPED)
+
+                yield functools.partial(self.close_connection, ssh_client)
                 state.remove(CONNECTED)
 
                 # All the services have been restarted.
+                self.restart_failed = False
                 self.status(OK)
                 
                 # Clear the alert if there was a prior restart error.
@@ -491,11 +1270,11 @@ class Server:
                 try:
                     # Try and restart any services that were stopped before exiting to shutdown. 
                     if XROOTDSTOPPED in state:
-                        self.start_service(ssh_client, self.xrootd_svc, False)
+                        yield functools.partial(self.start_service, ssh_client, self.xrootd_svc, False)
                     if CMSDSTOPPED in state:
-                        self.start_service(ssh_client, self.cmsd_svc, False)
+                        yield functools.partial(self.start_service, ssh_client, self.cmsd_svc, False)
                     if CONNECTED in state:
-                        self.close_connection(ssh_client)
+                        yield functools.partial(self.close_connection, ssh_client, False)
                         
                     print(f"Restarting {self.name} was interrupted.")
                     
@@ -509,73 +1288,107 @@ class Server:
             except Exception as e:
                 logger.error( f"Error restarting {self.name}" )
                 logger.error( f"ERROR:{e}" )
+                self.last_error = str(e)
+                self.restart_failed = True
                 self.status(ERR)
                 self.set_error(self.RESTART_ERR)
                 alerter.restart_failure(self.name,f"Unable to restart the services on {self.name}",str(e))
-                self.close_connection(ssh_client)
+                yield functools.partial(self.close_connection, ssh_client, False)
 
 
     def connect(self):
+        # Get a connection to the server from the ssh connection pool.
+        return ssh_pool.acquire(self)
+
+
+    def open_connection(self):
         # Connect to the server. Only use the private key specified in the config.
         # Stop it using the agent as that could result in intermittent working/not working.
         # Don't look in the .ssh directory for valid keys.
+        # An unreachable server gives up after service_timeout seconds rather than the tcp timeout.
         logger.info(f"Connecting to {self.name}")
         ssh_client = paramiko.SSHClient()
         ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(self.name, username=self.ssh_user, pkey=self.private_key, allow_agent=False, look_for_keys=False)
+        ssh_client.connect(self.name, port=self.ssh_port, username=self.ssh_user, pkey=self.private_key, allow_agent=False, look_for_keys=False,
+                           timeout=self.service_timeout, banner_timeout=self.service_timeout, auth_timeout=self.service_timeout)
         logger.debug(f"Connected to {self.name}")
         return ssh_client
 
 
-    def execute_command(self, ssh_client, command):
+    def execute_command(self, ssh_client, command, timeout=None, phase="other"):
+        # Run command on the server.  The time it takes is recorded in the command latency metric under phase.
         logger.debug(f"Executing command ({self.name}): {command}")
         
+        start_time = time.time()
         try:
             # NOTE: exec_command() doen't generate an exception when service_timeout is reached.
             #       The exception is raised when stdout.read() is executed.  
-            stdin, stdout, stderr = ssh_client.exec_command(command, timeout=self.service_timeout)
+            stdin, stdout, stderr = ssh_client.exec_command(command, timeout=timeout or self.service_timeout)
             ret_stdout = stdout.read().decode().strip()
             ret_stderr = stderr.read().decode().strip()
         except socket.timeout:
+            alerter.set_command_time(self.name, phase, "timeout", time.time() - start_time)
             logger.error(f"Timeout while executing command on {self.name}: {command}")
-            raise Server.RestartException(f"Timeout running command: {command}")
+            raise Server.TimeoutException(f"Timeout running command: {command}")
         except paramiko.SSHException as e:
+            alerter.set_command_time(self.name, phase, "error", time.time() - start_time)
             logger.error(f"SSH error while executing command on {self.name}: {e}")
             raise Server.RestartException(f"SSH error running command: {command}")
         except Exception as e:
+            alerter.set_command_time(self.name, phase, "error", time.time() - start_time)
             logger.error(f"An exception occurred while executing command on {self.name}: {e}")
             raise Server.RestartException(f"Error running command: {command}")
             
         logger.debug(f"stdout: {ret_stdout}")
         logger.debug(f"stderr: {ret_stderr}")
         
+        alerter.set_command_time(self.name, phase, "error" if ret_stderr else "ok", time.time() - start_time)
         if ret_stderr:
             raise Exception(f"Error running command: {ret_stderr}")
             
         return ret_stdout, ret_stderr
 
 
+    @staticmethod
+    def outcome(e):
+        # The outcome label of a phase or command that raised e.
+        return "timeout" if isinstance(e, Server.TimeoutException) else "error"
+
+
+    def service_phase(self, service_name, action):
+        # Name of the restart phase that does action (stop or start) to service_name.
+        return f"{'cmsd' if service_name == self.cmsd_svc else 'xrootd'}_{action}"
+
+
     def stop_service(self, ssh_client, service_name, raise_term_exception=True):
         if self.received_signal !=0 and raise_term_exception:
             raise Server.TerminateException("Program termination detected.  Exiting restart")
             
+        phase = self.service_phase(service_name, "stop")
+        timeout = self.phase_timeout(phase)
         try:
             start_time = time.time()
             logger.info(f"Stopping service {service_name} on {self.name}")
-            stdout, stderr = self.execute_command(ssh_client, f"sudo systemctl stop {service_name}")
+            stdout, stderr = self.execute_command(ssh_client, f"sudo systemctl stop {service_name}", timeout, phase)
             
             logger.info(f"Checking the state of {service_name}")
-            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}")
+            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}", timeout, phase)
             if stdout.strip() == "active":
                 raise Server.RestartException(f"{service_name} failed to stop")
                 
             logger.info(f"{service_name} stopped successfully")
             elapsed_time = time.time() - start_time
             logger.debug(f"Stoppping {service_name} took {elapsed_time}s")
+            self.record_duration(phase, elapsed_time)
+            alerter.set_phase_time(self.name, phase, "ok", elapsed_time)
                 
         except Exception as e:
             elapsed_time = time.time() - start_time
             logger.debug(f"Stoppping {service_name} took {elapsed_time}s")
+            alerter.set_phase_time(self.name, phase, self.outcome(e), elapsed_time)
+            if isinstance(e, Server.TimeoutException):
+                # It took at least the timeout.  Recording that lets the timeout grow for a slow server.
+                self.record_duration(phase, timeout, timed_out=True)
             raise Server.RestartException(f"Error stopping {service_name}: {str(e)}")
             
 
@@ -583,39 +1396,744 @@ class Server:
         if self.received_signal !=0 and raise_term_exception:
             raise Server.TerminateException("Program termination detected.  Exiting restart")
 
+        phase = self.service_phase(service_name, "start")
+        timeout = self.phase_timeout(phase)
         try:
             start_time = time.time()
             logger.info(f"Starting service {service_name} on {self.name}")
 
             # Double check the service is actually stopped before starting it.
             # If it's already active there is a problem so raise an exception.
-            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}")
+            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}", timeout, phase)
             if stdout.strip() == "active":
                 raise Server.RestartException(f"{service_name} already active before starting.")
 
-            stdout, stderr = self.execute_command(ssh_client, f"sudo systemctl start {service_name}")
+            stdout, stderr = self.execute_command(ssh_client, f"sudo systemctl start {service_name}", timeout, phase)
                
             logger.info(f"Checking the state of {service_name}")
-            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}")
+            stdout,stderr = self.execute_command(ssh_client, f"sudo systemctl is-active {service_name}", timeout, phase)
             if stdout.strip() == "inactive":
                 raise Server.RestartException(f"{service_name} failed to start")
                 
             logger.info(f"{service_name} started successfully")
             elapsed_time = time.time() - start_time
             logger.debug(f"Starting {service_name} took {elapsed_time}s")
+            self.record_duration(phase, elapsed_time)
+            alerter.set_phase_time(self.name, phase, "ok", elapsed_time)
                 
         except Exception as e:
             elapsed_time = time.time() - start_time
             logger.debug(f"Starting {service_name} took {elapsed_time}s")
+            alerter.set_phase_time(self.name, phase, self.outcome(e), elapsed_time)
+            if isinstance(e, Server.TimeoutException):
+                self.record_duration(phase, timeout, timed_out=True)
             raise Server.RestartException(f"Error starting {service_name}: {str(e)}")
 
 
-    def close_connection(self, ssh_client):
+    def start_restart_script(self, ssh_client):
+        # Start RESTART_SCRIPT on the server.  Returns the channel and stderr of the script.
+        args = " ".join(shlex.quote(str(arg)) for arg in [self.cmsd_svc, self.xrootd_svc, self.cmsd_wait,
+                                                          self.drain_poll, self.drain_threshold, self.xrootd_port])
+        command = f"bash -c {shlex.quote(RESTART_SCRIPT)} xrootdrestart {args}"
+        logger.info(f"Running the restart script on {self.name}")
+        try:
+            stdin, stdout, stderr = ssh_client.exec_command(command)
+            channel = stdout.channel
+            channel.settimeout(1)
+        except Exception as e:
+            logger.error(f"SSH error while starting the restart script on {self.name}: {e}")
+            raise Server.RestartException(f"SSH error running the restart script: {e}")
+        return channel, stderr
+
+
+    @staticmethod
+    def read_script_output(channel):
+        # Return the output the script has sent, b"" once it has finished, or None if there is nothing yet.
+        # Only reads when there is something to read, so it never waits for the script.
+        if channel.recv_ready() or channel.eof_received:
+            return channel.recv(4096)
+        return None
+
+
+    @staticmethod
+    def finish_restart_script(channel, stderr):
+        # Return the exit status and stderr of the finished script.
+        return channel.recv_exit_status(), stderr.read().decode().strip()
+
+
+    def script_sequence(self, ssh_client, state):
+        # Run RESTART_SCRIPT on the server over a single channel.  Progress lines are read as they arrive
+        # and used to keep state up to date so a failed or interrupted restart can be rolled back.  Like
+        # restart_sequence() it yields the reads as steps and waits between them as a Pause, so with the
+        # ASYNC engine a restart only holds an ssh worker while output is being read, not for the whole script.
+        if self.received_signal != 0:
+            raise Server.TerminateException("Program termination detected.  Exiting restart")
+
+        channel, stderr = yield functools.partial(self.start_restart_script, ssh_client)
+
+        phase = None
+        phase_start = time.time()
+        last_progress = time.time()
+        failure = None
+        finished = False
+        aborted = False
+        buffer = ""
+        while True:
+            if self.received_signal != 0 and not aborted:
+                # Closing stdin tells the script to stop before its next phase.
+                logger.info(f"Asking the restart script on {self.name} to stop")
+                channel.shutdown_write()
+                aborted = True
+
+            try:
+                data = yield functools.partial(self.read_script_output, channel)
+            except Exception as e:
+                logger.error(f"SSH error while running the restart script on {self.name}: {e}")
+                raise Server.RestartException(f"SSH error running the restart script: {e}")
+
+            if data is None:
+                # Nothing received.  Each phase has its timeout to report back, plus cmsd_wait for the pause
+                # after stopping cmsd.
+                if phase == "cmsd_wait":
+                    limit = self.service_timeout + self.cmsd_wait
+                else:
+                    limit = self.phase_timeout(phase)
+                if time.time() - last_progress > limit:
+                    logger.error(f"Timeout while running the restart script on {self.name} during {phase}")
+                    if phase in DurationModel.PHASES and phase != "cmsd_wait":
+                        self.record_duration(phase, limit, timed_out=True)
+                    alerter.set_phase_time(self.name, phase, "timeout", time.time() - phase_start)
+                    raise Server.RestartException(f"Timeout running the restart script during {phase}")
+                yield Server.Pause(1)
+                continue
+
+            if not data:
+                break
+            last_progress = time.time()
+            buffer += data.decode()
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+                fields = line.strip().split(" ", 3)
+                if len(fields) < 2 or fields[0] != "XRDR":
+                    logger.debug(f"Restart script ({self.name}): {line}")
+                    continue
+
+                if fields[1] == "done":
+                    finished = True
+                elif len(fields) > 3 and fields[2] == "clients":
+                    logger.debug(f"{fields[3]} xrootd clients connected to {self.name}")
+                elif fields[1] == "abort":
+                    aborted = True
+                elif len(fields) > 2 and fields[2] == "begin":
+                    phase = fields[1]
+                    phase_start = time.time()
+                    logger.info(f"{phase} started on {self.name}")
+                    self.set_phase(phase)
+                elif len(fields) > 2 and fields[2] == "ok":
+                    logger.info(f"{fields[1]} completed on {self.name}")
+                    logger.debug(f"{fields[1]} took {time.time() - phase_start}s")
+                    alerter.set_phase_time(self.name, fields[1], "ok", time.time() - phase_start)
+                    if fields[1] in DurationModel.PHASES:
+                        self.record_duration(fields[1], time.time() - phase_start)
+                    if fields[1] == "cmsd_wait":
+                        alerter.set_drain_time(self.name, time.time() - phase_start)
+                    if fields[1] == "cmsd_stop":
+                        state.append(self.CMSDSTOPPED)
+                    elif fields[1] == "xrootd_stop":
+                        state.append(self.XROOTDSTOPPED)
+                    elif fields[1] == "xrootd_start":
+                        state.remove(self.XROOTDSTOPPED)
+                    elif fields[1] == "cmsd_start":
+                        state.remove(self.CMSDSTOPPED)
+                elif len(fields) > 2 and fields[2] == "fail":
+                    failure = fields[3] if len(fields) > 3 else f"{fields[1]} failed"
+                    alerter.set_phase_time(self.name, fields[1], "error", time.time() - phase_start)
+                    logger.error(f"{fields[1]} failed on {self.name}: {failure}")
+
+        exit_status, ret_stderr = yield functools.partial(self.finish_restart_script, channel, stderr)
+        logger.debug(f"Restart script on {self.name} exited with {exit_status}")
+        if ret_stderr:
+            logger.debug(f"stderr: {ret_stderr}")
+
+        if failure:
+            raise Server.RestartException(failure)
+        if finished:
+            return
+        if aborted:
+            raise Server.TerminateException("Program termination detected.  Exiting restart")
+        raise Server.RestartException(f"The restart script didn't finish (exit status {exit_status}). {ret_stderr}")
+
+
+    def close_connection(self, ssh_client, reuse=True):
+        # Hand the connection back to the ssh connection pool.  If the connection may be in a bad
+        # state (reuse=False) it is closed instead of being kept for the next restart.
+        if reuse:
+            ssh_pool.release(self.name, ssh_client)
+        else:
+            ssh_pool.discard(self.name, ssh_client)
+
+#-----------------------------------------------------------------------------------------------------
+
+class SSHPool:
+    # Keeps ssh connections open after use so the next connection to a server doesn't have to do the tcp
+    # connect, key exchange and authentication again.  One idle connection is kept per host name.  Idle
+    # connections send keepalives, are checked before they are reused and are closed after ssh_idle_timeout
+    # seconds without being used.  If an idle connection is no longer usable a new one is opened instead.
+    # Each open connection has a paramiko thread, so no more than ssh_pool_size are kept.  When the pool is
+    # full the least recently used connection is closed.  A reaper thread closes the expired connections
+    # even when nothing is connecting.
+
+    def __init__(self, config):
+        self.keepalive = config.ssh_keepalive
+        self.idle_timeout = config.ssh_idle_timeout
+        self.max_size = config.ssh_pool_size
+        self.lock = threading.Lock()
+        # host name -> (ssh client, time the connection was released).  Least recently used first.
+        self.idle = collections.OrderedDict()
+        self.stopped = threading.Event()
+        self.reaper_thread = threading.Thread(target=self.reap, name="ssh-reaper")
+        self.reaper_thread.daemon = True
+
+
+    def start(self):
+        if self.idle_timeout > 0:
+            self.reaper_thread.start()
+
+
+    def reap(self):
+        # Close the expired connections every SSH_REAP_INTERVAL seconds, or sooner if idle_timeout is shorter.
+        interval = min(self.idle_timeout, SSH_REAP_INTERVAL)
+        while not self.stopped.wait(interval):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                logger.error(f"Error closing the idle ssh connections: {str(e)}")
+
+
+    def acquire(self, server):
+        # Return a working connection to server.
+        self.evict_idle()
+        with self.lock:
+            entry = self.idle.pop(server.name, None)
+            alerter.set_ssh_pool_size(len(self.idle))
+
+        if entry:
+            ssh_client = entry[0]
+            if self.is_healthy(ssh_client):
+                logger.debug(f"Reusing the connection to {server.name}")
+                alerter.ssh_pool_request(server.name, "hit")
+                return ssh_client
+            logger.debug(f"The pooled connection to {server.name} is no longer usable. Reconnecting")
+            self.close(server.name, ssh_client)
+
+        alerter.ssh_pool_request(server.name, "miss")
+        start_time = time.time()
+        ssh_client = server.open_connection()
+        alerter.set_handshake_time(server.name, time.time() - start_time)
+
+        if self.keepalive > 0:
+            transport = ssh_client.get_transport()
+            if transport:
+                transport.set_keepalive(self.keepalive)
+        return ssh_client
+
+
+    def release(self, name, ssh_client):
+        # Keep the connection for the next time it's needed or close it if pooling is disabled.
+        if self.idle_timeout <= 0 or self.max_size <= 0 or self.stopped.is_set() or not self.is_healthy(ssh_client):
+            self.close(name, ssh_client)
+            return
+
+        logger.debug(f"Keeping the connection to {name} open for reuse")
+        closing = []
+        with self.lock:
+            old = self.idle.pop(name, None)
+            if old and old[0] is not ssh_client:
+                closing.append((name, old[0]))
+            self.idle[name] = (ssh_client, time.time())
+            while len(self.idle) > self.max_size:
+                lru_name, entry = self.idle.popitem(last=False)
+                closing.append((lru_name, entry[0]))
+            alerter.set_ssh_pool_size(len(self.idle))
+        for old_name, old_client in closing:
+            self.close(old_name, old_client)
+
+
+    def discard(self, name, ssh_client):
+        # Close a connection that shouldn't be reused.
+        self.close(name, ssh_client)
+
+
+    def is_healthy(self, ssh_client):
+        # Check the transport is still up and can send a packet.
+        try:
+            transport = ssh_client.get_transport()
+            if transport is None or not transport.is_active():
+                return False
+            transport.send_ignore()
+            return True
+        except Exception as e:
+            logger.debug(f"Connection health check failed: {str(e)}")
+            return False
+
+
+    def evict_idle(self):
+        # Close connections that haven't been used for idle_timeout seconds.
+        now = time.time()
+        with self.lock:
+            expired = [(name, entry[0]) for name, entry in self.idle.items() if now - entry[1] > self.idle_timeout]
+            for name, ssh_client in expired:
+                del self.idle[name]
+            alerter.set_ssh_pool_size(len(self.idle))
+        for name, ssh_client in expired:
+            logger.debug(f"Closing idle connection to {name}")
+            self.close(name, ssh_client)
+
+
+    def close_all(self):
+        # Close all the idle connections and stop keeping connections.  Called when the program exits.
+        self.stopped.set()
+        with self.lock:
+            entries = list(self.idle.items())
+            self.idle.clear()
+            alerter.set_ssh_pool_size(0)
+        for name, entry in entries:
+            self.close(name, entry[0])
+
+
+    def close(self, name, ssh_client):
         try:
-            logger.info(f"Closing connection to {self.name}")
+            logger.info(f"Closing connection to {name}")
             ssh_client.close()
         except Exception as e:
-            logger.error(f"Error closing connection to {self.name}: {str(e)}")
+            logger.error(f"Error closing connection to {name}: {str(e)}")
+
+#-----------------------------------------------------------------------------------------------------
+
+class RoundRobinPolicy:
+    # Restart the server whose restart is due first.  Once the rotation is going this is the order the
+    # servers are listed in the config.
+    spare_slots = 0
+
+    def select(self, server_list):
+        return server_list.scheduler.candidates(1)[0]
+
+#-----------------------------------------------------------------------------------------------------
+
+class LeastLoadedPolicy:
+    # Restart the least loaded of the selection_window servers that have gone longest without a restart.
+    # A server is always picked if leaving it until the next restart slot would take it past cmsd_period.
+    # The servers are restarted slightly faster than round robin (selection_window - 1 spare slots each
+    # cmsd_period) so a server can't be passed over often enough to miss its deadline.
+
+    def __init__(self, config):
+        self.window = config.selection_window
+        self.spare_slots = config.selection_window - 1
+        self.load_probe = config.load_probe
+        self.prom_url = config.prom_url
+        self.prom_load_query = config.prom_load_query
+        # Longest the probes of one selection may take.
+        self.probe_timeout = config.service_timeout
+
+
+    def select(self, server_list):
+        # Candidates are the servers that aren't already waiting or being restarted, most overdue first.
+        candidates = server_list.scheduler.candidates(self.window)
+
+        # Don't pass over the most overdue server if it would miss its deadline.
+        oldest = candidates[0]
+        if time.time() + server_list.restart_interval() > server_list.scheduler.due_time(oldest):
+            logger.info(f"{oldest.name} is due to be restarted. Not checking the server loads")
+            return oldest
+
+        # The probes can take up to probe_timeout, so tell the watchdog before waiting for them.
+        server_list.alive(self.probe_timeout + ALIVE_LIMIT)
+        loads = self.probe(candidates)
+        selected = min(candidates, key=lambda server: loads[server.name])
+        logger.info(f"Selected {selected.name} (load {loads[selected.name]}) from {[server.name for server in candidates]}")
+        return selected
+
+
+    def probe(self, candidates):
+        # Measure the load of each candidate in parallel.  A server that can't be probed, or doesn't answer
+        # within probe_timeout seconds, is treated as fully loaded so it is only picked if none of the others
+        # can be probed either.  The executor isn't waited for, so a hung probe is left to finish on its own.
+        loads = {}
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="probe")
+        try:
+            if self.load_probe == PROMETHEUS:
+                futures = {executor.submit(self.query_prometheus, server.name): server for server in candidates}
+            else:
+                futures = {executor.submit(server.probe_load, self.load_probe): server for server in candidates}
+            deadline = time.time() + self.probe_timeout
+            for future, server in futures.items():
+                try:
+                    loads[server.name] = future.result(max(deadline - time.time(), 0))
+                    logger.debug(f"Load on {server.name}: {loads[server.name]}")
+                except concurrent.futures.TimeoutError:
+                    logger.warning(f"Timed out getting the load of {server.name}")
+                    loads[server.name] = float("inf")
+                except Exception as e:
+                    logger.warning(f"Unable to get the load of {server.name}: {str(e)}")
+                    loads[server.name] = float("inf")
+        finally:
+            executor.shutdown(wait=False)
+        return loads
+
+
+    def query_prometheus(self, server_name):
+        # Return the value of prom_load_query for the server.
+        query = self.prom_load_query.replace("{node}", server_name)
+        response = alerter.prometheus.request("GET", f"{self.prom_url}/api/v1/query", params={"query": query})
+        response.raise_for_status()
+        result = response.json()["data"]["result"]
+        if not result:
+            raise Exception(f"No result for the query {query}")
+        return float(result[0]["value"][1])
+
+#-----------------------------------------------------------------------------------------------------
+
+class DurationModel:
+    # Learns how long each phase of a restart takes on one server.  A moving average (EWMA) of each phase
+    # gives the expected duration and the 95th percentile of the last SAMPLES times sets the timeout.  A
+    # phase that times out is recorded as taking the timeout, so the timeout of a slow server grows until
+    # its phases finish, while a fast server gets a timeout well below service_timeout and a hang is
+    # noticed sooner.  Until a phase that timed out next finishes it is allowed at least service_timeout,
+    # so a server that has slowed down isn't failed again on each restart while its timeout catches up.
+
+    PHASES = ["cmsd_stop", "cmsd_wait", "xrootd_stop", "xrootd_start", "cmsd_start"]
+
+    # Weight of the newest time in the moving average.
+    ALPHA = 0.3
+    # Number of times kept for each phase.
+    SAMPLES = 20
+    # service_timeout is used until a phase has been timed this many times.
+    MIN_SAMPLES = 3
+    # Bounds of a learned timeout.  The upper bound is a multiple of service_timeout.
+    MIN_TIMEOUT = 30
+    MAX_TIMEOUT_FACTOR = 10
+
+    def __init__(self, samples=None):
+        # samples is a dictionary of phase -> list of times, oldest first.
+        self.samples = {}
+        self.mean = {}
+        # Phases whose last time was a timeout.
+        self.timed_out = set()
+        for phase, times in (samples or {}).items():
+            for seconds in times:
+                self.add(phase, seconds)
+
+
+    def add(self, phase, seconds, timed_out=False):
+        if timed_out:
+            self.timed_out.add(phase)
+        else:
+            self.timed_out.discard(phase)
+        mean = self.mean.get(phase)
+        self.mean[phase] = seconds if mean is None else self.ALPHA * seconds + (1 - self.ALPHA) * mean
+        self.samples.setdefault(phase, collections.deque(maxlen=self.SAMPLES)).append(seconds)
+
+
+    def expected(self, phase):
+        # Average time of the phase or None if it hasn't been timed.
+        return self.mean.get(phase)
+
+
+    def quantile(self, phase, q):
+        times = sorted(self.samples.get(phase, []))
+        if not times:
+            return None
+        return times[min(len(times) - 1, int(q * len(times)))]
+
+
+    def timeout(self, phase, service_timeout, timeout_factor):
+        # Seconds to allow for the phase.  service_timeout until there are enough times to go on.
+        if not timeout_factor or len(self.samples.get(phase, [])) < self.MIN_SAMPLES:
+            return service_timeout
+        timeout = timeout_factor * self.quantile(phase, 0.95)
+        if phase in self.timed_out:
+            timeout = max(timeout, service_timeout)
+        return min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT_FACTOR * service_timeout)
+
+#-----------------------------------------------------------------------------------------------------
+
+class StateStore:
+    # Keeps the state of each server in a SQLite database so it survives a program restart: status, active
+    # errors, the phase of a restart in progress, the last restart, success and failure times and a history
+    # of restarts.  Starting up is one local read rather than asking the alert manager about each server,
+    # and it works when alerts are turned off.  The database is in WAL mode so each change is a small
+    # transaction that doesn't block readers.  The connection is shared by the restart threads so the
+    # access is serialised with a lock.
+
+    IDLE = "idle"
+    SUCCESS = "success"
+    FAILURE = "failure"
+    INTERRUPTED = "interrupted"
+
+    # Number of restarts kept in the history of each server.
+    HISTORY_LENGTH = 100
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        try:
+            self.db = self.open(file_name)
+        except Exception as e:
+            # Carry on without saving the state rather than not restarting the servers at all.
+            logger.error(f"Error opening {file_name}: {str(e)}.  The state of the servers will not be saved")
+            self.db = self.open(":memory:")
+
+
+    def open(self, file_name):
+        db = sqlite3.connect(file_name, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            db.execute("""CREATE TABLE IF NOT EXISTS servers (
+                              name TEXT PRIMARY KEY,
+                              status TEXT,
+                              errors TEXT NOT NULL DEFAULT '',
+                              phase TEXT NOT NULL DEFAULT 'idle',
+                              last_restart REAL,
+                              last_success REAL,
+                              last_failure REAL,
+                              last_duration REAL)""")
+            db.execute("""CREATE TABLE IF NOT EXISTS history (
+                              id INTEGER PRIMARY KEY,
+                              name TEXT NOT NULL,
+                              started REAL NOT NULL,
+                              finished REAL NOT NULL,
+                              outcome TEXT NOT NULL,
+                              error TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS history_name ON history (name, started)")
+            db.execute("""CREATE TABLE IF NOT EXISTS durations (
+                              name TEXT NOT NULL,
+                              phase TEXT NOT NULL,
+                              samples TEXT NOT NULL,
+                              PRIMARY KEY (name, phase))""")
+        return db
+
+
+    def load(self):
+        # Returns a dictionary of server name -> saved state (a sqlite3.Row).
+        with self.lock:
+            return {row["name"]: row for row in self.db.execute("SELECT * FROM servers")}
+
+
+    def update(self, server_name, fields, history=None):
+        # Set fields of a server's row, adding the row if the server is new, and optionally add a restart to
+        # the history.  It is all done in one transaction.
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute("INSERT OR IGNORE INTO servers (name) VALUES (?)", (server_name,))
+                    self.db.execute(f"UPDATE servers SET {columns} WHERE name = ?", (*fields.values(), server_name))
+                    if history:
+                        self.db.execute("INSERT INTO history (name, started, finished, outcome, error) VALUES (?, ?, ?, ?, ?)",
+                                        (server_name, *history))
+                        self.db.execute("""DELETE FROM history WHERE name = ? AND id NOT IN
+                                          (SELECT id FROM history WHERE name = ? ORDER BY started DESC LIMIT ?)""",
+                                        (server_name, server_name, self.HISTORY_LENGTH))
+            except Exception as e:
+                logger.error(f"Error saving the state of {server_name}: {str(e)}")
+
+
+    def set_phase(self, server_name, phase):
+        self.update(server_name, {"phase": phase})
+
+
+    def load_durations(self, server_name):
+        # Returns a dictionary of phase -> list of the recent times of the phase, oldest first.
+        with self.lock:
+            rows = self.db.execute("SELECT phase, samples FROM durations WHERE name = ?", (server_name,)).fetchall()
+        return {row["phase"]: json.loads(row["samples"]) for row in rows}
+
+
+    def save_durations(self, server_name, phase, samples):
+        with self.lock:
+            try:
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO durations (name, phase, samples) VALUES (?, ?, ?)",
+                                    (server_name, phase, json.dumps(list(samples))))
+            except Exception as e:
+                logger.error(f"Error saving the restart times of {server_name}: {str(e)}")
+
+
+    def set_last_restart(self, server_name, last_restart):
+        self.update(server_name, {"last_restart": last_restart})
+
+
+    def restart_end(self, server_name, status, err_list, started, outcome, error=None):
+        # Save the result of a restart and add it to the history.
+        finished = time.time()
+        fields = {"status": status, "errors": ",".join(str(err) for err in err_list), "phase": self.IDLE,
+                  "last_duration": finished - started}
+        if outcome == self.SUCCESS:
+            fields["last_success"] = finished
+        elif outcome == self.FAILURE:
+            fields["last_failure"] = finished
+        self.update(server_name, fields, (started, finished, outcome, error))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#-----------------------------------------------------------------------------------------------------
+
+class Scheduler:
+    # Decides when restarts are due.  Each server is due cmsd_period seconds after its last restart.  The
+    # due times are kept in a min-heap so the next one is found without scanning the server list.  The
+    # times are absolute, so the schedule doesn't drift by the time the restarts take, and the last restart
+    # times are saved in the state store so the rotation carries on where it left off after a program restart.
+    # Servers without a saved time are given due times restart_interval apart, starting now.  Servers whose
+    # last restart was interrupted are due straight away.
+
+    def __init__(self, config, server_list, saved):
+        self.server_list = server_list
+        self.cmsd_period = config.cmsd_period
+        self.last_tick = None
+        # (due time, server name).  An entry is stale if the server has been given a new due time since.
+        self.heap = []
+        # server name -> current due time
+        self.due = {}
+
+        interval = server_list.restart_interval()
+        now = time.time()
+        unknown = 0
+        for server in server_list.list:
+            state = saved.get(server.name)
+            if state and state["phase"] != StateStore.IDLE:
+                self.set_due(server, now)
+            elif state and state["last_restart"] is not None:
+                server.last_restart = state["last_restart"]
+                self.set_due(server, state["last_restart"] + self.cmsd_period)
+            else:
+                self.set_due(server, now + unknown * interval)
+                unknown += 1
+        logger.info(f"{len(server_list.list) - unknown} server restart times read from the state file")
+
+
+    def set_due(self, server, due):
+        self.due[server.name] = due
+        heapq.heappush(self.heap, (due, server.name))
+
+
+    def remove(self, server):
+        # Stop scheduling a server.  Its heap entry becomes stale and is dropped when it reaches the top.
+        self.due.pop(server.name, None)
+
+
+    def reload(self, config, added, saved):
+        # Use the new cmsd_period from the next restart of each server and schedule the added servers
+        # restart_interval apart, starting now.  Added servers with a saved restart time carry on from it.
+        self.cmsd_period = config.cmsd_period
+        interval = self.server_list.restart_interval()
+        now = time.time()
+        unknown = 0
+        for server in added:
+            state = saved.get(server.name)
+            if state and state["phase"] == StateStore.IDLE and state["last_restart"] is not None:
+                self.set_due(server, state["last_restart"] + self.cmsd_period)
+            else:
+                self.set_due(server, now + unknown * interval)
+                unknown += 1
+
+
+    def due_time(self, server):
+        return self.due[server.name]
+
+
+    def next_due(self):
+        # Earliest due time, dropping stale entries from the top of the heap.
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+
+    def candidates(self, count):
+        # The count servers due soonest that aren't waiting to be restarted or being restarted.  Servers in a
+        # group that is at its restart limit are left until later if there are others to pick from.
+        servers = {server.name: server for server in self.server_list.list}
+        with self.server_list.lock:
+            busy = set(server.name for server in self.server_list.in_flight) | set(server.name for server in self.server_list.pending)
+            full = set(group for group in self.server_list.groups.values() if group.capacity(self.server_list.in_flight) <= 0)
+        entries = heapq.nsmallest(count, (entry for entry in self.heap
+                                         if self.due.get(entry[1]) == entry[0] and entry[1] not in busy
+                                         and servers[entry[1]].group not in full))
+        if not entries:
+            entries = heapq.nsmallest(count, (entry for entry in self.heap
+                                             if self.due.get(entry[1]) == entry[0] and entry[1] not in busy))
+        if not entries:
+            entries = heapq.nsmallest(count, (entry for entry in self.heap if self.due.get(entry[1]) == entry[0]))
+        return [servers[name] for due, name in entries]
+
+
+    def time_to_next(self):
+        # Seconds until the next restart should be started.
+        return self.next_start(self.next_due()) - time.time()
+
+
+    def next_start(self, next_due):
+        # Time the next restart should be started when the earliest due time is next_due.  Restarts are at
+        # least restart_interval apart and policies that pick servers out of order start looking spare_slots
+        # restarts before one is due.
+        interval = self.server_list.restart_interval()
+        next_time = next_due - self.server_list.policy.spare_slots * interval
+        if self.last_tick is not None:
+            next_time = max(next_time, self.last_tick + interval)
+        return next_time
+
+
+    def progress(self):
+        # How well the rotation is keeping to cmsd_period, for the metrics.  Called from the metrics threads
+        # so it works on copies and doesn't touch the heap.  A server is done in the current rotation if it
+        # has been restarted successfully in the last cmsd_period seconds.  The rotation is predicted to end
+        # when the last outstanding server is due, or once all of them have been restarted restart_interval
+        # apart if that is later.
+        now = time.time()
+        due = dict(self.due)
+        if not due:
+            return None
+        servers = [server for server in list(self.server_list.list) if server.name in due]
+        outstanding = [server for server in servers
+                       if server.last_success is None or now - server.last_success >= self.cmsd_period]
+        if outstanding:
+            rotation_end = max(max(due[server.name] for server in outstanding),
+                               now + len(outstanding) * self.server_list.restart_interval())
+        else:
+            rotation_end = max(due.values())
+        return {
+            "since_success": {server.name: now - (server.last_success if server.last_success is not None else server.added_time) for server in servers},
+            "max_overdue": max(max(now - time_due for time_due in due.values()), 0),
+            "complete": 100 * (len(servers) - len(outstanding)) / len(servers) if servers else 100,
+            "rotation_end": rotation_end,
+            "next_restart": self.next_start(min(due.values())),
+            "cmsd_period": self.cmsd_period,
+        }
+
+
+    def tick(self):
+        # Start the next restart.
+        self.last_tick = time.time()
+        self.server_list.restart_next_server()
+
+
+    def restart_selected(self, server):
+        # The server has been picked to be restarted.  Set its next due time and save the restart time.
+        # A restart that is on time or only a little late keeps its slot so the rotation doesn't drift.
+        # Restarts that are early, or well overdue (after the program has been stopped), start a new slot.
+        now = time.time()
+        due = self.due[server.name]
+        if due <= now <= due + self.server_list.restart_interval():
+            next_due = due + self.cmsd_period
+        else:
+            next_due = now + self.cmsd_period
+        logger.debug(f"Next restart of {server.name} due at {time.ctime(next_due)}")
+        self.set_due(server, next_due)
+        # Save the start of the slot rather than the time now so the rotation keeps its timing after a program restart.
+        state_store.set_last_restart(server.name, next_due - self.cmsd_period)
 
 #-----------------------------------------------------------------------------------------------------
 
@@ -625,21 +2143,148 @@ class ServerList:
         logger.debug("Creating server list")
         self.alert_set = True;
         self.list = []
-        self.current = 0
         self.num_ok = len(config.servers)
         self.min_ok = config.min_ok
+
+        # When more than one server can be restarted at a time the restarts are run by an engine
+        # (ThreadEngine or AsyncEngine).  Servers that are due to be restarted wait in pending until
+        # there is capacity to restart them.
+        self.max_concurrent = config.max_concurrent
+        self.in_flight = []
+        self.pending = collections.deque()
+        self.terminating = False
+        # Set by SIGHUP.  The main loop reloads the config when it sees it.
+        self.reload_requested = False
+        # Servers removed from the config while they were being restarted.  They are retired when the
+        # restart finishes.
+        self.retiring = []
+        # When the main loop last made progress and how long it may take to make more.
+        self.alive_time = time.time()
+        self.alive_limit = ALIVE_LIMIT
+        self.lock = threading.RLock()
+        self.engine = None
+        if self.max_concurrent > 1 and config.engine == THREAD:
+            self.engine = ThreadEngine(self)
+
+        # Picks the next server to restart.
+        self.cmsd_period = config.cmsd_period
+        if config.selection == LEAST_LOADED:
+            self.policy = LeastLoadedPolicy(config)
+        else:
+            self.policy = RoundRobinPolicy()
+
+        # The state of the servers saved by the last run.
+        saved = state_store.load()
+
         for name in config.servers:
             logger.debug(f"Adding server {name}")
             server = Server(name, config, self)
-            # Set the alert states according to what alerts were active on the last run. 
-            alerter.reset_alerts( server.name )
+            if name in saved:
+                server.load_state(saved[name])
+            else:
+                # Not seen before.  Set the alert states according to what alerts are active on the alert manager.
+                alerter.reset_alerts( server.name )
             self.list.append( server )
 
+        # Failure domains with their own restart limits.
+        self.set_groups(config)
+
+        # Decides when restarts are due.  Needs the list of servers and the policy.
+        self.scheduler = Scheduler(config, self, saved)
+
 
     def __len__(self):
         return len(self.list)
 
 
+    def alive(self, limit=ALIVE_LIMIT):
+        # Record that the main loop has made progress and will do so again within limit seconds.  Calls
+        # from other threads are ignored so a restart in a worker thread can't hide a stuck main loop.
+        if threading.current_thread() is threading.main_thread():
+            self.alive_time = time.time()
+            self.alive_limit = limit
+
+
+    def set_groups(self, config):
+        # Create the failure domains with their own restart limits and put the servers in them.
+        groups = {}
+        servers = {server.name: server for server in self.list}
+        for server in self.list:
+            server.group = None
+        for name, settings in config.groups.items():
+            group = ServerGroup(name, settings['max_concurrent'], settings['min_ok'])
+            for server_name in settings['servers']:
+                servers[server_name].group = group
+                group.servers.append(servers[server_name])
+            groups[name] = group
+        self.groups = groups
+
+
+    def reload(self):
+        # Read the config file again and apply it without stopping.  Only servers that have been added to the
+        # config get new Server objects.  Servers that have been removed are retired, straight away or when
+        # their restart finishes.  The other servers use the new settings from their next restart.
+        # engine, max_concurrent, selection and the ssh, metrics, alert and log settings are only read at start up.
+        self.reload_requested = False
+        logger.info("Reloading the config file")
+        config = Config(fail_no_key=False)
+        try:
+            config.load_config()
+        except Exception as e:
+            logger.error(f"Error reloading the config file: {str(e)}.  Keeping the current settings")
+            return
+        if not config.servers:
+            logger.error("The reloaded config file has no servers.  Keeping the current settings")
+            return
+
+        with self.lock:
+            current = {server.name: server for server in self.list}
+            added = [name for name in config.servers if name not in current]
+            removed = [server for server in self.list if server.name not in config.servers]
+
+            for server in self.list:
+                server.new_config = config
+
+            new_list = [current[name] for name in config.servers if name in current]
+            saved = state_store.load() if added else {}
+            for name in added:
+                try:
+                    server = Server(name, config, self)
+                except Exception as e:
+                    logger.error(f"Error adding server {name}: {str(e)}")
+                    continue
+                logger.info(f"Adding server {name}")
+                self.ajust_servers_ok(1)
+                if name in saved:
+                    server.load_state(saved[name])
+                else:
+                    alerter.reset_alerts(name)
+                new_list.append(server)
+            # Replace the list rather than change it so other threads looping over it aren't affected.
+            self.list = new_list
+
+            for server in removed:
+                logger.info(f"Removing server {server.name}")
+                if server in self.pending:
+                    self.pending.remove(server)
+                self.scheduler.remove(server)
+                if server.status(None) == OK:
+                    self.ajust_servers_ok(-1)
+                server.retired = True
+                if server in self.in_flight:
+                    self.retiring.append(server)
+                else:
+                    alerter.remove_node(server.name)
+
+            self.min_ok = config.min_ok
+            self.cmsd_period = config.cmsd_period
+            self.set_groups(config)
+            self.scheduler.reload(config, [server for server in self.list if server.name in added], saved)
+
+        logger.info(f"Config reloaded. {len(added)} servers added, {len(removed)} removed. Processing server list: {self}")
+        self.dispatch()
+
+
     def __str__(self):
         ret = ""
         comma = ""
@@ -649,29 +2294,142 @@ class ServerList:
         return ret
 
 
-    def next(self):
-        self.current += 1
-        if self.current >= len(self.list):
-            self.current = 0
-        return self.list[self.current]
+    def restart_interval(self):
+        # Time between starting restarts so that every server is restarted within cmsd_period.  The policy
+        # may need some spare restart slots each period to be able to pick servers out of order.  With no
+        # servers (and no spare slots) there is nothing to share the period between.
+        slots = len(self.list) + self.policy.spare_slots
+        if slots == 0:
+            return self.cmsd_period
+        return self.cmsd_period / slots
 
 
     def restart_next_server(self):
         if self.num_ok >= self.min_ok:
-            logger.debug("Doing next server")
-            self.next().restart()
+            if self.engine:
+                self.queue_next_server()
+            else:
+                logger.debug("Doing next server")
+                # Check the group before moving the server's due time on, so a server that is skipped keeps
+                # its place and is tried again at the next restart slot.
+                server = self.policy.select(self)
+                if self.group_capacity(server) > 0:
+                    self.scheduler.restart_selected(server)
+                    # Mark the server as being restarted so the health probe leaves it alone.
+                    with self.lock:
+                        self.in_flight.append(server)
+                    try:
+                        server.restart()
+                    finally:
+                        with self.lock:
+                            self.in_flight.remove(server)
+                else:
+                    logger.info(f"Restarting {server.name} would leave too few servers ok in group {server.group.name}. Skipping it")
+        elif self.num_ok + self.health_failures() >= self.min_ok:
+            # Only the health checks are keeping the number below min_ok.  The servers may just have been
+            # unreachable for a moment, so wait for them to pass a check rather than terminating.
+            logger.info(f"There are {self.num_ok} servers ok.  Not restarting any until more pass their health checks")
         else:
             # There aren't enough running servers.  Log the fact and terminate since the program can't do anyting else
             logger.info(f"There are {self.num_ok} servers ok.  There are insufficient to continue restarting servers")
             raise Exception("Insufficient servers running.")
 
 
+    def health_failures(self):
+        # Number of servers that are only in error because they failed a health check.
+        return sum(1 for server in self.list
+                   if server.status(None) == ERR and Server.HEALTH_ERR in server.err_list and not server.restart_failed)
+
+
+    def queue_next_server(self):
+        # Add the next server to the pending list and start as many pending restarts as there is capacity for.
+        # The policy may probe the loads of the servers, so the server is picked without holding the lock
+        # and finishing restarts and the health checks aren't held up by a slow probe.
+        server = self.policy.select(self)
+        with self.lock:
+            if server in self.in_flight or server in self.pending:
+                logger.info(f"{server.name} is still waiting to be restarted or being restarted. Skipping it")
+            else:
+                logger.debug(f"Queueing {server.name} to be restarted")
+                self.scheduler.restart_selected(server)
+                self.pending.append(server)
+        self.dispatch()
+
+
+    def restart_capacity(self):
+        # Number of extra restarts that can be started.  Servers being restarted count as not ok, so the number
+        # of servers in flight is capped so that num_ok - in_flight never drops below min_ok.
+        with self.lock:
+            return min(self.max_concurrent, self.num_ok - self.min_ok) - len(self.in_flight)
+
+
+    def group_capacity(self, server):
+        # Number of extra restarts that can be started in the server's group.  Servers that aren't in a
+        # group are only limited by restart_capacity().
+        with self.lock:
+            if server.group is None:
+                return self.max_concurrent
+            return server.group.capacity(self.in_flight)
+
+
+    def dispatch(self):
+        # Hand pending servers to the engine while there is capacity to restart them.  Servers whose group
+        # is at its limit stay pending and the next server from another group is started instead.
+        if not self.engine:
+            return
+        with self.lock:
+            while self.pending and not self.terminating and self.restart_capacity() > 0:
+                server = next((server for server in self.pending if self.group_capacity(server) > 0), None)
+                if server is None:
+                    break
+                self.pending.remove(server)
+                self.in_flight.append(server)
+                logger.debug(f"Starting restart of {server.name}. {len(self.in_flight)} restarts in flight")
+                self.engine.launch(server)
+            if self.pending and not self.terminating:
+                logger.debug(f"{len(self.pending)} servers waiting for restart capacity")
+
+
+    def restart_done(self, server):
+        # Called by the engine when a restart has finished.  Start the next pending restart.
+        with self.lock:
+            self.in_flight.remove(server)
+            if server in self.retiring:
+                # The server was removed from the config during its restart.
+                self.retiring.remove(server)
+                alerter.remove_node(server.name)
+        self.dispatch()
+
+
+    def abort_restarts(self, signum):
+        # Pass a shutdown signal to the servers being restarted by the engine so each one can leave its
+        # server in a good state.  Returns False if there are no restarts in flight.
+        with self.lock:
+            if not self.in_flight:
+                return False
+            self.terminating = True
+            self.pending.clear()
+            for server in self.in_flight:
+                server.signal_handler(signum, None)
+            return True
+
+
+    def wait_for_restarts(self):
+        # Stop any more restarts being started and wait for the engine to finish the restarts in flight.
+        with self.lock:
+            self.terminating = True
+            self.pending.clear()
+        if self.engine:
+            self.engine.wait()
+
+
     def ajust_servers_ok(self,amount):
         # Update the number of good servers.  If the number drops below
         # min_ok just raise an alert.  Let restart_next_server() exit
         # the process.  This should give prometheus time to collect the 
         # metrics.
-        self.num_ok += amount
+        with self.lock:
+            self.num_ok += amount
         logger.debug(f"Adjusting num_ok in server list by: {amount} num_ok now {self.num_ok}.  min_ok={self.min_ok}")
         if self.num_ok < self.min_ok:
             logger.info(f"Number of working servers ({self.num_ok}) dropped below the minimum ({self.min_ok})")
@@ -684,6 +2442,230 @@ class ServerList:
 
 #-----------------------------------------------------------------------------------------------------
 
+class ServerGroup:
+    # A failure domain (rack, switch, replica group) read from a [group:NAME] section of the config.  No more
+    # than max_concurrent of its servers are restarted at once and a restart isn't started if it would leave
+    # fewer than min_ok of its servers ok.
+
+    def __init__(self, name, max_concurrent, min_ok):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.min_ok = min_ok
+        self.servers = []
+
+
+    def num_ok(self):
+        return sum(1 for server in self.servers if server._status == OK)
+
+
+    def capacity(self, in_flight):
+        # Number of extra restarts that can be started in the group.  in_flight is the list of servers
+        # being restarted.
+        busy = sum(1 for server in in_flight if server.group is self)
+        return min(self.max_concurrent, self.num_ok() - self.min_ok) - busy
+
+#-----------------------------------------------------------------------------------------------------
+
+class ThreadEngine:
+    # Runs restarts for a ServerList on a pool of worker threads, one thread per restart in flight.
+
+    def __init__(self, server_list):
+        self.server_list = server_list
+        logger.debug(f"Creating a pool of {server_list.max_concurrent} restart workers")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=server_list.max_concurrent, thread_name_prefix="restart")
+
+
+    def launch(self, server):
+        self.executor.submit(self.run_restart, server)
+
+
+    def run_restart(self, server):
+        # Run by a worker thread.  Restart the server and tell the server list when it has finished.
+        try:
+            server.restart()
+        except Server.TerminateException:
+            logger.info(f"Restart of {server.name} was aborted")
+        except Exception as e:
+            logger.error(f"Exception in restart worker for {server.name}: {str(e)}")
+        finally:
+            self.server_list.restart_done(server)
+
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
+
+#-----------------------------------------------------------------------------------------------------
+
+class AsyncEngine:
+    # Runs restarts for a ServerList as coroutines on an asyncio event loop.  The blocking paramiko calls
+    # are run by a pool of ssh_workers threads and the cmsd_wait pause doesn't use a thread at all, so
+    # hundreds of restarts can be in flight with a fixed number of threads.  The event loop also replaces
+    # the scheduling loop in main().
+
+    def __init__(self, config, server_list):
+        self.server_list = server_list
+        self.server_list.engine = self
+        logger.debug(f"Creating a pool of {config.ssh_workers} ssh workers")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.ssh_workers, thread_name_prefix="ssh")
+        self.loop = None
+        self.tasks = set()
+        self.wakeup = None
+
+
+    def run(self):
+        # Run the event loop until the program is terminated.
+        asyncio.run(self.main())
+
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            self.loop.add_signal_handler(sig, self.signal_handler, sig)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload_handler)
+
+        try:
+            # Queue servers as the scheduler says they are due.
+            scheduler = self.server_list.scheduler
+            while not self.server_list.terminating:
+                self.server_list.alive()
+                if self.server_list.reload_requested:
+                    self.server_list.reload()
+                wait = scheduler.time_to_next()
+                if wait <= 0:
+                    # Picking the server can probe the loads of the servers, so it is done off the event loop.
+                    await self.loop.run_in_executor(None, scheduler.tick)
+                    continue
+                try:
+                    # Wake up at least every ALIVE_LIMIT / 2 seconds to show the event loop isn't blocked.
+                    await asyncio.wait_for(self.wakeup.wait(), min(wait, ALIVE_LIMIT / 2))
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        finally:
+            # Let the restarts in flight finish (or roll back) rather than cancelling them.
+            if self.tasks:
+                logger.info(f"Waiting for {len(self.tasks)} restarts to finish")
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.executor.shutdown(wait=True)
+
+        raise Server.TerminateException("Program termination detected")
+
+
+    def signal_handler(self, sig):
+        # Pass the signal on to the servers being restarted.  If nothing is being restarted the
+        # normal signal handler exits the program.
+        signal_handler(sig, None)
+        self.wakeup.set()
+
+
+    def reload_handler(self):
+        # SIGHUP.  Wake the scheduling loop to reload the config.
+        reload_handler(signal.SIGHUP, None)
+        self.wakeup.set()
+
+
+    def launch(self, server):
+        # Called by the server list, either from the event loop or from a step running in an ssh worker.
+        if threading.current_thread() is threading.main_thread():
+            self.start_task(server)
+        else:
+            self.loop.call_soon_threadsafe(self.start_task, server)
+
+
+    def start_task(self, server):
+        task = self.loop.create_task(self.run_restart(server))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+    async def run_restart(self, server):
+        try:
+            await server.restart_async(self.executor)
+        except Server.TerminateException:
+            logger.info(f"Restart of {server.name} was aborted")
+        except Exception as e:
+            logger.error(f"Exception in restart task for {server.name}: {str(e)}")
+        finally:
+            self.server_list.restart_done(server)
+
+
+    def wait(self):
+        # The event loop waits for the tasks when it finishes.
+        pass
+
+#-----------------------------------------------------------------------------------------------------
+
+class HttpEndpoint:
+    # Http requests to one service (alert manager, push gateway or prometheus).  The connections are kept
+    # open in a requests.Session and reused.  Every request has a connect and read timeout so a hung service
+    # can't hold up the program.  After HTTP_FAILURES failed requests in a row the endpoint is treated as down
+    # (the circuit is open) and requests fail straight away for HTTP_OPEN_TIME seconds.  After that one
+    # request is let through as a trial (the circuit is half open) while the others still fail straight away.
+    # The circuit closes again if the trial works and stays open for another HTTP_OPEN_TIME seconds if not.
+
+    class CircuitOpen(requests.exceptions.ConnectionError):
+        pass
+
+    def __init__(self, name, config, alerter):
+        self.name = name
+        self.alerter = alerter
+        self.timeout = (config.http_connect_timeout, config.http_timeout)
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+        # True while the trial request of a half open circuit is being made.
+        self.trial_in_progress = False
+
+
+    def request(self, method, url, **kwargs):
+        # Make a request.  Raises CircuitOpen if the endpoint is treated as down.  Responses with a server
+        # error status are returned but count as failures.
+        trial = False
+        with self.lock:
+            if self.failures >= HTTP_FAILURES:
+                if time.time() < self.open_until or self.trial_in_progress:
+                    raise HttpEndpoint.CircuitOpen(f"{self.name} is unavailable after {self.failures} failed requests")
+                self.trial_in_progress = True
+                trial = True
+        start_time = time.time()
+        try:
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except BaseException:
+            self.request_done(start_time, False, trial)
+            raise
+        self.request_done(start_time, response.status_code < 500, trial)
+        return response
+
+
+    def request_done(self, start_time, ok, trial=False):
+        self.alerter.http_request_done(self.name, time.time() - start_time, not ok)
+        with self.lock:
+            if trial:
+                self.trial_in_progress = False
+            if ok:
+                if self.failures >= HTTP_FAILURES:
+                    logger.info(f"{self.name} is available again")
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= HTTP_FAILURES:
+                    if self.failures == HTTP_FAILURES:
+                        logger.error(f"{self.name} has failed {self.failures} times in a row.  Not using it for {HTTP_OPEN_TIME} seconds")
+                    self.open_until = time.time() + HTTP_OPEN_TIME
+
+
+    def push_handler(self, url, method, timeout, headers, data):
+        # Handler for prometheus_client's push_to_gateway() so pushes use the pooled connections.
+        def handle():
+            response = self.request(method, url, headers=dict(headers), data=data)
+            if response.status_code >= 400:
+                raise IOError(f"Error talking to pushgateway: {response.status_code} {response.text}")
+        return handle
+
+#-----------------------------------------------------------------------------------------------------
+
 class Alerter:
     # Registry used to push metric prometheus
     registry = None
@@ -697,6 +2679,14 @@ class Alerter:
         self.alert_url = config.alert_url
         self.metrics_port = config.metrics_port
         self.alerts_on = config.alert_url != ""
+        # Copy of the active alerts on the alert manager. (alertname, node) -> alert.  It is read with one request
+        # and kept up to date as alerts are sent and ended.  It is read again after ALERT_CACHE_TTL seconds
+        # in case alerts have been changed by something else.
+        self.alert_cache = {}
+        self.alert_cache_time = None
+        self.alert_cache_lock = threading.Lock()
+        # Last health check result of each server.
+        self.node_up = {}
         logger.info(f"Alerts are {'enabled' if self.alerts_on else 'disabled'}")
 
         # Setup the metrics
@@ -709,26 +2699,81 @@ class Alerter:
         b_end = ((config.cmsd_wait + 2*config.service_timeout+b_size) // b_size) * b_size
         duration_buckets = [x for x in range(b_start, b_end, b_size)]
 
+        # The drain time is between 0 and cmsd_wait.
+        drain_buckets = [x for x in [1, 5, 10, 30, 60, 120, 300, 600, 1200] if x < config.cmsd_wait] + [config.cmsd_wait]
+
         if self.metrics_method == PULL:
             # Pull needs a webserver to serve the metrics.
             logger.debug(f"Creating webserver on port {self.metrics_port}")
             start_http_server(self.metrics_port)
             labels = ["node"]
+            self.registry = REGISTRY
         else:
             labels = ["node","cluster"]
-        self.create_metrics(labels,duration_buckets)
+            # Only the xrootdrestart metrics are pushed, not the process and python metrics in the default
+            # registry.  The heartbeat is also in a registry of its own so it can be pushed on its own.
+            self.registry = CollectorRegistry()
+            self.heartbeat_registry = CollectorRegistry()
+            self.grouping_key = {"cluster": self.cluster_id, "instance": self.hostname}
+        self.create_metrics(labels,duration_buckets,drain_buckets)
+        if self.metrics_method == PUSH:
+            self.heartbeat_registry.register(self.heartbeat_metric)
+        # The rotation and liveness metrics are worked out when they are collected.
+        self.registry.register(RotationCollector(self, labels))
+        self.registry.register(LivenessCollector(self, labels, self.metrics_method == PULL))
+
+        # Pooled http connections to the services used.
+        self.alertmanager = HttpEndpoint("alertmanager", config, self)
+        self.pushgateway = HttpEndpoint("pushgateway", config, self)
+        self.prometheus = HttpEndpoint("prometheus", config, self)
+
+        # Alerts are sent by a background thread so the restarts don't wait for the alert manager.
+        self.dispatcher = AlertDispatcher(self)
+        if self.alerts_on:
+            self.dispatcher.start()
+
+        # Everything that talks to the alert manager is run on the event bus.
+        self.events = EventBus(self)
+        self.events.start()
+
+        # The metrics are pushed by a background thread.
+        self.pusher = MetricsPusher(self)
+        if self.metrics_method == PUSH:
+            self.pusher.start()
         
 
-    def create_metrics(self,labels,duration_buckets):
-        self.heartbeat_metric = Gauge("xrootdrestart_heartbeat", f"xrootdrestart heartbeat generated every {HEARTBEAT_INTERVAL} seconds",labels)
-        self.xrootdrestart_restart_active = Gauge("xrootdrestart_restart_active","State of the service restart on an XRootD node. 1=Restart Active, 0=Idle",labels)
-        self.xrootdrestart_start_time = Gauge("xrootdrestart_start_time","Time when the xrootdrestart started restarting a server",labels)
-        self.xrootdrestart_restart_alert_state = Gauge("xrootdrestart_restart_alert_state","state of the restart alert for a node. 1=Alert, 0=No Alert",labels)
-        self.xrootdrestart_connect_alert_state = Gauge("xrootdrestart_connect_alert_state","Unable to connect alert state. 1=Alert, 0=No Alert",labels)
-        self.xrootdrestart_insufficuent_alert_state = Gauge("xrootdrestart_insufficient_alert_state","State of the alert indicating there are insuffucient servers to allow restarting to continue. 1=Alert, 0=No Alert",labels)
-        self.xrootdrestart_duration = Histogram("xrootdrestart_restart_duration_seconds","How long it took to restart a server",labels,buckets=duration_buckets)
+    def create_metrics(self,labels,duration_buckets,drain_buckets):
+        # The phase and command times aren't labelled by node.  There would be dozens of series for every node.
+        fleet_labels = [label for label in labels if label != "node"]
+        if self.metrics_method == PUSH:
+            # When the metrics are pulled the heartbeat is worked out when they are scraped (LivenessCollector).
+            self.heartbeat_metric = Gauge("xrootdrestart_heartbeat", f"xrootdrestart heartbeat generated every {HEARTBEAT_INTERVAL} seconds",labels,registry=self.registry)
+        self.xrootdrestart_restart_active = Gauge("xrootdrestart_restart_active","State of the service restart on an XRootD node. 1=Restart Active, 0=Idle",labels,registry=self.registry)
+        self.xrootdrestart_start_time = Gauge("xrootdrestart_start_time","Time when the xrootdrestart started restarting a server",labels,registry=self.registry)
+        self.xrootdrestart_restart_alert_state = Gauge("xrootdrestart_restart_alert_state","state of the restart alert for a node. 1=Alert, 0=No Alert",labels,registry=self.registry)
+        self.xrootdrestart_connect_alert_state = Gauge("xrootdrestart_connect_alert_state","Unable to connect alert state. 1=Alert, 0=No Alert",labels,registry=self.registry)
+        self.xrootdrestart_insufficuent_alert_state = Gauge("xrootdrestart_insufficient_alert_state","State of the alert indicating there are insuffucient servers to allow restarting to continue. 1=Alert, 0=No Alert",labels,registry=self.registry)
+        self.xrootdrestart_duration = Histogram("xrootdrestart_restart_duration_seconds","How long it took to restart a server",labels,buckets=duration_buckets,registry=self.registry)
+        self.xrootdrestart_drain_duration = Histogram("xrootdrestart_drain_duration_seconds","How long the wait between stopping cmsd and stopping xrootd actually took",labels,buckets=drain_buckets,registry=self.registry)
+        self.xrootdrestart_ssh_pool_requests = Counter("xrootdrestart_ssh_pool_requests","Requests for an ssh connection. result=hit reused a pooled connection, result=miss opened a new one",labels+["result"],registry=self.registry)
+        self.xrootdrestart_ssh_pool_idle = Gauge("xrootdrestart_ssh_pool_idle_connections","Number of idle ssh connections kept open for reuse",labels,registry=self.registry)
+        self.xrootdrestart_expected_duration = Gauge("xrootdrestart_expected_duration_seconds","Expected time to restart a node, learned from its previous restarts",labels,registry=self.registry)
+        self.xrootdrestart_node_up = Gauge("xrootdrestart_node_up","Result of the last health check of a node. 1=Up, 0=Down",labels,registry=self.registry)
+        self.xrootdrestart_phase_duration = Histogram("xrootdrestart_phase_duration_seconds","How long each phase of a restart (connect, cmsd_stop, cmsd_wait, xrootd_stop, xrootd_start, cmsd_start) took",fleet_labels+["phase","outcome"],buckets=[0.1,0.25,0.5,1,2.5,5,10,30,60,120,300,600,1200],registry=self.registry)
+        self.xrootdrestart_command = Histogram("xrootdrestart_command_seconds","How long each command run on a server over ssh took",fleet_labels+["phase","outcome"],buckets=[0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300],registry=self.registry)
+        self.xrootdrestart_ssh_handshake = Histogram("xrootdrestart_ssh_handshake_seconds","How long it took to open a new ssh connection (tcp connect, key exchange and authentication)",labels,buckets=[0.05,0.1,0.25,0.5,1,2.5,5,10,30,60],registry=self.registry)
+
+        self.xrootdrestart_alert_queue = Gauge("xrootdrestart_alert_queue_depth","Number of alerts waiting to be sent to the alert manager",labels,registry=self.registry)
+        self.xrootdrestart_event_queue = Gauge("xrootdrestart_event_queue_depth","Number of events (alerts to send or end) waiting to be run",labels,registry=self.registry)
+        self.xrootdrestart_alert_flush = Histogram("xrootdrestart_alert_flush_seconds","How long it took to send a batch of alerts to the alert manager",labels,buckets=[0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10],registry=self.registry)
+
+        self.xrootdrestart_http_request = Histogram("xrootdrestart_http_request_seconds","How long requests to the alert manager, push gateway and prometheus took",labels+["endpoint"],buckets=[0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10],registry=self.registry)
+        self.xrootdrestart_log_suppressed = Counter("xrootdrestart_log_suppressed","Repeated log messages that weren't output",labels+["level"],registry=self.registry)
+        self.xrootdrestart_http_errors = Counter("xrootdrestart_http_errors","Failed requests to the alert manager, push gateway and prometheus",labels+["endpoint"],registry=self.registry)
 
         self.xrootdrestart_insufficuent_alert_state.labels(**self.metrics_labels(self.hostname)).set(0)
+        self.xrootdrestart_alert_queue.labels(**self.metrics_labels(self.hostname)).set(0)
+        self.xrootdrestart_event_queue.labels(**self.metrics_labels(self.hostname)).set(0)
         
         
     def metrics_labels(self,node):
@@ -739,6 +2784,11 @@ class Alerter:
         return ret
 
 
+    def fleet_labels(self):
+        # Return the labels to use with a metric value that covers all the nodes.
+        return {"cluster": self.cluster_id} if self.metrics_method == PUSH else {}
+
+
     def remove_active_alerts(self):
         # End all the active alerts on the alert manager.
         alerts = self.get_active_alerts(ALERT_TYPE_LIST)
@@ -753,7 +2803,7 @@ class Alerter:
             url = f"{self.alert_url}/api/v2/alerts"
             try:
                 logger.debug(f"Requesting alerts from {url}")
-                response = requests.get(url)
+                response = self.alertmanager.request("GET", url)
                 response.raise_for_status()
                 alerts = response.json()
                 for alert in alerts:
@@ -768,8 +2818,9 @@ class Alerter:
     def end_alert(self,alert):
         # Set the end time of the alert and update the alert manager. 
         alert_name = alert.get("labels", {}).get("alertname")
+        # The end time is set on a copy.  The alert may be in the cache or waiting to be sent by the dispatcher.
         logger.info("Ending alert: %s", alert)
-        alert["endsAt"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        alert = dict(alert, endsAt=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
         self.send_alert(alert)
 
 
@@ -777,18 +2828,18 @@ class Alerter:
         # Send the alert manager an ALERT_XROOTDRESTART_RESTART_ERROR and set the XROOTDRESTART_RESTART_ALERT_STATE metric
         if self.alerts_on:
             alert = self.new_alert(ALERT_XROOTDRESTART_RESTART_ERROR,server_name,err_summary,err_message)
-            self.send_alert(alert)
+            self.events.emit(self.send_alert, alert, key=(ALERT_XROOTDRESTART_RESTART_ERROR, server_name))
         self.xrootdrestart_restart_alert_state.labels(**self.metrics_labels(server_name)).set(1)
+        self.metrics_changed()
 
 
     def clear_restart_alert(self,server_name):
         # Clear ALERT_XROOTDRESTART_RESTART_ERROR on the alert manager and unset the XROOTDRESTART_RESTART_ALERT_STATE metric
         if self.alerts_on:
             logger.debug(f"Clearing restart alert for {server_name}")
-            alert = self.find_alert(ALERT_XROOTDRESTART_RESTART_ERROR,server_name)
-            if alert:
-                self.end_alert(alert)
+            self.events.emit(self.end_active_alert, ALERT_XROOTDRESTART_RESTART_ERROR, server_name, key=(ALERT_XROOTDRESTART_RESTART_ERROR, server_name))
         self.xrootdrestart_restart_alert_state.labels(**self.metrics_labels(server_name)).set(0)
+        self.metrics_changed()
 
 
     def cant_connect(self,server_name,err_summary,err_message):
@@ -796,36 +2847,44 @@ class Alerter:
         if self.alerts_on:
             logger.debug(f"Sending ALERT_XROOTDRESTART_CONNECT_ERROR alert for {server_name}" )
             alert = self.new_alert(ALERT_XROOTDRESTART_CONNECT_ERROR,server_name,err_summary,err_message)
-            self.send_alert(alert)
+            self.events.emit(self.send_alert, alert, key=(ALERT_XROOTDRESTART_CONNECT_ERROR, server_name))
         self.xrootdrestart_connect_alert_state.labels(**self.metrics_labels(server_name)).set(1)
+        self.metrics_changed()
 
 
     def clear_connect_alert(self, server_name):
         # Clear ALERT_XROOTDRESTART_CONNECT_ERROR on the alert manager and unset the XROOTDRESTART_CONNECT_ALERT_STATE metric
         if self.alerts_on:
             logger.debug(f"Clearing ALERT_XROOTDRESTART_CONNECT_ERROR alert for {server_name}")
-            alert = self.find_alert(ALERT_XROOTDRESTART_CONNECT_ERROR,server_name)
-            if alert:
-                self.end_alert(alert)
+            self.events.emit(self.end_active_alert, ALERT_XROOTDRESTART_CONNECT_ERROR, server_name, key=(ALERT_XROOTDRESTART_CONNECT_ERROR, server_name))
         self.xrootdrestart_connect_alert_state.labels(**self.metrics_labels(server_name)).set(0)
+        self.metrics_changed()
 
 
     def send_insuffucient_alert(self,err_message):
         # Send the alert manager an ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS and set the XROOTDRESTART_INSUFFICUENT_ALERT_STATE metric
         if self.alerts_on:
             alert = self.new_alert(ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS,"","Too many servers down",err_message)
-            self.send_alert(alert)
+            self.events.emit(self.send_alert, alert, key=(ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS, ""))
         self.xrootdrestart_insufficuent_alert_state.labels(**self.metrics_labels(self.hostname)).set(1)
+        self.metrics_changed()
 
 
     def clear_insuffucient_alert(self):
         # Clear ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS on the alert manager and unset the XROOTDRESTART_INSUFFICUENT_ALERT_STATE metric
         if self.alerts_on:
             logger.debug(f"Clearing ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS alert")
-            alert = self.find_alert(ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS,"")
-            if alert:
-                self.end_alert(alert)
+            self.events.emit(self.end_active_alert, ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS, "", key=(ALERT_XROOTDRESTART_INSUFFICIENT_SERVERS, ""))
         self.xrootdrestart_insufficuent_alert_state.labels(**self.metrics_labels(self.hostname)).set(0)
+        self.metrics_changed()
+
+
+    def end_active_alert(self,alert_type,server_name):
+        # End the alert_type alert for server_name if it is active.  Run on the event bus as it may need to
+        # read the active alerts from the alert manager.
+        alert = self.find_alert(alert_type,server_name)
+        if alert:
+            self.end_alert(alert)
     
 
     def new_alert(self,alert_type,server_name,err_summary,err_message):
@@ -848,51 +2907,126 @@ class Alerter:
 
 
     def send_alert(self,alert):
-        # Send the alert to the alert manager
+        # Queue the alert to be sent to the alert manager.  The cached copy of the alerts is updated straight
+        # away so it shows the alert as sent (or ended).
         if self.alerts_on:
-            logger.debug(f"Sending alert: {alert}")
-            try:
-                mgr_url = f"{self.alert_url}/api/v2/alerts"
-                logger.debug(f"Sending alert to {mgr_url}")
-                response = requests.post( 
-                    url=mgr_url, 
-                    data=f"[{json.dumps(alert)}]",
-                    headers={"Content-type": "application/json"}
-                )
-                if response.status_code == 200:
-                    logger.debug("Alert sent successfully")
-                else:
-                    raise Exception(f"Failed to send alert: {response.status_code} {response.text}")
-            except Exception as e:
-                logger.error(f"Error sending alert: {alert}, Exception: {e}")
+            logger.debug(f"Queueing alert: {alert}")
+            self.update_alert_cache(alert)
+            self.dispatcher.put(alert)
+
+
+    def post_alerts(self,alerts):
+        # Send a list of alerts to the alert manager in one request.  Raises an exception if it fails.
+        mgr_url = f"{self.alert_url}/api/v2/alerts"
+        logger.debug(f"Sending {len(alerts)} alerts to {mgr_url}")
+        with self.xrootdrestart_alert_flush.labels(**self.metrics_labels(self.hostname)).time():
+            response = self.alertmanager.request(
+                "POST",
+                mgr_url,
+                data=json.dumps(alerts),
+                headers={"Content-type": "application/json"}
+            )
+        if response.status_code != 200:
+            raise Exception(f"Failed to send alerts: {response.status_code} {response.text}")
+        logger.debug("Alerts sent successfully")
+
+
+    def http_request_done(self,endpoint,seconds,failed):
+        self.xrootdrestart_http_request.labels(**self.metrics_labels(self.hostname),endpoint=endpoint).observe(seconds)
+        if failed:
+            self.xrootdrestart_http_errors.labels(**self.metrics_labels(self.hostname),endpoint=endpoint).inc()
+
+
+    def log_suppressed(self,level):
+        self.xrootdrestart_log_suppressed.labels(**self.metrics_labels(self.hostname),level=level).inc()
+
+
+    def set_event_queue_depth(self,depth):
+        self.xrootdrestart_event_queue.labels(**self.metrics_labels(self.hostname)).set(depth)
+
+
+    def flush(self,timeout):
+        # Wait up to timeout seconds for the waiting events to be run, the queued alerts to be sent and the
+        # last metrics to be pushed.  Used before the program exits.
+        end_time = time.time() + timeout
+        return (self.events.flush(timeout) and self.dispatcher.flush(max(end_time - time.time(), 0))
+                and self.pusher.flush(max(end_time - time.time(), 0)))
+
+
+    def set_alert_queue_depth(self,depth):
+        self.xrootdrestart_alert_queue.labels(**self.metrics_labels(self.hostname)).set(depth)
 
 
     def find_alert(self, alert_type, server_name):
-        # Find the alert_type alert on the alert manaager.
-        ret = None
-        alerts = self.get_active_alerts(alert_type)
+        # Find the alert_type alert on the alert manaager.  server_name is "" for alerts that aren't about a server.
+        # A copy is returned so the caller can't change the cache.
+        with self.alert_cache_lock:
+            if self.alert_cache_time is None or time.time() > self.alert_cache_time + ALERT_CACHE_TTL:
+                self.refresh_alert_cache()
+            return copy.deepcopy(self.alert_cache.get((alert_type, server_name)))
+
+
+    def refresh_alert_cache(self):
+        # Read all the active alerts with one request and index them.  Called with alert_cache_lock held.
+        # If the alert manager can't be read the old copy is kept until the next refresh.
+        self.alert_cache_time = time.time()
+        if not self.alerts_on:
+            return
+        url = f"{self.alert_url}/api/v2/alerts"
+        try:
+            logger.debug(f"Requesting alerts from {url}")
+            response = self.alertmanager.request("GET", url)
+            response.raise_for_status()
+            alerts = response.json()
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching active alerts: {e}")
+            return
+        cache = {}
         for alert in alerts:
-            if server_name != "" and alert.get("labels", {}).get("node") == server_name:
-                ret = alert
-                break
-            elif server_name == "":
-                ret = alert
-                break
-        return ret
+            if alert.get("labels", {}).get("alertname") in ALERT_TYPE_LIST:
+                cache[self.alert_key(alert)] = alert
+        # Alerts that are still waiting to be sent are newer than the copy on the alert manager.
+        for alert in self.dispatcher.pending():
+            key = self.alert_key(alert)
+            if "endsAt" in alert:
+                cache.pop(key, None)
+            else:
+                cache[key] = copy.deepcopy(alert)
+        self.alert_cache = cache
+        logger.debug(f"{len(cache)} alerts read")
+
+
+    @staticmethod
+    def alert_key(alert):
+        # (alertname, node) of an alert.  node is "" for alerts that aren't about a server.
+        labels = alert.get("labels", {})
+        return (labels.get("alertname"), labels.get("node", ""))
+
+
+    def update_alert_cache(self, alert):
+        # Add a sent alert to the cache or remove it if it has been ended.  A copy is kept so later changes to
+        # the alert by the caller don't change the cache.
+        key = self.alert_key(alert)
+        with self.alert_cache_lock:
+            if "endsAt" in alert:
+                self.alert_cache.pop(key, None)
+            else:
+                self.alert_cache[key] = copy.deepcopy(alert)
 
 
     def reset_alerts(self, server_name):
         # Set/unset the alert mentrics for a server dependant on the current active alerts on the alert manager. 
-        # NOTE: Should the current alerts be stored localy for when the alert manager isn't used. 
-        if self.find_alert(ALERT_XROOTDRESTART_CONNECT_ERROR,server_name):
-            self.xrootdrestart_restart_alert_state.labels(**self.metrics_labels(server_name)).set(1)
-        else:
-            self.xrootdrestart_restart_alert_state.labels(**self.metrics_labels(server_name)).set(0)
+        # Only used for servers that aren't in the state file yet.
+        self.set_alert_states(server_name,
+                              self.find_alert(ALERT_XROOTDRESTART_CONNECT_ERROR,server_name) is not None,
+                              self.find_alert(ALERT_XROOTDRESTART_RESTART_ERROR,server_name) is not None)
 
-        if self.find_alert(ALERT_XROOTDRESTART_RESTART_ERROR,server_name):
-            self.xrootdrestart_connect_alert_state.labels(**self.metrics_labels(server_name)).set(1)
-        else:
-            self.xrootdrestart_connect_alert_state.labels(**self.metrics_labels(server_name)).set(0)
+
+    def set_alert_states(self, server_name, connect_error, restart_error):
+        # Set the connect and restart alert state metrics for a server.
+        self.xrootdrestart_connect_alert_state.labels(**self.metrics_labels(server_name)).set(1 if connect_error else 0)
+        self.xrootdrestart_restart_alert_state.labels(**self.metrics_labels(server_name)).set(1 if restart_error else 0)
+        self.metrics_changed()
 
 
     def set_restart_time(self,server):
@@ -904,73 +3038,584 @@ class Alerter:
         # Set the heartbeat metric to the current time and PUSH to the gateway if metrics are being pushed.
         logger.debug("heartbeat")
         self.heartbeat_metric.labels(**self.metrics_labels(self.hostname)).set(time.time())
-        # Push the metric if needed.
         if self.metrics_method == PUSH:
-            logger.debug(f"Pushing metrics to {self.pushgw_url}")
-            push_to_gateway(self.pushgw_url, registry=self.heartbeat_metric.registry)
-            
+            self.pusher.request(False)
+
+
+    def metrics_changed(self):
+        # Push all the metrics straight away so the gateway shows a change of state.
+        if self.metrics_method == PUSH:
+            self.pusher.request(True)
+
+
+    def push_metrics(self):
+        # Replace all the metrics on the gateway.  Run by the pusher thread.
+        logger.debug(f"Pushing metrics to {self.pushgw_url}")
+        push_to_gateway(self.pushgw_url, job="xrootdrestart", registry=self.registry, grouping_key=self.grouping_key,
+                        handler=self.pushgateway.push_handler)
+
+
+    def push_heartbeat(self):
+        # Update just the heartbeat on the gateway.  Run by the pusher thread.
+        logger.debug(f"Pushing the heartbeat to {self.pushgw_url}")
+        pushadd_to_gateway(self.pushgw_url, job="xrootdrestart", registry=self.heartbeat_registry, grouping_key=self.grouping_key,
+                           handler=self.pushgateway.push_handler)
+
+
+    def set_phase_time(self,server_name,phase,outcome,seconds):
+        self.xrootdrestart_phase_duration.labels(**self.fleet_labels(),phase=phase,outcome=outcome).observe(seconds)
+
+
+    def set_command_time(self,server_name,phase,outcome,seconds):
+        self.xrootdrestart_command.labels(**self.fleet_labels(),phase=phase,outcome=outcome).observe(seconds)
+
+
+    def set_drain_time(self,server_name,seconds):
+        self.xrootdrestart_drain_duration.labels(**self.metrics_labels(server_name)).observe(seconds)
+
+
+    def ssh_pool_request(self,server_name,result):
+        self.xrootdrestart_ssh_pool_requests.labels(**self.metrics_labels(server_name),result=result).inc()
+
+
+    def set_ssh_pool_size(self,size):
+        self.xrootdrestart_ssh_pool_idle.labels(**self.metrics_labels(self.hostname)).set(size)
+
+
+    def set_handshake_time(self,server_name,seconds):
+        self.xrootdrestart_ssh_handshake.labels(**self.metrics_labels(server_name)).observe(seconds)
+
+
+    def remove_node(self,server_name):
+        # Remove the metric series of a server that has been taken out of the config.
+        label_values = list(self.metrics_labels(server_name).values())
+        series = [(metric, label_values) for metric in [self.xrootdrestart_restart_active, self.xrootdrestart_start_time,
+                                                        self.xrootdrestart_restart_alert_state, self.xrootdrestart_connect_alert_state,
+                                                        self.xrootdrestart_duration, self.xrootdrestart_drain_duration,
+                                                        self.xrootdrestart_ssh_handshake, self.xrootdrestart_node_up,
+                                                        self.xrootdrestart_expected_duration]]
+        series += [(self.xrootdrestart_ssh_pool_requests, label_values + [result]) for result in ["hit", "miss"]]
+        for metric, values in series:
+            try:
+                metric.remove(*values)
+            except KeyError:
+                # The server never had a value for this metric.
+                pass
+        self.node_up.pop(server_name, None)
+        self.metrics_changed()
+
+
+    def set_expected_duration(self,server_name,seconds):
+        self.xrootdrestart_expected_duration.labels(**self.metrics_labels(server_name)).set(seconds)
+
+
+    def set_node_up(self,server_name,up):
+        self.xrootdrestart_node_up.labels(**self.metrics_labels(server_name)).set(1 if up else 0)
+        # The health checks set this for every server every probe_interval.  Only push when it changes.
+        if self.node_up.get(server_name) != up:
+            self.node_up[server_name] = up
+            self.metrics_changed()
+
+
     def restart_begin(self,server_name):
         self.xrootdrestart_restart_active.labels(**self.metrics_labels(server_name)).set(1)
+        self.metrics_changed()
         
     def restart_end(self,server_name):
         self.xrootdrestart_restart_active.labels(**self.metrics_labels(server_name)).set(0)
+        self.metrics_changed()
+
+#-----------------------------------------------------------------------------------------------------
+
+class EventBus:
+    # Runs the side effects of the restarts on a background thread: sending alerts and ending alerts (which
+    # may need the active alerts to be read from the alert manager).  The restarts only add events to the
+    # queue so the ssh steps never wait for the monitoring services.  Events are run one at a time in the order they were added, so an alert is never ended
+    # before it has been sent.  The events about one alert are given its (alert type, server name) as their key.
+    # An event isn't added if the last event waiting with its key is the same, so repeated clears of an alert
+    # only end it once.  A send waiting after the end is a different event, so the order is kept.
+
+    def __init__(self, alerter):
+        self.alerter = alerter
+        self.queue = collections.deque()
+        # key -> the last event waiting with that key.
+        self.keys = {}
+        self.condition = threading.Condition()
+        # True while an event is being run.
+        self.busy = False
+        self.event_thread = threading.Thread(target=self.run, name="events")
+        self.event_thread.daemon = True
+
+    def start(self):
+        self.event_thread.start()
+
+    def emit(self, func, *args, key=None):
+        with self.condition:
+            event = (func, args, key)
+            if key is not None:
+                if self.keys.get(key) == event:
+                    return
+                self.keys[key] = event
+            self.queue.append(event)
+            self.alerter.set_event_queue_depth(len(self.queue))
+            self.condition.notify()
+
+    def flush(self, timeout):
+        # Wait up to timeout seconds for the waiting events to be run.
+        end_time = time.time() + timeout
+        with self.condition:
+            while (self.queue or self.busy) and time.time() < end_time:
+                self.condition.wait(end_time - time.time())
+            return not (self.queue or self.busy)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                event = self.queue.popleft()
+                func, args, key = event
+                if key is not None and self.keys.get(key) is event:
+                    del self.keys[key]
+                self.busy = True
+                self.alerter.set_event_queue_depth(len(self.queue))
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error(f"Error running {func.__name__}: {e}")
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+#-----------------------------------------------------------------------------------------------------
+
+class RotationCollector:
+    # Metrics showing whether the fleet is keeping to cmsd_period.  They depend on the time, so rather than
+    # being kept up to date by a thread they are worked out from the scheduler each time they are scraped
+    # (or pushed).
+
+    def __init__(self, alerter, labels):
+        self.alerter = alerter
+        self.labels = labels
+
+    def describe(self):
+        return self.families()
+
+    def collect(self):
+        families = self.families()
+        progress = server_list.scheduler.progress() if server_list is not None else None
+        if progress is None:
+            return families
+        since_success, max_overdue, complete, rotation_end, next_restart, cmsd_period = families
+        for name, seconds in progress["since_success"].items():
+            since_success.add_metric(self.values(name), seconds)
+        host = self.values(self.alerter.hostname)
+        max_overdue.add_metric(host, progress["max_overdue"])
+        complete.add_metric(host, progress["complete"])
+        rotation_end.add_metric(host, progress["rotation_end"])
+        next_restart.add_metric(host, progress["next_restart"])
+        cmsd_period.add_metric(host, progress["cmsd_period"])
+        return families
+
+    def families(self):
+        return [
+            GaugeMetricFamily("xrootdrestart_seconds_since_last_success", "Seconds since the last successful restart of a node, or since it was added if it hasn't had one", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_max_overdue_seconds", "Longest time any node is overdue to be restarted", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_rotation_complete_percent", "Percentage of the nodes restarted successfully in the last cmsd_period seconds", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_rotation_end_time", "Predicted time every node will have been restarted in the current rotation", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_next_restart_time", "Time the next restart is scheduled to start", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_cmsd_period_seconds", "Time between restarts of a node (cmsd_period)", labels=self.labels),
+        ]
+
+    def values(self, node):
+        return list(self.alerter.metrics_labels(node).values())
+
+#-----------------------------------------------------------------------------------------------------
+
+class LivenessCollector:
+    # Metrics showing the program is working, worked out when they are scraped.  The main loop (and a restart
+    # it is running) records its progress with ServerList.alive().  If it hasn't made progress for longer
+    # than it said it would, for example because it is stuck in an ssh read, xrootdrestart_main_loop_up is 0.
+    # When the metrics are pulled the heartbeat is the time of the scrape so no thread is needed to set it.
+
+    def __init__(self, alerter, labels, heartbeat):
+        self.alerter = alerter
+        self.labels = labels
+        self.heartbeat = heartbeat
+
+    def describe(self):
+        return self.families()
+
+    def collect(self):
+        families = self.families()
+        now = time.time()
+        host = list(self.alerter.metrics_labels(self.alerter.hostname).values())
+        if self.heartbeat:
+            families[-1].add_metric(host, now)
+        if server_list is not None:
+            up, last_progress, last_tick = families[:3]
+            up.add_metric(host, 1 if now - server_list.alive_time <= server_list.alive_limit else 0)
+            last_progress.add_metric(host, server_list.alive_time)
+            if server_list.scheduler.last_tick is not None:
+                last_tick.add_metric(host, server_list.scheduler.last_tick)
+        return families
+
+    def families(self):
+        families = [
+            GaugeMetricFamily("xrootdrestart_main_loop_up", "Whether the main loop is making progress. 1=Up, 0=Stuck", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_main_loop_progress_time", "Time the main loop last made progress", labels=self.labels),
+            GaugeMetricFamily("xrootdrestart_last_tick_time", "Time the scheduler last started a restart", labels=self.labels),
+        ]
+        if self.heartbeat:
+            families.append(GaugeMetricFamily("xrootdrestart_heartbeat", "Time the metrics were scraped", labels=self.labels))
+        return families
+
+#-----------------------------------------------------------------------------------------------------
+
+class MetricsPusher:
+    # Pushes the metrics to the push gateway from a background thread.  All the metrics are pushed when
+    # something has changed (and at least every FULL_PUSH_INTERVAL seconds so the counters and histograms
+    # are kept up to date).  Otherwise only the heartbeat is pushed.  Requests made while a push is waiting
+    # are merged into it.  After a failed push the next one waits PUSH_RETRY_WAIT seconds, doubling each
+    # time up to PUSH_MAX_RETRY_WAIT.
+
+    def __init__(self, alerter):
+        self.alerter = alerter
+        self.condition = threading.Condition()
+        # Pushes that have been asked for.
+        self.full = False
+        self.heartbeat = False
+        # True while a push is being made.
+        self.busy = False
+        self.last_full = 0
+        self.retry_wait = 0
+        self.retry_time = 0
+        self.push_thread = threading.Thread(target=self.run, name="pusher")
+        self.push_thread.daemon = True
+
+    def start(self):
+        self.push_thread.start()
+
+    def request(self, full):
+        with self.condition:
+            if full:
+                self.full = True
+            else:
+                self.heartbeat = True
+            self.condition.notify()
+
+    def flush(self, timeout):
+        # Push all the metrics and wait up to timeout seconds for it to be done.
+        if not self.push_thread.is_alive():
+            return True
+        end_time = time.time() + timeout
+        with self.condition:
+            self.full = True
+            self.condition.notify()
+            while (self.full or self.heartbeat or self.busy) and time.time() < end_time:
+                self.condition.wait(end_time - time.time())
+            return not (self.full or self.heartbeat or self.busy)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not (self.full or self.heartbeat) or time.time() < self.retry_time:
+                    self.condition.wait(self.retry_time - time.time() if self.full or self.heartbeat else None)
+                full = self.full or time.time() >= self.last_full + FULL_PUSH_INTERVAL
+                self.full = self.heartbeat = False
+                self.busy = True
+            try:
+                if full:
+                    self.alerter.push_metrics()
+                else:
+                    self.alerter.push_heartbeat()
+                ok = True
+            except Exception as e:
+                logger.error(f"Error pushing the metrics to {self.alerter.pushgw_url}: {e}")
+                ok = False
+            with self.condition:
+                self.busy = False
+                if ok:
+                    self.retry_wait = 0
+                    if full:
+                        self.last_full = time.time()
+                else:
+                    # Try again later, keeping any newer request.
+                    if full:
+                        self.full = True
+                    else:
+                        self.heartbeat = True
+                    self.retry_wait = min(self.retry_wait * 2 or PUSH_RETRY_WAIT, PUSH_MAX_RETRY_WAIT)
+                    self.retry_time = time.time() + self.retry_wait
+                self.condition.notify_all()
+
+#-----------------------------------------------------------------------------------------------------
+
+class AlertDispatcher:
+    # Sends alerts to the alert manager from a background thread.  Alerts waiting to be sent are kept per
+    # (alertname, node) so only the latest state of each alert is sent.  Everything waiting is sent in
+    # batches of up to ALERT_BATCH_SIZE alerts.  A failed batch is tried again ALERT_RETRIES times, waiting
+    # twice as long each time, unless newer states of its alerts have been queued in the meantime.
+
+    def __init__(self, alerter):
+        self.alerter = alerter
+        self.queue = collections.OrderedDict()
+        self.condition = threading.Condition()
+        # The batch being sent.
+        self.batch = []
+        self.dispatch_thread = threading.Thread(target=self.run, name="alerts")
+        self.dispatch_thread.daemon = True
+
+    def start(self):
+        self.dispatch_thread.start()
+
+    def put(self, alert):
+        key = Alerter.alert_key(alert)
+        with self.condition:
+            self.queue.pop(key, None)
+            self.queue[key] = alert
+            self.alerter.set_alert_queue_depth(len(self.queue))
+            self.condition.notify()
+
+    def flush(self, timeout):
+        # Wait up to timeout seconds for the queued alerts to be sent.  Used before the program exits.
+        end_time = time.time() + timeout
+        with self.condition:
+            while (self.queue or self.batch) and time.time() < end_time:
+                self.condition.wait(end_time - time.time())
+            return not (self.queue or self.batch)
+
+    def pending(self):
+        # The alerts that haven't been sent yet, oldest first.
+        with self.condition:
+            return [alert for key, alert in self.batch] + list(self.queue.values())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                self.batch = list(self.queue.items())[:ALERT_BATCH_SIZE]
+                for key, alert in self.batch:
+                    del self.queue[key]
+                self.alerter.set_alert_queue_depth(len(self.queue))
+            self.send()
+            with self.condition:
+                self.batch = []
+                self.condition.notify_all()
+
+    def send(self):
+        wait = ALERT_RETRY_WAIT
+        for attempt in range(ALERT_RETRIES):
+            try:
+                self.alerter.post_alerts([alert for key, alert in self.batch])
+                return
+            except Exception as e:
+                logger.error(f"Error sending {len(self.batch)} alerts (attempt {attempt + 1} of {ALERT_RETRIES}): {e}")
+            time.sleep(wait)
+            wait *= 2
+            # Drop alerts that have been queued again with a newer state.
+            with self.condition:
+                self.batch = [(key, alert) for key, alert in self.batch if key not in self.queue]
+            if not self.batch:
+                return
+        for key, alert in self.batch:
+            logger.error(f"Giving up sending alert: {alert}")
 
 #-----------------------------------------------------------------------------------------------------
 
 class UniqueFilter(logging.Filter):
-    # Filter duplicated log entries.  Multiple heartbeat log entries will be reduced to two log entries.
-    # The first log entry and then a summary line showing how many times the log entry was repeated.
-    # This stops the log file filling up with "heartbeat" entries.
+    # Filter duplicated log entries.  The first time a message is logged it is output.  Repeats of it in the
+    # next LOG_DEDUP_WINDOW seconds are counted but not output, and when the window ends a summary line shows
+    # how many times it was repeated.  The messages seen recently are kept in an LRU of up to LOG_DEDUP_SIZE
+    # entries so repeats are caught even when other messages are logged in between (heartbeats and health
+    # checks from different threads).  Messages are matched on the unformatted message and its arguments so
+    # repeats aren't formatted.  A background thread outputs the summaries of windows that have ended.
     def __init__(self):
-        self.last_message = None
-        self.last_level = None
-        self.count = 0
+        super().__init__()
+        # (level, msg, args) -> [first record, window end time, repeats]
+        self.recent = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_thread = threading.Thread(target=self.run, name="logdedup")
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
 
 
     def filter(self, record):
         # Skip processing if this is a summary record being output.  We don't want to dive into infinite recursion.
         if getattr(record, "is_summary", False):
             return True
+        # Records with a traceback are always output.
+        if record.exc_info:
+            return True
+        try:
+            key = (record.levelno, record.msg, record.args)
+            hash(key)
+        except TypeError:
+            # Arguments that can't be used as a key.
+            return True
 
-        # Get the current message and see if it's a repeat of the last.
-        current_message = record.getMessage()
-        if current_message == self.last_message:
-            # We're doing a repeated message.  Inc the repeat count and stop the current message being output.
-            self.count += 1
-            return False
-        else:
-            # This is a non-repeated message.  Any repeats before this one?
-            if self.count > 0:
-                # The current message is different to the last. The previous log message
-                # was repeated so we need to output two log messages this
-                # time: The summary of the message repeat and the new log message.
-
-                # If there were only two messages the same, just display the same message twice.
-                if self.count == 1:
-                    log_msg = self.last_message
-                else:
-                    log_msg = f"Repeated {self.count} more times: {self.last_message}"
-
-                # Create a summary record for repeated messages
-                summary_record = logging.LogRecord(
-                    name=record.name,
-                    level=self.last_level,
-                    pathname=record.pathname,
-                    lineno=record.lineno,
-                    msg=log_msg,
-                    args=(),
-                    exc_info=None,
-                )
-                # Mark it as a summary to avoid recursion
-                summary_record.is_summary = True
-                logging.getLogger(record.name).handle(summary_record)
-
-            # Reset things for the new messages
-            self.last_message = current_message
-            self.last_level = record.levelno
-            self.count = 0
+        now = time.time()
+        summaries = []
+        with self.lock:
+            entry = self.recent.get(key)
+            if entry is not None and now < entry[1]:
+                # A repeat.  Count it and stop it being output.
+                entry[2] += 1
+                self.recent.move_to_end(key)
+                suppressed = True
+            else:
+                if entry is not None:
+                    # The window has ended.  Output the summary before the message.
+                    summaries.append(entry)
+                self.recent[key] = [record, now + LOG_DEDUP_WINDOW, 0]
+                self.recent.move_to_end(key)
+                while len(self.recent) > LOG_DEDUP_SIZE:
+                    summaries.append(self.recent.popitem(last=False)[1])
+                suppressed = False
+        self.output_summaries(summaries)
+        if suppressed and alerter is not None:
+            alerter.log_suppressed(record.levelname)
+        return not suppressed
+
+
+    def run(self):
+        while True:
+            time.sleep(LOG_DEDUP_FLUSH)
+            self.flush(time.time())
+
+
+    def flush(self, now=None):
+        # Output the summaries of the windows that ended before now, or all of them if now is None.
+        with self.lock:
+            ended = [key for key, entry in self.recent.items() if now is None or entry[1] <= now]
+            summaries = [self.recent.pop(key) for key in ended]
+        self.output_summaries(summaries)
+
+
+    def output_summaries(self, summaries):
+        for record, window_end, count in summaries:
+            if count == 0:
+                continue
+            # If there were only two messages the same, just display the same message twice.
+            if count == 1:
+                log_msg = record.getMessage()
+            else:
+                log_msg = f"Repeated {count} more times: {record.getMessage()}"
+
+            # Create a summary record for repeated messages
+            summary_record = logging.LogRecord(
+                name=record.name,
+                level=record.levelno,
+                pathname=record.pathname,
+                lineno=record.lineno,
+                msg=log_msg,
+                args=(),
+                exc_info=None,
+            )
+            # Mark it as a summary to avoid recursion
+            summary_record.is_summary = True
+            logging.getLogger(record.name).handle(summary_record)
+
+#-----------------------------------------------------------------------------------------------------
 
+class LogContextFilter(logging.Filter):
+    # Add the node, phase and restart id of the restart being run by the current thread (or task) to a log
+    # record.  Run by the thread that logs the record, before it is queued.
+    def filter(self, record):
+        server = log_context.get()
+        if server is not None:
+            record.node = server.name
+            record.phase = server.phase
+            record.restart_id = server.restart_id
+        return True
+
+#-----------------------------------------------------------------------------------------------------
+
+class JsonFormatter(logging.Formatter):
+    # Format a log record as a single line JSON object so the log can be indexed without parsing the text.
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for field in ["node", "phase", "restart_id"]:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry)
+
+#-----------------------------------------------------------------------------------------------------
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    # Log file handler that starts a new file when the log file reaches log_max_bytes or every
+    # log_rotate_interval seconds.  The old files are compressed with gzip by a background thread and
+    # log_backups of them are kept (xrootdrestart.log.1.gz is the newest).  It is run by the logging
+    # QueueListener thread so nothing here holds up the threads that log.
+
+    def __init__(self, filename, max_bytes, rotate_interval, backups):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups)
+        self.rotate_interval = rotate_interval
+        self.rollover_at = time.time() + rotate_interval if rotate_interval else None
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+        self.compress_thread = None
+
+
+    def configure(self, config):
+        # Use the log settings from the config file.  The handler is created before it is read and the
+        # QueueListener thread may be writing a record, so the handler's lock is held while they are changed.
+        self.acquire()
+        try:
+            self.maxBytes = config.log_max_bytes
+            self.backupCount = config.log_backups
+            self.rotate_interval = config.log_rotate_interval
+            self.rollover_at = time.time() + self.rotate_interval if self.rotate_interval else None
+            if config.log_format == JSON:
+                self.setFormatter(JsonFormatter())
+        finally:
+            self.release()
+
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
             return True
+        return super().shouldRollover(record)
+
+
+    def doRollover(self):
+        # Wait for the last file to be compressed before the old files are renamed.
+        if self.compress_thread is not None:
+            self.compress_thread.join()
+        super().doRollover()
+        if self.rotate_interval:
+            self.rollover_at = time.time() + self.rotate_interval
+
+
+    def compress(self, source, dest):
+        # Move the log file out of the way and compress it in the background.  If the log file can't be renamed
+        # (it is bind mounted into a container) it is copied and emptied instead.
+        uncompressed = dest[:-len(".gz")]
+        try:
+            os.rename(source, uncompressed)
+        except OSError:
+            shutil.copyfile(source, uncompressed)
+            open(source, "w").close()
+        self.compress_thread = threading.Thread(target=self.gzip_file, args=(uncompressed, dest), name="logcompress")
+        self.compress_thread.daemon = True
+        self.compress_thread.start()
+
+
+    @staticmethod
+    def gzip_file(source, dest):
+        try:
+            with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(source)
+        except Exception as e:
+            print(f"Error compressing {source}: {e}", file=sys.stderr)
 
 #-----------------------------------------------------------------------------------------------------
 class Heartbeat:
@@ -987,22 +3632,88 @@ class Heartbeat:
         self.running = False
         
     def generate_heartbeat(self):
+        # Only used when the metrics are pushed.  The pushes are made by the MetricsPusher so an error here
+        # is logged and the heartbeat carries on.
         while self.running:
             try:
                 alerter.set_heartbeat()
-                time.sleep(HEARTBEAT_INTERVAL)
             except Exception as e:
                 logger.error(f"Error generating the heartbeat: {str(e)}")
-                self.running = False;
-                logger.error("Heartbeat disabled")
+            time.sleep(HEARTBEAT_INTERVAL)
             
 #-----------------------------------------------------------------------------------------------------
+
+class HealthProber:
+    # Checks every server in parallel every probe_interval seconds so a server that has gone bad is counted
+    # as not ok straight away rather than when its next restart is due.  The results update num_ok (and so
+    # the min_ok checks before each restart) and the xrootdrestart_node_up metric.  Servers being restarted
+    # are skipped because their services are stopped on purpose.
+
+    def __init__(self, config, server_list):
+        self.server_list = server_list
+        self.interval = config.probe_interval
+        self.running = True
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.ssh_workers, thread_name_prefix="probe")
+        self.probe_thread = threading.Thread(target=self.run_probes)
+        self.probe_thread.daemon = True
+
+    def start(self):
+        self.probe_thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run_probes(self):
+        while self.running:
+            start_time = time.time()
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.error(f"Error running the health checks: {str(e)}")
+            logger.debug(f"Health check of {len(self.server_list)} servers took {time.time() - start_time}s")
+            while self.running and time.time() < start_time + self.interval:
+                time.sleep(1)
+
+    def probe_all(self):
+        with self.server_list.lock:
+            busy = list(self.server_list.in_flight)
+        servers = [server for server in self.server_list.list if server not in busy]
+        futures = {self.executor.submit(server.health_check): server for server in servers}
+        for future in concurrent.futures.as_completed(futures):
+            server = futures[future]
+            try:
+                problem = future.result()
+            except Exception as e:
+                problem = str(e)
+            # The result is set while holding the lock so a restart can't start between the check and
+            # the status being changed.
+            with self.server_list.lock:
+                if server in self.server_list.in_flight or server not in self.server_list.list:
+                    # A restart started, or the server was removed from the config, while it was being checked.
+                    continue
+                server.set_health(problem)
+
+#-----------------------------------------------------------------------------------------------------
+def reload_handler(sig, frame):
+    # SIGHUP asks for the config file to be reloaded.  The reload is done by the main loop rather than in the
+    # signal handler so it doesn't happen part way through a change to the server list.
+    logger.info("Received signal to reload the config file")
+    if server_list:
+        server_list.reload_requested = True
+
+
 def signal_handler(sig, frame):
     # Handle program shutdown.  If a server is being restarted when a shutdown is instigated, the server object will 
     # make sure the services are running on the server before exiting.
     logger.info("Received signal to stop")
-    logger.info("Stopping heartbeat")
-    heartbeat.stop()
+    if server_list and server_list.abort_restarts(sig):
+        # Restarts are running in worker threads.  The main loop exits once they have finished.
+        logger.info("Waiting for the restarts in progress to finish before exiting")
+        return
+    if heartbeat:
+        logger.info("Stopping heartbeat")
+        heartbeat.stop()
+    alerter.flush(10)
     if sig == signal.SIGTERM:
         logger.info("Program terminated.  Exit gracefully")
     else:
@@ -1013,18 +3724,28 @@ def signal_handler(sig, frame):
 
 #-----------------------------------------------------------------------------------------------------
 def main():
-    global logger, alerter, heartbeat
+    global logger, alerter, heartbeat, server_list, ssh_pool, state_store
     
     # Configure the logging output.
-    # Set the format for the messages and filter repeating messages.
+    # Set the format for the messages and filter repeating messages.  The records are put on a queue by the
+    # threads that log them and written to the file by a QueueListener thread, so the restarts never wait
+    # for the disk.  Repeats are filtered and the restart details added before the records are queued.
     logger = logging.getLogger('xrootdrestart')
-    handler = logging.FileHandler(LOG_FILE)
+    handler = RotatingLogHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUPS)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
     unique_filter = UniqueFilter()
-    handler.addFilter(unique_filter)
-    logger.addHandler(handler)
+    queue_handler.addFilter(unique_filter)
+    queue_handler.addFilter(LogContextFilter())
+    logger.addHandler(queue_handler)
     logger.setLevel(logging.DEBUG)
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    # Write out the summaries of the repeated messages and then the queued records when the program exits.
+    atexit.register(log_listener.stop)
+    atexit.register(unique_filter.flush)
     
     # Logger active and configured so log the program start. 
     logger.info("===========================================================================")
@@ -1039,6 +3760,7 @@ def main():
     # Adjust the logging level to the value in the config.
     logger.info(f"Setting log level to {config.log_level}")
     logger.setLevel(config.log_level)
+    handler.configure(config)
     
     # Output current settings to the log
     logger.info(f"Version: {VERSION}")
@@ -1048,10 +3770,21 @@ def main():
     logger.info("Starting Alerter")
     alerter = Alerter(config)
 
-    # Start the heartbeat thread
-    logger.info("Starting heartbeat thread")
-    heartbeat = Heartbeat()
-    heartbeat.start()
+    # Setup the pool of ssh connections used to connect to the servers.  The connections are closed when
+    # the program exits.
+    ssh_pool = SSHPool(config)
+    ssh_pool.start()
+    atexit.register(ssh_pool.close_all)
+
+    # Open the database holding the state of the servers from the last run.
+    logger.info(f"Opening state file: {config.state_file}")
+    state_store = StateStore(config.state_file)
+
+    # Start the heartbeat thread.  When the metrics are pulled the heartbeat is set when they are scraped.
+    if config.metrics_method == PUSH:
+        logger.info("Starting heartbeat thread")
+        heartbeat = Heartbeat()
+        heartbeat.start()
 
     # Setup the server list
     server_list = ServerList( config )
@@ -1059,27 +3792,44 @@ def main():
         logger.info(f"Processing server list: {server_list}")
 
         # Work out the time between restarting all servers so that each server is restarted every cmsd_period.
-        restart_interval = config.cmsd_period / len(server_list)
+        restart_interval = server_list.restart_interval()
         logger.info(f"A server will be restarted every {restart_interval} seconds")
 
+        # Start checking the health of the servers in the background.
+        if config.probe_interval > 0:
+            logger.info(f"Starting health checks every {config.probe_interval} seconds")
+            HealthProber(config, server_list).start()
+
         # Put hook in to handle SIGTERM and SIGINT events.
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
-
-        # Start the scheduler
-        schedule.every(restart_interval).seconds.do( server_list.restart_next_server )
-        logger.debug(f"restart_next_server() scheduled to run every {restart_interval} seconds")
+        signal.signal(signal.SIGHUP, reload_handler)
 
         try:
-            # Run the first restart because schedule will wait for the restart_interval before doing the first run.
-            server_list.restart_next_server()
-
-            # Sit in a loop waiting for the next schedule.
-            while True:
-                schedule.run_pending()
-                time.sleep(5)
+            if config.engine == ASYNC:
+                # The asyncio engine runs its own scheduling loop.
+                logger.info("Starting the asyncio restart engine")
+                AsyncEngine(config, server_list).run()
+            else:
+                # Sit in a loop starting restarts when the scheduler says they are due.  Sleep for at most a
+                # second at a time so a shutdown of the worker pool is noticed.
+                scheduler = server_list.scheduler
+                while True:
+                    server_list.alive()
+                    if server_list.terminating:
+                        # A signal was received while restarts were running in the worker pool.
+                        server_list.wait_for_restarts()
+                        raise Server.TerminateException("Program termination detected")
+                    if server_list.reload_requested:
+                        server_list.reload()
+                    wait = scheduler.time_to_next()
+                    if wait <= 0:
+                        scheduler.tick()
+                    else:
+                        time.sleep(min(wait, 1))
         except Server.TerminateException as e:
             logger.info("Program terminating")
+            alerter.flush(10)
             sys.exit(3)
         except Exception as e:
             logger.error(f"Program terminating because of an exception: {str(e)}")
@@ -1092,6 +3842,7 @@ def main():
             print(tb)            
             logger.error(tb)
             logger.info("Program terminating")
+            alerter.flush(10)
             sys.exit(2)
     else:
         logger.info("No servers specified.  Program exit")